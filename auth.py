@@ -9,20 +9,21 @@ from google_auth_oauthlib.flow import InstalledAppFlow
 from config import GMAIL_SCOPES, GMAIL_CREDENTIALS_FILE, GMAIL_TOKEN_FILE
 
 class GmailAuth:
-    def __init__(self):
+    def __init__(self, token_file: str = GMAIL_TOKEN_FILE):
+        self.token_file = token_file  # one per mailbox
         self.creds = None
 
     async def load_token(self):
         """Load token from file if exists."""
-        if os.path.exists(GMAIL_TOKEN_FILE):
-            async with aiofiles.open(GMAIL_TOKEN_FILE, 'r') as f:
+        if os.path.exists(self.token_file):
+            async with aiofiles.open(self.token_file, 'r') as f:
                 token_data = json.loads(await f.read())
                 self.creds = Credentials.from_authorized_user_info(token_data, GMAIL_SCOPES)
 
     async def save_token(self):
         """Save token to file."""
         if self.creds:
-            async with aiofiles.open(GMAIL_TOKEN_FILE, 'w') as f:
+            async with aiofiles.open(self.token_file, 'w') as f:
                 await f.write(self.creds.to_json())
 
     async def refresh_if_expired(self):
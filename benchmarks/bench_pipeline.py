@@ -0,0 +1,200 @@
+"""End-to-end benchmark: notification -> history sync -> fetch -> ledger -> DM.
+
+Runs the real PubSubListener, Gmail client, event writer and SQLite ledger
+against local stand-ins: FakeGmail (REST API over HTTP), notifications
+injected straight into PubSubListener.handle_notification at a fixed rate,
+and a fake Discord user whose send() just records the delivery time.
+Reports throughput and delivery latency (mail added -> DM sent) for every
+combination of arrival rate and message size.
+
+    python benchmarks/bench_pipeline.py [--rates 20 100 500] [--sizes 2000 50000]
+        [--duration 5] [--client googleapiclient|async] [--gmail-latency 0.02]
+        [--discord-latency 0.05] [--dm-rate 5] [--digest] [--mailboxes 1]
+        [--gmail-errors 0.05]
+
+Discord pacing is off by default (--dm-rate 0) so the numbers show the
+pipeline rather than the DM rate limit; pass --dm-rate 5 for real pacing.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config  # noqa: E402
+
+# The ledger is a throwaway SQLite file; must be set before database is imported
+config.DATABASE_BACKEND = 'sqlite'
+config.SQLITE_PATH = os.path.join(tempfile.mkdtemp(prefix='gmail-bench-'), 'ledger.db')
+
+from google.oauth2.credentials import Credentials  # noqa: E402
+
+import database as db  # noqa: E402
+import metrics  # noqa: E402
+from dedup import SeenMessages  # noqa: E402
+from event_writer import EventWriteBuffer  # noqa: E402
+from gmail_api import GmailAPI  # noqa: E402
+from mailboxes import Mailbox, MailboxRegistry  # noqa: E402
+from pubsub_listener import PubSubListener  # noqa: E402
+from fake_gmail import FakeGmail  # noqa: E402
+
+random.seed(7)
+
+class FakeUser:
+    """Discord user stand-in: records which messages each DM carried and when."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.delivered = {}  # message_id -> perf_counter at send
+        self.sends = 0
+
+    async def send(self, embed=None, view=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.sends += 1
+        now = time.perf_counter()
+        for message_id in _message_ids(view):
+            self.delivered[message_id] = now
+
+def _message_ids(view):
+    ids = set()
+    for child in view.children if view else ():
+        if getattr(child, 'message_id', None):
+            ids.add(child.message_id)
+        elif hasattr(child, 'item') and getattr(child.item, 'options', None):
+            ids.update(option.value for option in child.item.options)
+    return ids
+
+class FakeBot:
+    def __init__(self, user):
+        self.user = user
+        self.loop = asyncio.get_running_loop()
+
+    async def fetch_user(self, user_id):
+        return self.user
+
+def percentile(values, q):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def make_client(args, gmail):
+    credentials = Credentials(token='bench')  # never expires, never refreshed
+    if args.client == 'async':
+        from gmail_api_async import AsyncGmailAPI
+        return AsyncGmailAPI(credentials, base_url=gmail.base_url)
+    return GmailAPI(credentials, api_endpoint=gmail.api_endpoint)
+
+async def run_once(args, gmails, rate: float, size: int) -> dict:
+    user = FakeUser(args.discord_latency)
+    bot = FakeBot(user)
+    mailboxes = MailboxRegistry(bot)
+    for gmail in gmails:
+        mailbox = Mailbox(bot, gmail.email, None, make_client(args, gmail))
+        await db.set_watch_record_async(gmail.email, int(time.time() * 1000) + 86400000, gmail.history_id)
+        await mailbox.history_cursor.load()
+        mailboxes.add(mailbox)
+    event_writer = EventWriteBuffer()
+
+    listener = PubSubListener(bot, mailboxes, event_writer, SeenMessages())
+    listener.dispatcher.rate = args.dm_rate or 10 ** 9
+    listener.dispatcher.per = 1.0
+    if not args.digest:
+        listener.digest.threshold = 10 ** 9
+    event_writer.start()
+
+    sent = []
+    created_at = {}
+    tasks = []
+    count = max(1, int(rate * args.duration))
+    start = arrival = time.perf_counter()
+    for i in range(count):
+        # Poisson arrivals
+        arrival += random.expovariate(rate)
+        delay = arrival - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        code = f"{random.randrange(10 ** 6):06d}" if random.random() < args.code_ratio else None
+        gmail = gmails[i % len(gmails)]
+        message_id, history_id = gmail.add_message(size, code)
+        sent.append(message_id)
+        created_at[message_id] = gmail.created_at[message_id]
+        data = json.dumps({'emailAddress': gmail.email, 'historyId': history_id}).encode()
+        tasks.append(asyncio.create_task(listener.handle_notification(data)))
+    await asyncio.gather(*tasks)
+
+    deadline = time.perf_counter() + args.timeout
+    while len(user.delivered) < len(sent) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+
+    await listener.stop()
+    await event_writer.close()
+    await mailboxes.close()
+
+    latencies = [user.delivered[m] - created_at[m] for m in sent if m in user.delivered]
+    return {
+        'sent': len(sent),
+        'delivered': len(latencies),
+        'dms': user.sends,
+        'throughput': len(latencies) / elapsed,
+        'p50': percentile(latencies, 0.50),
+        'p99': percentile(latencies, 0.99),
+        'syncs': sum(w.passes for w in listener.sync_workers.values()),
+    }
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rates', type=float, nargs='+', default=[20, 100, 500], help='notifications per second')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[2000, 50000], help='body size in characters')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds of arrivals per run')
+    parser.add_argument('--client', choices=('googleapiclient', 'async'), default=config.GMAIL_CLIENT)
+    parser.add_argument('--gmail-latency', type=float, default=0.02, help='seconds added to each Gmail response')
+    parser.add_argument('--gmail-errors', type=float, default=0.0, help='share of Gmail calls failing with 429/503')
+    parser.add_argument('--discord-latency', type=float, default=0.05, help='seconds per DM send')
+    parser.add_argument('--dm-rate', type=float, default=0, help='DMs per second (0 = unpaced)')
+    parser.add_argument('--code-ratio', type=float, default=0.1, help='share of mail carrying a code')
+    parser.add_argument('--digest', action='store_true', help='allow burst digests')
+    parser.add_argument('--mailboxes', type=int, default=1, help='fake accounts the arrivals are spread over')
+    parser.add_argument('--timeout', type=float, default=60.0, help='seconds to wait for stragglers')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    db.init_db()
+    gmails = [
+        FakeGmail(f'bench{n}@example.com', latency=args.gmail_latency, error_rate=args.gmail_errors)
+        for n in range(args.mailboxes)
+    ]
+    for gmail in gmails:
+        await gmail.start()
+    print(f"client={args.client} mailboxes={args.mailboxes} gmail_latency={args.gmail_latency}s discord_latency={args.discord_latency}s "
+          f"dm_rate={args.dm_rate or 'unpaced'} digest={args.digest} gmail_errors={args.gmail_errors}")
+    print(f"{'rate/s':>8}{'size':>9}{'sent':>7}{'done':>7}{'DMs':>6}{'syncs':>7}{'msg/s':>9}{'p50 ms':>9}{'p99 ms':>9}")
+    try:
+        for size in args.sizes:
+            for rate in args.rates:
+                r = await run_once(args, gmails, rate, size)
+                print(f"{rate:>8.0f}{size:>9}{r['sent']:>7}{r['delivered']:>7}{r['dms']:>6}{r['syncs']:>7}"
+                      f"{r['throughput']:>9.1f}{r['p50'] * 1000:>9.1f}{r['p99'] * 1000:>9.1f}")
+    finally:
+        if args.client == 'async':
+            from gmail_api_async import close_http_client
+            await close_http_client()
+        for gmail in gmails:
+            await gmail.stop()
+        db.close()
+
+    stages = metrics.summary()['stages']
+    print(f"\n{'stage':<16}{'n':>8}{'p50 ms':>9}{'p99 ms':>9}")
+    for stage, s in stages.items():
+        print(f"{stage:<16}{s['count']:>8}{s['p50'] * 1000:>9.1f}{s['p99'] * 1000:>9.1f}")
+
+if __name__ == '__main__':
+    asyncio.run(main())
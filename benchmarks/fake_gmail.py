@@ -0,0 +1,202 @@
+"""In-process stand-in for the Gmail REST API, for benchmarks.
+
+Serves a synthetic mailbox over HTTP with the endpoints the notification
+pipeline uses: profile, history.list, messages.list (``after:`` queries
+only), messages.get and the multipart batch endpoint. Point AsyncGmailAPI at FakeGmail.base_url, or GmailAPI at
+FakeGmail.api_endpoint.
+"""
+import asyncio
+import base64
+import itertools
+import json
+import random
+import time
+from bisect import bisect_right
+from email.parser import Parser
+from urllib.parse import urlsplit, parse_qs, unquote
+from aiohttp import web
+
+API = '/gmail/v1/users/me'
+REASONS = {200: 'OK', 404: 'Not Found', 429: 'Too Many Requests', 503: 'Service Unavailable'}
+WORDS = ("the your account team update offer sale today free shipping click here "
+         "unsubscribe privacy policy terms view browser new arrivals limited time").split()
+
+def synthetic_body(size: int, code: str = None) -> str:
+    words = []
+    length = 0
+    while length < size:
+        word = random.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    text = ' '.join(words)[:size]
+    if code:
+        text = f"Your verification code is {code}.\n" + text
+    return text
+
+class FakeGmail:
+    """Synthetic mailbox; add_message() appends to history like a delivery would."""
+
+    _instances = itertools.count()
+
+    def __init__(self, email: str = 'bench@example.com', page_size: int = 500, latency: float = 0.0,
+                 error_rate: float = 0.0):
+        self.email = email
+        self._tag = next(self._instances)  # keeps message IDs unique across fake mailboxes
+        self.page_size = page_size
+        self.latency = latency  # added to every response, seconds
+        self.error_rate = error_rate  # share of calls answered 429 or 503 instead
+        self.history_id = 1000
+        self.history_floor = 0  # history.list 404s for startHistoryId below this, like expired history
+        self.history = []       # (history_id, message_id), ascending
+        self.messages = {}
+        self.created_at = {}    # message_id -> time.perf_counter() at delivery
+        self.requests = 0
+        self._runner = None
+        self.base_url = None
+        self.api_endpoint = None
+
+    def add_message(self, body_size: int = 2000, code: str = None, labels=('INBOX', 'CATEGORY_UPDATES')):
+        """Deliver a message; returns (message_id, history_id) for the notification."""
+        self.history_id += 1
+        message_id = f"{self._tag:04x}{self.history_id:012x}"
+        body = synthetic_body(body_size, code)
+        self.messages[message_id] = {
+            'id': message_id,
+            'threadId': message_id,
+            'labelIds': list(labels),
+            'snippet': body[:200],
+            'internalDate': str(int(time.time() * 1000)),
+            'payload': {
+                'mimeType': 'multipart/alternative',
+                'headers': [
+                    {'name': 'From', 'value': f"Sender {self.history_id % 50} <sender{self.history_id % 50}@example.com>"},
+                    {'name': 'To', 'value': self.email},
+                    {'name': 'Subject', 'value': f"Benchmark message {self.history_id}"},
+                    {'name': 'Message-ID', 'value': f"<{message_id}@example.com>"},
+                    {'name': 'Received', 'value': 'from mx.example.com'},
+                ],
+                'body': {'size': 0},
+                'parts': [{
+                    'mimeType': 'text/plain',
+                    'headers': [],
+                    'body': {'size': len(body), 'data': base64.urlsafe_b64encode(body.encode()).decode()},
+                }],
+            },
+        }
+        self.history.append((self.history_id, message_id))
+        self.created_at[message_id] = time.perf_counter()
+        return message_id, self.history_id
+
+    # ---------- HTTP ----------
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0):
+        app = web.Application(client_max_size=64 * 1024 ** 2)
+        app.router.add_get(f'{API}/profile', self.handle_profile)
+        app.router.add_get(f'{API}/history', self.handle_history)
+        app.router.add_get(f'{API}/messages', self.handle_messages)
+        app.router.add_get(f'{API}/messages/{{message_id}}', self.handle_message)
+        app.router.add_post('/batch/gmail/v1', self.handle_batch)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.api_endpoint = f"http://{host}:{port}"
+        self.base_url = f"{self.api_endpoint}{API}"
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def transient_error(self):
+        """A random 429/503 (status, payload) per error_rate, else None."""
+        if random.random() >= self.error_rate:
+            return None
+        status = random.choice((429, 503))
+        return status, {'error': {'code': status, 'message': 'Injected failure'}}
+
+    async def _respond(self, status: int, payload: dict) -> web.Response:
+        self.requests += 1
+        if status == 200:
+            status, payload = self.transient_error() or (status, payload)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return web.json_response(payload, status=status)
+
+    def profile(self):
+        return 200, {'emailAddress': self.email, 'historyId': str(self.history_id)}
+
+    def history_page(self, query):
+        start = int(query['startHistoryId'][0])
+        if start < self.history_floor:
+            return 404, {'error': {'code': 404, 'message': 'Requested entity was not found.'}}
+        offset = int(query.get('pageToken', ['0'])[0])
+        size = min(int(query.get('maxResults', [self.page_size])[0]), self.page_size)
+        first = bisect_right(self.history, (start, '\uffff'))
+        newer = self.history[first:]
+        page = newer[offset:offset + size]
+        response = {
+            'history': [{'id': str(h), 'messagesAdded': [{'message': {'id': m, 'threadId': m}}]} for h, m in page],
+            'historyId': str(self.history_id),
+        }
+        if offset + size < len(newer):
+            response['nextPageToken'] = str(offset + size)
+        return 200, response
+
+    def messages_page(self, query):
+        """messages.list, newest first; only the ``after:<epoch seconds>`` search is understood."""
+        after = 0
+        for term in query.get('q', [''])[0].split():
+            if term.startswith('after:'):
+                after = int(term[len('after:'):]) * 1000
+        offset = int(query.get('pageToken', ['0'])[0])
+        size = min(int(query.get('maxResults', [self.page_size])[0]), self.page_size)
+        matches = [m for _, m in reversed(self.history) if int(self.messages[m]['internalDate']) > after]
+        page = matches[offset:offset + size]
+        response = {'messages': [{'id': m, 'threadId': m} for m in page]}
+        if offset + size < len(matches):
+            response['nextPageToken'] = str(offset + size)
+        return 200, response
+
+    def message(self, message_id):
+        msg = self.messages.get(message_id)
+        if msg is None:
+            return 404, {'error': {'code': 404, 'message': 'Requested entity was not found.'}}
+        return 200, msg
+
+    async def handle_profile(self, request):
+        return await self._respond(*self.profile())
+
+    async def handle_history(self, request):
+        return await self._respond(*self.history_page(parse_qs(request.query_string)))
+
+    async def handle_messages(self, request):
+        return await self._respond(*self.messages_page(parse_qs(request.query_string)))
+
+    async def handle_message(self, request):
+        return await self._respond(*self.message(request.match_info['message_id']))
+
+    async def handle_batch(self, request):
+        """multipart/mixed batch of messages.get calls (googleapiclient format)."""
+        raw = await request.text()
+        envelope = Parser().parsestr(f"Content-Type: {request.headers['Content-Type']}\r\n\r\n{raw}")
+        boundary = 'batch_bench_boundary'
+        parts = []
+        for part in envelope.get_payload():
+            request_line = part.get_payload().split('\n', 1)[0]
+            path = urlsplit(request_line.split(' ')[1]).path
+            status, payload = self.transient_error() or self.message(unquote(path.rsplit('/', 1)[1]))
+            parts.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\n"
+                f"Content-ID: <response-{part['Content-ID'][1:-1]}>\r\n\r\n"
+                f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n"
+                f"{json.dumps(payload)}\r\n"
+            )
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return web.Response(
+            body=(''.join(parts) + f"--{boundary}--\r\n").encode(),
+            headers={'Content-Type': f'multipart/mixed; boundary={boundary}'}
+        )
@@ -0,0 +1,83 @@
+import re
+from bisect import bisect_left
+from typing import NamedTuple
+
+from config import CODE_SCAN_MAX_CHARS
+
+class CodeCandidate(NamedTuple):
+    code: str
+    kind: str
+    score: float
+    position: int
+
+# Every pattern, plus the context keywords, in one alternation so the body is
+# scanned exactly once. Group order is the rank when two could match at the
+# same position.
+_SCANNER = re.compile(r"""
+    \b(?:
+        (?P<keyword>(?i:
+            code|otp|passcode|pin|verification|verify|one[- ]time|2fa|
+            security|login|log[- ]in|sign[- ]in|confirm(?:ation)?|authenticat\w*
+        ))
+      | (?P<numeric>\d{6,8})
+      | (?P<split>\d{3}[- ]\d{3})
+      | (?P<alnum>(?=[A-Z0-9]*\d)(?=[A-Z0-9]*[A-Z])[A-Z0-9]{6,10})
+      | (?P<short>\d{4,5})
+    )\b
+""", re.VERBOSE)
+
+# Base score per kind: 6-8 digit codes qualify on their own (as before),
+# the rest need a nearby keyword.
+_BASE_SCORE = {'numeric': 2.0, 'split': 1.5, 'alnum': 0.5, 'short': 0.0}
+KEYWORD_BONUS = 3.0
+KEYWORD_WINDOW = 80      # chars between keyword and code for the full bonus to decay over
+MIN_SCORE = 2.0
+# Amounts, order/ticket numbers, phone numbers
+_NOISE_PREFIXES = ('#', '$', '€', '£', '+', 'No.', 'no.')
+
+def find_codes(text: str, max_chars: int = CODE_SCAN_MAX_CHARS):
+    """Return likely verification codes in text, best first.
+
+    Only the first max_chars characters are scanned.
+    """
+    if not text:
+        return []
+    text = text[:max_chars]
+
+    keywords = []
+    raw = []
+    for match in _SCANNER.finditer(text):
+        kind = match.lastgroup
+        if kind == 'keyword':
+            keywords.append(match.start())
+        else:
+            raw.append((match.group(kind), kind, match.start(), match.end()))
+
+    candidates = []
+    for code, kind, start, end in raw:
+        score = _BASE_SCORE[kind]
+        if keywords:
+            score += KEYWORD_BONUS * _proximity(keywords, start, end)
+        prefix = text[max(0, start - 3):start].rstrip()
+        if prefix.endswith(_NOISE_PREFIXES):
+            score -= 2.0
+        if score >= MIN_SCORE:
+            candidates.append(CodeCandidate(re.sub(r'[- ]', '', code), kind, score, start))
+
+    candidates.sort(key=lambda c: (-c.score, c.position))
+    return candidates
+
+def best_code(text: str, max_chars: int = CODE_SCAN_MAX_CHARS):
+    """The single most likely code in text, or None."""
+    candidates = find_codes(text, max_chars)
+    return candidates[0].code if candidates else None
+
+def _proximity(keywords, start: int, end: int) -> float:
+    """1.0 right next to a keyword, falling linearly to 0 at KEYWORD_WINDOW chars."""
+    i = bisect_left(keywords, start)
+    distance = KEYWORD_WINDOW
+    if i > 0:
+        distance = min(distance, start - keywords[i - 1])
+    if i < len(keywords):
+        distance = min(distance, keywords[i] - end)
+    return max(0.0, 1.0 - distance / KEYWORD_WINDOW)
@@ -1,4 +1,5 @@
 import os
+import socket
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -23,7 +24,11 @@ VERIFY_TIMEOUT = 15
 PUBLIC_GUILD_ID = None
 PUBLIC_CHANNEL_ID = None
 
-# ---------- Database (SQL Server Authentication) ----------
+# ---------- Database ----------
+DATABASE_BACKEND = 'mssql'       # 'mssql' (SQL Server via pyodbc) or 'sqlite' (embedded, WAL)
+SQLITE_PATH = 'gmail_bot.db'
+
+# SQL Server Authentication (used when DATABASE_BACKEND = 'mssql')
 DATABASE = {
     'driver': '{ODBC Driver 17 for SQL Server}',
     'server': 'localhost',
@@ -31,16 +36,123 @@ DATABASE = {
     'uid': 'SQL_ID',
     'pwd': 'SQL_PW'
 }
+DB_POOL_SIZE = 5                 # max open connections (also DB executor threads)
+DB_POOL_TIMEOUT = 10             # seconds to wait for a free connection
+DB_HEALTH_CHECK_INTERVAL = 30    # ping idle connections older than this (seconds)
+EVENT_FLUSH_BATCH_SIZE = 200     # flush buffered gmail_events writes at this many ops...
+EVENT_FLUSH_INTERVAL = 2.0       # ...or after this many seconds, whichever comes first
+HISTORY_CHECKPOINT_INTERVAL = 10 # seconds between history cursor checkpoints to gmail_watch
+DEDUP_CACHE_SIZE = 10000         # message IDs remembered in memory to skip replays
+DEDUP_WARM_ROWS = 5000           # recent gmail_events rows loaded into that cache at startup
 
 # ---------- Gmail API Configuration ----------
 GMAIL_SCOPES = ['https://mail.google.com/']
 GMAIL_CREDENTIALS_FILE = 'credentials.json'
 GMAIL_TOKEN_FILE = 'token.json'
+# Mailboxes served by this process: email address -> token file. Leave empty to
+# serve only GMAIL_TOKEN_FILE (its address is read from the profile).
+GMAIL_ACCOUNTS = {}              # e.g. {'me@example.com': 'tokens/me.json', 'ops@example.com': 'tokens/ops.json'}
+GMAIL_HISTORY_PAGE_SIZE = 500    # users.history.list maxResults (API max is 500)
+GMAIL_BATCH_SIZE = 50            # messages.get calls per batch request (Gmail allows 100, recommends 50)
+GMAIL_BATCH_THRESHOLD = 3        # use a batch request once a history page adds this many messages
+GMAIL_FETCH_MAX_PASSES = 5       # sync passes a message may fail to fetch in (transient errors) before it is skipped
+GMAIL_EXECUTOR_WORKERS = 16      # threads (each with its own keep-alive transport) for Gmail calls
+GMAIL_HTTP_TIMEOUT = 30          # seconds
+GMAIL_CLIENT = 'googleapiclient' # 'googleapiclient' (threaded) or 'async' (native asyncio, httpx)
+GMAIL_ASYNC_MAX_CONNECTIONS = 20 # pooled connections for the async client (HTTP/2 multiplexes on top)
+GMAIL_ASYNC_MAX_CONCURRENCY = 200  # in-flight requests per mailbox for the async client
+
+# ---------- Gmail quota and retries ----------
+GMAIL_QUOTA_UNITS_PER_SECOND = 250  # Gmail's per-user quota (15,000 units a minute)
+GMAIL_QUOTA_BURST = 250          # units that can be spent at once after an idle spell
+GMAIL_RETRY_ATTEMPTS = 4         # retries of a call failing with 429, 5xx or a transport error...
+GMAIL_RETRY_BASE = 0.5           # ...after this many seconds, doubling (jittered)...
+GMAIL_RETRY_MAX = 16             # ...up to this
+GMAIL_BREAKER_THRESHOLD = 5      # failed attempts in a row that open a mailbox's circuit...
+GMAIL_BREAKER_COOLDOWN = 30      # ...failing its calls fast for this many seconds before probing
 
 # ---------- Google Cloud Pub/Sub ----------
 GCP_PROJECT_ID = 'exemplary-torch-470317-i1'
 GCP_TOPIC_NAME = 'gmail-notifications'
 GCP_SUBSCRIPTION_NAME = 'gmail-sub'
+PUBSUB_MAX_MESSAGES = 100        # flow control: outstanding (unacked) messages
+PUBSUB_MAX_BYTES = 10 * 1024 * 1024  # flow control: outstanding bytes
+PUBSUB_MAX_LEASE_DURATION = 600  # seconds the client keeps extending a message's ack deadline
+PUBSUB_MAX_IN_FLIGHT = 50        # notifications processed concurrently on the bot loop
+# Redelivery backoff for failed notifications. Set on the subscription at startup
+# when it has no retry policy; push subscriptions need one set in Pub/Sub itself.
+PUBSUB_RETRY_MIN_BACKOFF = 10    # seconds
+PUBSUB_RETRY_MAX_BACKOFF = 600   # seconds (Pub/Sub's maximum)
+
+# Ingestion mode: 'pull' (streaming pull subscriber) or 'push' (embedded HTTP endpoint;
+# single worker only, sharded workers need their own pull subscriptions)
+PUBSUB_MODE = 'pull'
+PUBSUB_PUSH_HOST = '0.0.0.0'
+PUBSUB_PUSH_PORT = 8080
+PUBSUB_PUSH_PATH = '/pubsub/push'
+PUBSUB_PUSH_VERIFY_TOKEN = True  # verify the OIDC bearer token (disable only for local testing)
+PUBSUB_PUSH_AUDIENCE = None      # audience set on the push subscription (required for push mode)
+PUBSUB_PUSH_SERVICE_ACCOUNT = None  # service account email the push subscription signs as (required for push mode)
+
+# ---------- Watch renewal ----------
+# Gmail watches expire after 7 days; each is renewed this long before its own
+# expiration (one timer for all mailboxes, no polling).
+WATCH_RENEW_BEFORE = 86400       # seconds before expiration a watch is renewed
+WATCH_RENEW_JITTER = 3600        # up to this many seconds earlier, spreading renewals out
+WATCH_RENEW_CONCURRENCY = 10     # users.watch calls in flight at once
+WATCH_RETRY_BASE = 30            # first retry after a failed renewal (seconds), doubling...
+WATCH_RETRY_MAX = 1800           # ...up to this
+
+# ---------- Resync (catch-up after downtime) ----------
+RESYNC_ON_STARTUP = True         # catch every mailbox up from its stored cursor at startup
+SYNC_PARALLEL_PAGES = 4          # history pages whose messages are fetched concurrently in one sync
+# When the stored history ID has expired (404), recent mail is listed by date
+# instead and reconciled against gmail_events.
+RESYNC_WINDOW = 7 * 86400        # look back at most this far (seconds)...
+RESYNC_WINDOW_MARGIN = 3600      # ...and no further than this before the mailbox's newest ledger row
+RESYNC_MAX_MESSAGES = 2000       # messages listed by one expired-history resync
+RESYNC_PROGRESS_INTERVAL = 5     # seconds between progress reports
+
+# ---------- Sharded workers ----------
+# Run several processes (or hosts) with the same GMAIL_ACCOUNTS and ledger DB;
+# mailboxes are split between them by leases in the database. Each worker pulls
+# from its own subscription '<GCP_SUBSCRIPTION_NAME>-<WORKER_ID>' on the topic
+# (created on demand) and ignores notifications for mailboxes it does not own.
+# Lease times are wall-clock, so keep the hosts' clocks in sync (NTP).
+SHARDING_ENABLED = False
+WORKER_ID = os.getenv('WORKER_ID') or f"{socket.gethostname()}-{os.getpid()}"  # set it so restarts reuse the subscription
+LEASE_TTL = 30                   # seconds a mailbox lease lasts without renewal
+LEASE_RENEW_INTERVAL = 10        # seconds between heartbeats / lease renewals / rebalancing
+WORKER_TIMEOUT = 30              # a worker without a heartbeat for this long is dead
+WORKER_SUBSCRIPTION_TTL = 86400  # seconds before an idle per-worker subscription is deleted by Pub/Sub
+
+# ---------- Notification content ----------
+BODY_TEXT_MAX_CHARS = 4000       # body text decoded per message (preview + code scan)
+CODE_SCAN_MAX_CHARS = 4000       # only this much of a body is scanned for verification codes
+VIEW_STATE_CACHE_SIZE = 1000     # recent messages whose thread ID / code the buttons keep in memory
+
+# ---------- Discord dispatch ----------
+DISCORD_DM_RATE = 5              # DMs allowed per DISCORD_DM_PER seconds (DM channel route limit)
+DISCORD_DM_PER = 5.0
+DISPATCH_MAX_ATTEMPTS = 3        # sends per notification before giving up (429 / 5xx are retried)
+DISPATCH_RETRY_DELAY = 2         # seconds before retrying a DM that failed with 5xx, doubling (jittered)
+# Lower sends sooner; code-bearing mail is always 0 and everything else defaults to 50.
+# Senders match a full address or '@domain'; they win over labels.
+DISPATCH_SENDER_PRIORITIES = {}  # e.g. {'boss@example.com': 10, '@bank.example': 20}
+DISPATCH_LABEL_PRIORITIES = {
+    'IMPORTANT': 30,
+    'CATEGORY_UPDATES': 60,
+    'CATEGORY_SOCIAL': 70,
+    'CATEGORY_FORUMS': 70,
+    'CATEGORY_PROMOTIONS': 90,
+}
+DIGEST_THRESHOLD = 10            # notifications within DIGEST_WINDOW that switch to digest DMs
+DIGEST_WINDOW = 60               # seconds
+DIGEST_FLUSH_INTERVAL = 30       # seconds a digest collects emails before it is sent
+
+# ---------- Metrics ----------
+METRICS_HOST = '127.0.0.1'       # Prometheus scrape endpoint (/metrics); keep it local
+METRICS_PORT = 9108              # None disables the endpoint (/stats still works)
 
 # ---------- Admin User (for DMs) ----------
 ADMIN_USER_ID = 1399234194281861201  # Your Discord user ID
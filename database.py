@@ -1,188 +1,647 @@
-import pyodbc
 import logging
 import json
-from config import DATABASE
+import queue
+import time
+import asyncio
+import functools
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from config import (
+    DATABASE, DATABASE_BACKEND, SQLITE_PATH,
+    DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_HEALTH_CHECK_INTERVAL
+)
+from db_backends import get_backend
+from executors import MonitoredExecutor
 
 logger = logging.getLogger(__name__)
 
+_backend = get_backend(DATABASE_BACKEND, settings=DATABASE, sqlite_path=SQLITE_PATH)
+DBError = _backend.Error
+
 def get_connection():
     try:
-        conn = pyodbc.connect(
-            driver=DATABASE['driver'],
-            server=DATABASE['server'],
-            database=DATABASE['database'],
-            uid=DATABASE['uid'],
-            pwd=DATABASE['pwd'],
-            autocommit=False
-        )
-        return conn
-    except pyodbc.Error as e:
+        return _backend.connect()
+    except DBError as e:
         logger.error(f"Database connection failed: {e}")
         raise
 
+class _TrackedCursor:
+    """Cursor proxy that marks its connection failed when a statement raises."""
+
+    _GUARDED = {'execute', 'executemany', 'fetchone', 'fetchall', 'fetchmany'}
+
+    def __init__(self, cursor, conn):
+        object.__setattr__(self, '_cursor', cursor)
+        object.__setattr__(self, '_conn', conn)
+
+    def __getattr__(self, name):
+        attr = getattr(self._cursor, name)
+        if name not in self._GUARDED:
+            return attr
+
+        def guarded(*args, **kwargs):
+            result = self._conn.guard(attr, *args, **kwargs)
+            return self if result is self._cursor else result
+        return guarded
+
+    def __setattr__(self, name, value):
+        setattr(self._cursor, name, value)
+
+class _TrackedConnection:
+    """What connection() hands out: the pooled connection, remembering whether any call on it failed.
+
+    Callers catch DBError and roll back, so the pool cannot see the error;
+    this lets it drop the connection instead of reusing one that may be broken.
+    """
+
+    def __init__(self, conn):
+        self.raw = conn
+        self.failed = False
+
+    def guard(self, fn, *args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        except DBError:
+            self.failed = True
+            raise
+
+    def cursor(self):
+        return _TrackedCursor(self.guard(self.raw.cursor), self)
+
+    def commit(self):
+        self.guard(self.raw.commit)
+
+    def rollback(self):
+        self.guard(self.raw.rollback)
+
+class ConnectionPool:
+    """Bounded pool of database connections with idle health checks.
+
+    A connection on which any statement failed is closed on release rather
+    than returned to the pool.
+    """
+
+    def __init__(self, size: int, timeout: float, health_check_interval: float):
+        self.size = size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self._idle = queue.LifoQueue()  # (conn, last_used) – LIFO keeps hot connections warm
+        self._slots = threading.BoundedSemaphore(size)
+        self._closed = False
+
+    def acquire(self):
+        """Check out a connection, opening or replacing one as needed."""
+        if self._closed:
+            raise DBError("Connection pool is closed")
+        if not self._slots.acquire(timeout=self.timeout):
+            raise DBError(f"Timed out after {self.timeout}s waiting for a database connection")
+        try:
+            while True:
+                try:
+                    conn, last_used = self._idle.get_nowait()
+                except queue.Empty:
+                    return get_connection()
+                if time.monotonic() - last_used < self.health_check_interval or self._is_alive(conn):
+                    return conn
+                logger.info("Discarding stale database connection")
+                self._close_quietly(conn)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn, discard: bool = False):
+        """Return a connection to the pool (or drop it if it is suspect)."""
+        try:
+            if discard or self._closed:
+                self._close_quietly(conn)
+            else:
+                self._idle.put((conn, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        tracked = _TrackedConnection(conn)
+        discard = False
+        try:
+            yield tracked
+        except BaseException:
+            discard = True
+            raise
+        finally:
+            self.release(conn, discard=discard or tracked.failed)
+
+    def close(self):
+        """Close all idle connections; checked-out ones are closed on release."""
+        self._closed = True
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._close_quietly(conn)
+
+    @staticmethod
+    def _is_alive(conn) -> bool:
+        try:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("SELECT 1")
+                cursor.fetchone()
+            finally:
+                cursor.close()
+            return True
+        except DBError:
+            return False
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except DBError:
+            pass
+
+_pool = ConnectionPool(DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_HEALTH_CHECK_INTERVAL)
+# One thread per pooled connection so DB calls never queue on the default executor.
+_executor = MonitoredExecutor(DB_POOL_SIZE, 'gmail-db')
+
+async def run(func, *args, **kwargs):
+    """Run a blocking database function on the dedicated DB executor."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+def executor_stats() -> dict:
+    return _executor.stats()
+
+def close():
+    """Release pooled connections and stop the DB executor."""
+    _executor.shutdown(wait=True)
+    _pool.close()
+
 def init_db():
     """Create all Gmail bot tables."""
-    conn = get_connection()
-    cursor = conn.cursor()
-    try:
-        # ----- Handshake events (existing) -----
-        cursor.execute("""
-            IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='handshake_events' AND xtype='U')
-            CREATE TABLE handshake_events (
-                id INT IDENTITY(1,1) PRIMARY KEY,
-                event_type NVARCHAR(50) NOT NULL,
-                license_code NVARCHAR(50) NOT NULL,
-                details NVARCHAR(MAX),
-                created_at DATETIME DEFAULT GETDATE()
+    with _pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            for statement in _backend.schema():
+                cursor.execute(statement)
+                conn.commit()
+            _backend.upgrade(cursor)
+            conn.commit()
+
+            logger.info("✅ Gmail Bot database tables initialised.")
+        except DBError as e:
+            logger.error(f"Error creating tables: {e}")
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+# ---------- Handshake events (existing) ----------
+def log_event(event_type: str, license_code: str, details: str = None):
+    with _pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "INSERT INTO handshake_events (event_type, license_code, details) VALUES (?, ?, ?)",
+                (event_type, license_code, details)
             )
-        """)
-        conn.commit()
-
-        # ----- Gmail watch records -----
-        cursor.execute("""
-            IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='gmail_watch' AND xtype='U')
-            CREATE TABLE gmail_watch (
-                id INT IDENTITY(1,1) PRIMARY KEY,
-                expiration BIGINT NOT NULL,
-                history_id BIGINT NOT NULL,
-                created_at DATETIME DEFAULT GETDATE(),
-                renewed_at DATETIME
+            conn.commit()
+        except DBError as e:
+            logger.error(f"Failed to log event: {e}")
+            conn.rollback()
+        finally:
+            cursor.close()
+
+# ---------- Gmail watch (one row per mailbox) ----------
+def set_watch_record(email_address: str, expiration: int, history_id: int):
+    with _pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("DELETE FROM gmail_watch WHERE email_address = ?", (email_address,))
+            cursor.execute(
+                "INSERT INTO gmail_watch (email_address, expiration, history_id) VALUES (?, ?, ?)",
+                (email_address, expiration, history_id)
             )
-        """)
-        conn.commit()
-
-        # ----- Gmail event logs (notifications) -----
-        cursor.execute("""
-            IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='gmail_events' AND xtype='U')
-            CREATE TABLE gmail_events (
-                id INT IDENTITY(1,1) PRIMARY KEY,
-                message_id NVARCHAR(100) NOT NULL,
-                thread_id NVARCHAR(100) NOT NULL,
-                from_email NVARCHAR(255),
-                subject NVARCHAR(500),
-                snippet NVARCHAR(2000),
-                body_preview NVARCHAR(2000),
-                has_code BIT DEFAULT 0,
-                notified BIT DEFAULT 0,
-                deleted BIT DEFAULT 0,
-                received_at DATETIME DEFAULT GETDATE(),
-                notified_at DATETIME
+            conn.commit()
+        except DBError as e:
+            logger.error(f"Failed to set watch record: {e}")
+            conn.rollback()
+        finally:
+            cursor.close()
+
+def get_watch_record(email_address: str):
+    with _pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                _backend.select_first("expiration, history_id, created_at FROM gmail_watch WHERE email_address = ? ORDER BY id DESC"),
+                (email_address,)
             )
-        """)
-        conn.commit()
+            row = cursor.fetchone()
+            if row:
+                return (row[0], row[1], row[2])
+            return None
+        except DBError as e:
+            logger.error(f"Failed to get watch record: {e}")
+            return None
+        finally:
+            cursor.close()
 
-        logger.info("✅ Gmail Bot database tables initialised.")
-    except pyodbc.Error as e:
-        logger.error(f"Error creating tables: {e}")
-        conn.rollback()
-        raise
-    finally:
-        cursor.close()
-        conn.close()
+def get_watch_records():
+    """(email_address, expiration, history_id) for every mailbox with a watch."""
+    with _pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT email_address, expiration, history_id FROM gmail_watch WHERE email_address IS NOT NULL")
+            return [(row[0], row[1], row[2]) for row in cursor.fetchall()]
+        except DBError as e:
+            logger.error(f"Failed to get watch records: {e}")
+            return []
+        finally:
+            cursor.close()
 
-# ---------- Handshake events (existing) ----------
-def log_event(event_type: str, license_code: str, details: str = None):
-    conn = get_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute(
-            "INSERT INTO handshake_events (event_type, license_code, details) VALUES (?, ?, ?)",
-            (event_type, license_code, details)
-        )
-        conn.commit()
-    except pyodbc.Error as e:
-        logger.error(f"Failed to log event: {e}")
-        conn.rollback()
-    finally:
-        cursor.close()
-        conn.close()
-
-# ---------- Gmail watch ----------
-def set_watch_record(expiration: int, history_id: int):
-    conn = get_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("DELETE FROM gmail_watch")  # only one record
-        cursor.execute(
-            "INSERT INTO gmail_watch (expiration, history_id) VALUES (?, ?)",
-            (expiration, history_id)
-        )
-        conn.commit()
-    except pyodbc.Error as e:
-        logger.error(f"Failed to set watch record: {e}")
-        conn.rollback()
-    finally:
-        cursor.close()
-        conn.close()
-
-def get_watch_record():
-    conn = get_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("SELECT TOP 1 expiration, history_id, created_at FROM gmail_watch ORDER BY id DESC")
-        row = cursor.fetchone()
-        if row:
-            return (row.expiration, row.history_id, row.created_at)
-        return None
-    except pyodbc.Error as e:
-        logger.error(f"Failed to get watch record: {e}")
-        return None
-    finally:
-        cursor.close()
-        conn.close()
-
-def update_watch_renewal():
-    conn = get_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("UPDATE gmail_watch SET renewed_at = GETDATE()")
-        conn.commit()
-    except pyodbc.Error as e:
-        logger.error(f"Failed to update watch renewal: {e}")
-        conn.rollback()
-    finally:
-        cursor.close()
-        conn.close()
+def claim_legacy_watch(email_address: str):
+    """Assign the single-account watch row (and event rows) from before multi-mailbox support."""
+    with _pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT COUNT(*) FROM gmail_watch WHERE email_address = ?", (email_address,))
+            if cursor.fetchone()[0] == 0:
+                cursor.execute("UPDATE gmail_watch SET email_address = ? WHERE email_address IS NULL", (email_address,))
+            else:
+                cursor.execute("DELETE FROM gmail_watch WHERE email_address IS NULL")
+            cursor.execute("UPDATE gmail_events SET email_address = ? WHERE email_address IS NULL", (email_address,))
+            conn.commit()
+        except DBError as e:
+            logger.error(f"Failed to claim legacy watch record: {e}")
+            conn.rollback()
+        finally:
+            cursor.close()
+
+def update_history_id(email_address: str, history_id: int) -> bool:
+    """Move a mailbox's stored history cursor forward (compare-and-set, never backwards).
+
+    Returns True once the stored cursor is at or past history_id (moved now,
+    or already there: written with the watch record or by another worker);
+    False if there is no row or the update failed.
+    """
+    with _pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "UPDATE gmail_watch SET history_id = ? WHERE email_address = ? AND history_id < ?",
+                (history_id, email_address, history_id)
+            )
+            conn.commit()
+            if cursor.rowcount == 1:
+                return True
+            cursor.execute("SELECT history_id FROM gmail_watch WHERE email_address = ?", (email_address,))
+            row = cursor.fetchone()
+            return row is not None and row[0] >= history_id
+        except DBError as e:
+            logger.error(f"Failed to update history id: {e}")
+            conn.rollback()
+            return False
+        finally:
+            cursor.close()
+
+def update_watch_renewal(email_address: str):
+    with _pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("UPDATE gmail_watch SET renewed_at = ? WHERE email_address = ?", (datetime.now(), email_address))
+            conn.commit()
+        except DBError as e:
+            logger.error(f"Failed to update watch renewal: {e}")
+            conn.rollback()
+        finally:
+            cursor.close()
 
 # ---------- Gmail events ----------
-def log_gmail_event(message_id: str, thread_id: str, from_email: str, subject: str, snippet: str, body_preview: str, has_code: bool):
-    conn = get_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("""
-            INSERT INTO gmail_events (message_id, thread_id, from_email, subject, snippet, body_preview, has_code)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (message_id, thread_id, from_email, subject, snippet, body_preview, has_code))
-        conn.commit()
-    except pyodbc.Error as e:
-        logger.error(f"Failed to log gmail event: {e}")
-        conn.rollback()
-    finally:
-        cursor.close()
-        conn.close()
+def log_gmail_event(message_id: str, thread_id: str, from_email: str, subject: str, snippet: str, body_preview: str, has_code: bool, code: str = None, email_address: str = None):
+    with _pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(f"""
+                {_backend.insert_ignore} INTO gmail_events (message_id, thread_id, from_email, subject, snippet, body_preview, has_code, code, email_address)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (message_id, thread_id, from_email, subject, snippet, body_preview, has_code, code, email_address))
+            conn.commit()
+        except DBError as e:
+            logger.error(f"Failed to log gmail event: {e}")
+            conn.rollback()
+        finally:
+            cursor.close()
+
+def get_gmail_event(message_id: str):
+    """(thread_id, code, deleted, email_address) for a logged message, or None."""
+    with _pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT thread_id, code, deleted, email_address FROM gmail_events WHERE message_id = ?", (message_id,))
+            row = cursor.fetchone()
+            if row:
+                return (row[0], row[1], bool(row[2]), row[3])
+            return None
+        except DBError as e:
+            logger.error(f"Failed to get gmail event: {e}")
+            return None
+        finally:
+            cursor.close()
 
 def mark_notified(message_id: str):
-    conn = get_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("UPDATE gmail_events SET notified = 1, notified_at = GETDATE() WHERE message_id = ?", (message_id,))
-        conn.commit()
-    except pyodbc.Error as e:
-        logger.error(f"Failed to mark notified: {e}")
-        conn.rollback()
-    finally:
-        cursor.close()
-        conn.close()
+    with _pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("UPDATE gmail_events SET notified = 1, notified_at = ? WHERE message_id = ?", (datetime.now(), message_id))
+            conn.commit()
+        except DBError as e:
+            logger.error(f"Failed to mark notified: {e}")
+            conn.rollback()
+        finally:
+            cursor.close()
+
+def get_recent_notified_ids(limit: int):
+    """Most recently notified message IDs, newest first."""
+    with _pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(_backend.select_top("message_id FROM gmail_events WHERE notified = 1 ORDER BY id DESC", limit))
+            return [row[0] for row in cursor.fetchall()]
+        except DBError as e:
+            logger.error(f"Failed to get recent message ids: {e}")
+            return []
+        finally:
+            cursor.close()
+
+def get_notified_message_ids(message_ids):
+    """Return the subset of message_ids already notified (None on error)."""
+    message_ids = list(message_ids)
+    known = set()
+    with _pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            for i in range(0, len(message_ids), 500):
+                chunk = message_ids[i:i + 500]
+                placeholders = ', '.join('?' * len(chunk))
+                cursor.execute(f"SELECT message_id FROM gmail_events WHERE notified = 1 AND message_id IN ({placeholders})", chunk)
+                known.update(row[0] for row in cursor.fetchall())
+            return known
+        except DBError as e:
+            logger.error(f"Failed to look up message ids: {e}")
+            return None
+        finally:
+            cursor.close()
+
+def get_last_event_time(email_address: str):
+    """When the mailbox's newest gmail_events row was written, as epoch seconds (None if none)."""
+    with _pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                _backend.select_first("received_at FROM gmail_events WHERE email_address = ? ORDER BY id DESC"),
+                (email_address,)
+            )
+            row = cursor.fetchone()
+            if not row or row[0] is None:
+                return None
+            received_at = row[0]
+            if isinstance(received_at, str):  # SQLite returns DATETIME columns as text
+                received_at = datetime.fromisoformat(received_at)
+            return received_at.timestamp()
+        except (DBError, ValueError) as e:
+            logger.error(f"Failed to get last event time: {e}")
+            return None
+        finally:
+            cursor.close()
+
+def write_gmail_events(inserts, notified, deleted):
+    """Apply a batch of buffered gmail_events writes in a single transaction.
+
+    inserts:  (message_id, thread_id, from_email, subject, snippet, body_preview, has_code, code, notified, notified_at, email_address)
+    notified: (notified_at, message_id)
+    deleted:  message_id
+    """
+    with _pool.connection() as conn:
+        cursor = _backend.prepare_batch_cursor(conn.cursor())
+        try:
+            if inserts:
+                cursor.executemany(f"""
+                    {_backend.insert_ignore} INTO gmail_events (message_id, thread_id, from_email, subject, snippet, body_preview, has_code, code, notified, notified_at, email_address)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, inserts)
+            if notified:
+                cursor.executemany("UPDATE gmail_events SET notified = 1, notified_at = ? WHERE message_id = ?", notified)
+            if deleted:
+                cursor.executemany("UPDATE gmail_events SET deleted = 1 WHERE message_id = ?", [(m,) for m in deleted])
+            conn.commit()
+            return True
+        except DBError as e:
+            logger.error(f"Failed to write gmail events batch: {e}")
+            conn.rollback()
+            return False
+        finally:
+            cursor.close()
 
 def mark_deleted(message_id: str):
-    conn = get_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("UPDATE gmail_events SET deleted = 1 WHERE message_id = ?", (message_id,))
-        conn.commit()
-    except pyodbc.Error as e:
-        logger.error(f"Failed to mark deleted: {e}")
-        conn.rollback()
-    finally:
-        cursor.close()
-        conn.close()
\ No newline at end of file
+    with _pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("UPDATE gmail_events SET deleted = 1 WHERE message_id = ?", (message_id,))
+            conn.commit()
+        except DBError as e:
+            logger.error(f"Failed to mark deleted: {e}")
+            conn.rollback()
+        finally:
+            cursor.close()
+
+# ---------- Sharded workers (heartbeats and mailbox leases) ----------
+def heartbeat_worker(worker_id: str, now: float) -> bool:
+    """Record that a worker is alive (times are epoch seconds)."""
+    with _pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("UPDATE gmail_workers SET heartbeat_at = ? WHERE worker_id = ?", (now, worker_id))
+            if cursor.rowcount == 0:
+                cursor.execute("INSERT INTO gmail_workers (worker_id, heartbeat_at) VALUES (?, ?)", (worker_id, now))
+            conn.commit()
+            return True
+        except DBError as e:
+            logger.error(f"Failed to record worker heartbeat: {e}")
+            conn.rollback()
+            return False
+        finally:
+            cursor.close()
+
+def remove_worker(worker_id: str):
+    """Drop a worker's heartbeat and any leases it still holds (clean shutdown)."""
+    with _pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("DELETE FROM mailbox_leases WHERE worker_id = ?", (worker_id,))
+            cursor.execute("DELETE FROM gmail_workers WHERE worker_id = ?", (worker_id,))
+            conn.commit()
+        except DBError as e:
+            logger.error(f"Failed to remove worker: {e}")
+            conn.rollback()
+        finally:
+            cursor.close()
+
+def get_live_workers(since: float):
+    """IDs of workers with a heartbeat at or after since (None on error)."""
+    with _pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT worker_id FROM gmail_workers WHERE heartbeat_at >= ?", (since,))
+            return [row[0] for row in cursor.fetchall()]
+        except DBError as e:
+            logger.error(f"Failed to get live workers: {e}")
+            return None
+        finally:
+            cursor.close()
+
+def get_mailbox_leases():
+    """email_address -> (worker_id, expires_at) for every lease row (None on error)."""
+    with _pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT email_address, worker_id, expires_at FROM mailbox_leases")
+            return {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+        except DBError as e:
+            logger.error(f"Failed to get mailbox leases: {e}")
+            return None
+        finally:
+            cursor.close()
+
+def acquire_lease(email_address: str, worker_id: str, now: float, expires_at: float) -> bool:
+    """Take a mailbox's lease if it is free or expired; True if this worker now holds it."""
+    with _pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                f"{_backend.insert_ignore} INTO mailbox_leases (email_address, worker_id, expires_at) VALUES (?, ?, ?)",
+                (email_address, worker_id, expires_at)
+            )
+            if cursor.rowcount != 1:
+                # Row exists: only an expired (or our own) lease can be taken over
+                cursor.execute(
+                    "UPDATE mailbox_leases SET worker_id = ?, expires_at = ?, acquired_at = ? "
+                    "WHERE email_address = ? AND (expires_at < ? OR worker_id = ?)",
+                    (worker_id, expires_at, datetime.now(), email_address, now, worker_id)
+                )
+            acquired = cursor.rowcount == 1
+            conn.commit()
+            return acquired
+        except DBError as e:
+            logger.error(f"Failed to acquire lease for {email_address}: {e}")
+            conn.rollback()
+            return False
+        finally:
+            cursor.close()
+
+def renew_leases(worker_id: str, now: float, expires_at: float):
+    """Extend every unexpired lease a worker holds; returns the mailboxes it still owns (None on error)."""
+    with _pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "UPDATE mailbox_leases SET expires_at = ? WHERE worker_id = ? AND expires_at >= ?",
+                (expires_at, worker_id, now)
+            )
+            cursor.execute("SELECT email_address FROM mailbox_leases WHERE worker_id = ? AND expires_at >= ?", (worker_id, now))
+            owned = {row[0] for row in cursor.fetchall()}
+            conn.commit()
+            return owned
+        except DBError as e:
+            logger.error(f"Failed to renew leases: {e}")
+            conn.rollback()
+            return None
+        finally:
+            cursor.close()
+
+def release_lease(email_address: str, worker_id: str) -> bool:
+    with _pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("DELETE FROM mailbox_leases WHERE email_address = ? AND worker_id = ?", (email_address, worker_id))
+            conn.commit()
+            return True
+        except DBError as e:
+            logger.error(f"Failed to release lease for {email_address}: {e}")
+            conn.rollback()
+            return False
+        finally:
+            cursor.close()
+
+# ---------- Async API (runs on the DB executor) ----------
+async def init_db_async():
+    return await run(init_db)
+
+async def log_event_async(event_type: str, license_code: str, details: str = None):
+    return await run(log_event, event_type, license_code, details)
+
+async def set_watch_record_async(email_address: str, expiration: int, history_id: int):
+    return await run(set_watch_record, email_address, expiration, history_id)
+
+async def get_watch_record_async(email_address: str):
+    return await run(get_watch_record, email_address)
+
+async def get_watch_records_async():
+    return await run(get_watch_records)
+
+async def claim_legacy_watch_async(email_address: str):
+    return await run(claim_legacy_watch, email_address)
+
+async def update_history_id_async(email_address: str, history_id: int) -> bool:
+    return await run(update_history_id, email_address, history_id)
+
+async def update_watch_renewal_async(email_address: str):
+    return await run(update_watch_renewal, email_address)
+
+async def log_gmail_event_async(message_id: str, thread_id: str, from_email: str, subject: str, snippet: str, body_preview: str, has_code: bool, code: str = None, email_address: str = None):
+    return await run(log_gmail_event, message_id, thread_id, from_email, subject, snippet, body_preview, has_code, code, email_address)
+
+async def get_gmail_event_async(message_id: str):
+    return await run(get_gmail_event, message_id)
+
+async def mark_notified_async(message_id: str):
+    return await run(mark_notified, message_id)
+
+async def get_recent_notified_ids_async(limit: int):
+    return await run(get_recent_notified_ids, limit)
+
+async def get_notified_message_ids_async(message_ids):
+    return await run(get_notified_message_ids, message_ids)
+
+async def get_last_event_time_async(email_address: str):
+    return await run(get_last_event_time, email_address)
+
+async def write_gmail_events_async(inserts, notified, deleted):
+    return await run(write_gmail_events, inserts, notified, deleted)
+
+async def mark_deleted_async(message_id: str):
+    return await run(mark_deleted, message_id)
+
+async def heartbeat_worker_async(worker_id: str, now: float) -> bool:
+    return await run(heartbeat_worker, worker_id, now)
+
+async def remove_worker_async(worker_id: str):
+    return await run(remove_worker, worker_id)
+
+async def get_live_workers_async(since: float):
+    return await run(get_live_workers, since)
+
+async def get_mailbox_leases_async():
+    return await run(get_mailbox_leases)
+
+async def acquire_lease_async(email_address: str, worker_id: str, now: float, expires_at: float) -> bool:
+    return await run(acquire_lease, email_address, worker_id, now, expires_at)
+
+async def renew_leases_async(worker_id: str, now: float, expires_at: float):
+    return await run(renew_leases, worker_id, now, expires_at)
+
+async def release_lease_async(email_address: str, worker_id: str) -> bool:
+    return await run(release_lease, email_address, worker_id)
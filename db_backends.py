@@ -0,0 +1,283 @@
+import sqlite3
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+class StorageBackend:
+    """Connection factory and SQL dialect for one database engine.
+
+    database.py only issues qmark-style SQL that both engines accept; anything
+    engine-specific (DDL, row limiting, batch cursors) lives on the backend.
+    """
+    name = None
+    Error = Exception
+
+    def connect(self):
+        raise NotImplementedError
+
+    def schema(self):
+        """DDL statements creating every table if it does not exist."""
+        raise NotImplementedError
+
+    # INSERT keyword that silently skips rows violating a unique index
+    insert_ignore = 'INSERT'
+
+    def select_top(self, query: str, n: int) -> str:
+        """Turn 'cols FROM ... ORDER BY ...' into a SELECT of at most n rows."""
+        raise NotImplementedError
+
+    def select_first(self, query: str) -> str:
+        return self.select_top(query, 1)
+
+    def upgrade(self, cursor):
+        """Bring tables created by older versions up to the current schema."""
+
+    def prepare_batch_cursor(self, cursor):
+        """Tune a cursor before executemany()."""
+        return cursor
+
+class SqlServerBackend(StorageBackend):
+    """SQL Server over pyodbc."""
+    name = 'mssql'
+
+    def __init__(self, settings: dict):
+        import pyodbc  # only required when this backend is selected
+        self._pyodbc = pyodbc
+        self.Error = pyodbc.Error
+        self.settings = settings
+
+    def connect(self):
+        return self._pyodbc.connect(
+            driver=self.settings['driver'],
+            server=self.settings['server'],
+            database=self.settings['database'],
+            uid=self.settings['uid'],
+            pwd=self.settings['pwd'],
+            autocommit=False
+        )
+
+    def schema(self):
+        return [
+            # ----- Handshake events (existing) -----
+            """
+            IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='handshake_events' AND xtype='U')
+            CREATE TABLE handshake_events (
+                id INT IDENTITY(1,1) PRIMARY KEY,
+                event_type NVARCHAR(50) NOT NULL,
+                license_code NVARCHAR(50) NOT NULL,
+                details NVARCHAR(MAX),
+                created_at DATETIME DEFAULT GETDATE()
+            )
+            """,
+            # ----- Gmail watch records -----
+            """
+            IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='gmail_watch' AND xtype='U')
+            CREATE TABLE gmail_watch (
+                id INT IDENTITY(1,1) PRIMARY KEY,
+                email_address NVARCHAR(255),
+                expiration BIGINT NOT NULL,
+                history_id BIGINT NOT NULL,
+                created_at DATETIME DEFAULT GETDATE(),
+                renewed_at DATETIME
+            )
+            """,
+            # ----- Gmail event logs (notifications) -----
+            """
+            IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='gmail_events' AND xtype='U')
+            CREATE TABLE gmail_events (
+                id INT IDENTITY(1,1) PRIMARY KEY,
+                email_address NVARCHAR(255),
+                message_id NVARCHAR(100) NOT NULL,
+                thread_id NVARCHAR(100) NOT NULL,
+                from_email NVARCHAR(255),
+                subject NVARCHAR(500),
+                snippet NVARCHAR(2000),
+                body_preview NVARCHAR(2000),
+                has_code BIT DEFAULT 0,
+                code NVARCHAR(64),
+                notified BIT DEFAULT 0,
+                deleted BIT DEFAULT 0,
+                received_at DATETIME DEFAULT GETDATE(),
+                notified_at DATETIME
+            )
+            """,
+            # Older tables can hold a message more than once; keep its first row
+            # (notified if any copy was) so the unique index below can be built
+            """
+            IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='ux_gmail_events_message_id')
+            BEGIN
+                UPDATE e SET notified = 1 FROM gmail_events e
+                WHERE e.notified = 0 AND EXISTS (
+                    SELECT 1 FROM gmail_events d WHERE d.message_id = e.message_id AND d.notified = 1
+                );
+                DELETE FROM gmail_events
+                WHERE id NOT IN (SELECT MIN(id) FROM gmail_events GROUP BY message_id);
+            END
+            """,
+            # One row per Gmail message; IGNORE_DUP_KEY turns replayed inserts into no-ops
+            """
+            IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='ux_gmail_events_message_id')
+            CREATE UNIQUE INDEX ux_gmail_events_message_id ON gmail_events (message_id)
+            WITH (IGNORE_DUP_KEY = ON)
+            """,
+            # ----- Sharded workers: heartbeats and mailbox leases -----
+            """
+            IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='gmail_workers' AND xtype='U')
+            CREATE TABLE gmail_workers (
+                worker_id NVARCHAR(255) NOT NULL PRIMARY KEY,
+                heartbeat_at FLOAT NOT NULL,
+                started_at DATETIME DEFAULT GETDATE()
+            )
+            """,
+            """
+            IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='mailbox_leases' AND xtype='U')
+            CREATE TABLE mailbox_leases (
+                email_address NVARCHAR(255) NOT NULL,
+                worker_id NVARCHAR(255) NOT NULL,
+                expires_at FLOAT NOT NULL,
+                acquired_at DATETIME DEFAULT GETDATE(),
+                CONSTRAINT pk_mailbox_leases PRIMARY KEY (email_address) WITH (IGNORE_DUP_KEY = ON)
+            )
+            """,
+        ]
+
+    def upgrade(self, cursor):
+        cursor.execute("IF COL_LENGTH('gmail_events', 'code') IS NULL ALTER TABLE gmail_events ADD code NVARCHAR(64)")
+        # Multi-mailbox: rows written before this have email_address NULL (the primary account)
+        cursor.execute("IF COL_LENGTH('gmail_watch', 'email_address') IS NULL ALTER TABLE gmail_watch ADD email_address NVARCHAR(255)")
+        cursor.execute("IF COL_LENGTH('gmail_events', 'email_address') IS NULL ALTER TABLE gmail_events ADD email_address NVARCHAR(255)")
+        cursor.execute("""
+            IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='ix_gmail_watch_email_address')
+            CREATE INDEX ix_gmail_watch_email_address ON gmail_watch (email_address)
+        """)
+
+    def select_top(self, query: str, n: int) -> str:
+        return f"SELECT TOP {int(n)} {query}"
+
+    def prepare_batch_cursor(self, cursor):
+        cursor.fast_executemany = True
+        return cursor
+
+class SqliteBackend(StorageBackend):
+    """Embedded SQLite ledger in WAL mode (single-node deployments, local benchmarks)."""
+    name = 'sqlite'
+    Error = sqlite3.Error
+    insert_ignore = 'INSERT OR IGNORE'
+
+    def __init__(self, path: str, busy_timeout: float = 5.0):
+        self.path = path
+        self.busy_timeout = busy_timeout
+
+    def connect(self):
+        # Pooled connections hop between DB executor threads, never concurrently.
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def schema(self):
+        return [
+            # ----- Handshake events (existing) -----
+            """
+            CREATE TABLE IF NOT EXISTS handshake_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                event_type TEXT NOT NULL,
+                license_code TEXT NOT NULL,
+                details TEXT,
+                created_at DATETIME DEFAULT (datetime('now', 'localtime'))
+            )
+            """,
+            # ----- Gmail watch records -----
+            """
+            CREATE TABLE IF NOT EXISTS gmail_watch (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                email_address TEXT,
+                expiration INTEGER NOT NULL,
+                history_id INTEGER NOT NULL,
+                created_at DATETIME DEFAULT (datetime('now', 'localtime')),
+                renewed_at DATETIME
+            )
+            """,
+            # ----- Gmail event logs (notifications) -----
+            """
+            CREATE TABLE IF NOT EXISTS gmail_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                email_address TEXT,
+                message_id TEXT NOT NULL,
+                thread_id TEXT NOT NULL,
+                from_email TEXT,
+                subject TEXT,
+                snippet TEXT,
+                body_preview TEXT,
+                has_code INTEGER DEFAULT 0,
+                code TEXT,
+                notified INTEGER DEFAULT 0,
+                deleted INTEGER DEFAULT 0,
+                received_at DATETIME DEFAULT (datetime('now', 'localtime')),
+                notified_at DATETIME
+            )
+            """,
+            # Older tables can hold a message more than once; keep its first row
+            # (notified if any copy was) so the unique index below can be built
+            """
+            UPDATE gmail_events SET notified = 1
+            WHERE NOT EXISTS (SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'ux_gmail_events_message_id')
+              AND notified = 0 AND EXISTS (
+                  SELECT 1 FROM gmail_events d WHERE d.message_id = gmail_events.message_id AND d.notified = 1
+              )
+            """,
+            """
+            DELETE FROM gmail_events
+            WHERE NOT EXISTS (SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'ux_gmail_events_message_id')
+              AND id NOT IN (SELECT MIN(id) FROM gmail_events GROUP BY message_id)
+            """,
+            # One row per Gmail message
+            """
+            CREATE UNIQUE INDEX IF NOT EXISTS ux_gmail_events_message_id ON gmail_events (message_id)
+            """,
+            # ----- Sharded workers: heartbeats and mailbox leases -----
+            """
+            CREATE TABLE IF NOT EXISTS gmail_workers (
+                worker_id TEXT NOT NULL PRIMARY KEY,
+                heartbeat_at REAL NOT NULL,
+                started_at DATETIME DEFAULT (datetime('now', 'localtime'))
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS mailbox_leases (
+                email_address TEXT NOT NULL PRIMARY KEY,
+                worker_id TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                acquired_at DATETIME DEFAULT (datetime('now', 'localtime'))
+            )
+            """,
+        ]
+
+    def upgrade(self, cursor):
+        columns = {row[1] for row in cursor.execute("PRAGMA table_info(gmail_events)").fetchall()}
+        if 'code' not in columns:
+            cursor.execute("ALTER TABLE gmail_events ADD COLUMN code TEXT")
+        # Multi-mailbox: rows written before this have email_address NULL (the primary account)
+        if 'email_address' not in columns:
+            cursor.execute("ALTER TABLE gmail_events ADD COLUMN email_address TEXT")
+        columns = {row[1] for row in cursor.execute("PRAGMA table_info(gmail_watch)").fetchall()}
+        if 'email_address' not in columns:
+            cursor.execute("ALTER TABLE gmail_watch ADD COLUMN email_address TEXT")
+        # Mailboxes are keyed lower-case; SQLite compares text case-sensitively
+        cursor.execute("UPDATE gmail_watch SET email_address = LOWER(email_address) WHERE email_address <> LOWER(email_address)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS ix_gmail_watch_email_address ON gmail_watch (email_address)")
+
+    def select_top(self, query: str, n: int) -> str:
+        return f"SELECT {query} LIMIT {int(n)}"
+
+# Store datetimes the way datetime('now', 'localtime') does.
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(' ', timespec='seconds'))
+
+def get_backend(name: str, settings: dict = None, sqlite_path: str = None) -> StorageBackend:
+    """Build the backend selected in config.py."""
+    if name == 'mssql':
+        return SqlServerBackend(settings)
+    if name == 'sqlite':
+        return SqliteBackend(sqlite_path)
+    raise ValueError(f"Unknown database backend: {name!r}")
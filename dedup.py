@@ -0,0 +1,68 @@
+import logging
+from collections import OrderedDict
+
+from config import DEDUP_CACHE_SIZE, DEDUP_WARM_ROWS
+import database as db
+
+logger = logging.getLogger(__name__)
+
+class SeenMessages:
+    """Bounded LRU of Gmail message IDs that were already handled.
+
+    Pub/Sub and users.history.list both deliver at least once; this is the
+    fast path that drops replays before any Gmail fetch. gmail_events (unique
+    on message_id) stays the final arbiter for IDs the cache has forgotten.
+    """
+
+    def __init__(self, capacity: int = DEDUP_CACHE_SIZE):
+        self.capacity = capacity
+        self._ids = OrderedDict()
+        self.hits = 0
+        self.db_hits = 0
+
+    def __contains__(self, message_id) -> bool:
+        return message_id in self._ids
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def add(self, message_id: str):
+        self._ids[message_id] = None
+        self._ids.move_to_end(message_id)
+        while len(self._ids) > self.capacity:
+            self._ids.popitem(last=False)
+
+    def discard(self, message_id: str):
+        """Forget a claimed ID whose processing failed, so a redelivery retries it."""
+        self._ids.pop(message_id, None)
+
+    async def warm(self, limit: int = DEDUP_WARM_ROWS):
+        """Load the most recent ledger rows into the cache."""
+        ids = await db.get_recent_notified_ids_async(min(limit, self.capacity))
+        for message_id in reversed(ids):  # oldest first, so the newest end up most recent
+            self.add(message_id)
+        logger.info(f"Dedup cache warmed with {len(ids)} message IDs")
+
+    async def claim(self, message_ids):
+        """Return the IDs that are new, marking them seen.
+
+        IDs are claimed before the ledger lookup is awaited, so a concurrent
+        pass over the same history cannot claim them a second time.
+        """
+        fresh = []
+        for message_id in message_ids:
+            if message_id in self._ids:
+                self.hits += 1
+                self._ids.move_to_end(message_id)
+            elif message_id not in fresh:
+                fresh.append(message_id)
+        if not fresh:
+            return []
+        for message_id in fresh:
+            self.add(message_id)
+
+        known = await db.get_notified_message_ids_async(fresh)
+        if known:
+            self.db_hits += len(known)
+            fresh = [m for m in fresh if m not in known]
+        return fresh
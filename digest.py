@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import NamedTuple
+import discord
+
+from config import DIGEST_THRESHOLD, DIGEST_WINDOW, DIGEST_FLUSH_INTERVAL, EMOJIS, COLORS
+from dispatch_queue import PRIORITY_CODE
+from gmail_views import DigestView
+
+logger = logging.getLogger(__name__)
+
+DIGEST_MAX_ENTRIES = 25   # Discord's limit on options in one select menu
+LINE_MAX = 150            # per entry in the digest embed
+
+class DigestEntry(NamedTuple):
+    message_id: str
+    from_email: str
+    subject: str
+    priority: int
+
+class NotificationDigest:
+    """Groups notifications into digest DMs while mail arrives in bursts.
+
+    Once DIGEST_THRESHOLD notifications arrive within DIGEST_WINDOW seconds,
+    non-code mail is held and sent every DIGEST_FLUSH_INTERVAL seconds as
+    one embed per DIGEST_MAX_ENTRIES emails, with a select menu for the
+    per-email buttons. Below the threshold every email gets its own DM again.
+    Code-bearing mail is never held.
+    """
+
+    def __init__(self, dispatcher, on_done, threshold: int = DIGEST_THRESHOLD,
+                 window: float = DIGEST_WINDOW, flush_interval: float = DIGEST_FLUSH_INTERVAL):
+        self.dispatcher = dispatcher
+        self.on_done = on_done  # (message_id, ok), called for every entry in a digest
+        self.threshold = threshold
+        self.window = window
+        self.flush_interval = flush_interval
+        self._arrivals = deque()
+        self._pending = []
+        self._timer = None
+        self.digests_sent = 0
+        self.entries_digested = 0
+
+    @property
+    def active(self) -> bool:
+        cutoff = time.monotonic() - self.window
+        while self._arrivals and self._arrivals[0] < cutoff:
+            self._arrivals.popleft()
+        return len(self._arrivals) >= self.threshold
+
+    def offer(self, entry: DigestEntry) -> bool:
+        """Count the arrival; return True if the entry was taken into a digest."""
+        self._arrivals.append(time.monotonic())
+        if entry.priority == PRIORITY_CODE or not self.active:
+            return False
+
+        self._pending.append(entry)
+        if len(self._pending) >= DIGEST_MAX_ENTRIES:
+            self.flush()
+        elif self._timer is None or self._timer.done():
+            self._timer = asyncio.create_task(self._flush_later())
+        return True
+
+    def holds(self, message_id: str) -> bool:
+        """Whether the email is held for the next digest."""
+        return any(entry.message_id == message_id for entry in self._pending)
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        self.flush()
+
+    def flush(self):
+        """Queue everything held so far as digest DMs."""
+        pending, self._pending = self._pending, []
+        for i in range(0, len(pending), DIGEST_MAX_ENTRIES):
+            self._submit(pending[i:i + DIGEST_MAX_ENTRIES])
+
+    def _submit(self, entries):
+        def delivered(_, ok):
+            for entry in entries:
+                self.on_done(entry.message_id, ok)
+
+        embed = discord.Embed(
+            title=f"{EMOJIS['mail']} {len(entries)} New Emails",
+            description='\n'.join(_line(n, entry) for n, entry in enumerate(entries, 1)),
+            color=COLORS['gmail'],
+            timestamp=datetime.now(timezone.utc)
+        )
+        embed.set_footer(text="Pick an email below for reply / delete.")
+        view = DigestView([(e.message_id, e.from_email, e.subject) for e in entries])
+        self.dispatcher.submit(
+            min(e.priority for e in entries), f"digest:{entries[0].message_id}",
+            on_done=delivered, embed=embed, view=view
+        )
+        self.digests_sent += 1
+        self.entries_digested += len(entries)
+        logger.info(f"Queued digest of {len(entries)} notifications")
+
+    def stats(self) -> dict:
+        return {
+            'active': self.active,
+            'pending': len(self._pending),
+            'digests_sent': self.digests_sent,
+            'entries_digested': self.entries_digested,
+        }
+
+    async def close(self):
+        """Cancel the timer and queue whatever is still held."""
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        self.flush()
+
+def _line(n: int, entry: DigestEntry) -> str:
+    line = f"**{n}.** {entry.from_email} — {entry.subject}"
+    return line if len(line) <= LINE_MAX else line[:LINE_MAX - 3] + '...'
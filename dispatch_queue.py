@@ -0,0 +1,181 @@
+import asyncio
+import itertools
+import logging
+import random
+import time
+from collections import deque
+from email.utils import parseaddr
+import discord
+
+import metrics
+
+from config import (
+    DISCORD_DM_RATE, DISCORD_DM_PER, DISPATCH_MAX_ATTEMPTS, DISPATCH_RETRY_DELAY,
+    DISPATCH_SENDER_PRIORITIES, DISPATCH_LABEL_PRIORITIES
+)
+
+logger = logging.getLogger(__name__)
+
+# Lower is sooner
+PRIORITY_CODE = 0
+PRIORITY_DEFAULT = 50
+
+class _Outgoing:
+    __slots__ = ('message_id', 'kwargs', 'on_done', 'enqueued_at', 'attempts')
+
+    def __init__(self, message_id, kwargs, on_done):
+        self.message_id = message_id
+        self.kwargs = kwargs
+        self.on_done = on_done
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+class DiscordDispatcher:
+    """Prioritised outbound DM queue.
+
+    Code-bearing mail goes first, then configured senders/labels, then the
+    rest. A single sender drains the queue, paced by a token bucket sized to
+    the DM channel's rate limit so discord.py never has to back off.
+    """
+
+    def __init__(self, get_destination, rate: int = DISCORD_DM_RATE, per: float = DISCORD_DM_PER):
+        self.get_destination = get_destination  # async () -> discord.abc.Messageable
+        self.rate = rate
+        self.per = per
+        self._tokens = float(rate)
+        self._refilled_at = time.monotonic()
+        self._queue = asyncio.PriorityQueue()
+        self._seq = itertools.count()  # FIFO within a priority
+        self._task = None
+        self._retries = {}  # task -> _Outgoing waiting out a 5xx before going back in the queue
+        self.sent = 0
+        self.failed = 0
+        self.rate_limited = 0
+        self._waits = deque(maxlen=500)  # recent queue wait times (seconds)
+
+    @staticmethod
+    def priority_for(from_header: str, label_ids=(), has_code: bool = False) -> int:
+        if has_code:
+            return PRIORITY_CODE
+        address = parseaddr(from_header or '')[1].lower()
+        domain = address.rpartition('@')[2]
+        for key in (address, f"@{domain}"):
+            if key in DISPATCH_SENDER_PRIORITIES:
+                return DISPATCH_SENDER_PRIORITIES[key]
+        label_priorities = [DISPATCH_LABEL_PRIORITIES[l] for l in label_ids or () if l in DISPATCH_LABEL_PRIORITIES]
+        return min(label_priorities) if label_priorities else PRIORITY_DEFAULT
+
+    def submit(self, priority: int, message_id: str, on_done=None, **send_kwargs):
+        """Queue a DM; on_done(message_id, ok) is called once it is sent or given up."""
+        self._queue.put_nowait((priority, next(self._seq), _Outgoing(message_id, send_kwargs, on_done)))
+        self.start()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _take_token(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens + (now - self._refilled_at) * self.rate / self.per)
+            self._refilled_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) * self.per / self.rate)
+
+    async def _run(self):
+        while True:
+            priority, seq, item = await self._queue.get()
+            try:
+                await self._take_token()
+                item.attempts += 1
+                destination = await self.get_destination()
+                with metrics.timed('discord_send'):
+                    await destination.send(**item.kwargs)
+            except asyncio.CancelledError:
+                # close(): leave the item for it to report as undelivered
+                self._queue.put_nowait((priority, seq, item))
+                raise
+            except discord.HTTPException as e:
+                retry = item.attempts < DISPATCH_MAX_ATTEMPTS and (e.status == 429 or e.status >= 500)
+                if e.status == 429:
+                    self.rate_limited += 1
+                    self._tokens = 0  # our budget was too optimistic; wait a full refill
+                if retry:
+                    # A 429 already emptied the bucket; a 5xx gets Discord some time to recover
+                    delay = 0
+                    if e.status != 429:
+                        delay = DISPATCH_RETRY_DELAY * 2 ** (item.attempts - 1) * random.uniform(0.5, 1.0)
+                    logger.warning(f"DM for {item.message_id} failed ({e.status}), retrying in {delay:.1f}s")
+                    self._retry_later(priority, seq, item, delay)
+                    continue
+                self._finish(item, False, e)
+                continue
+            except Exception as e:
+                self._finish(item, False, e)
+                continue
+            self._finish(item, True)
+
+    def _retry_later(self, priority, seq, item, delay: float):
+        if not delay:
+            self._queue.put_nowait((priority, seq, item))
+            return
+        task = asyncio.create_task(self._requeue(priority, seq, item, delay))
+        self._retries[task] = item
+        task.add_done_callback(lambda t: self._retries.pop(t, None))
+
+    async def _requeue(self, priority, seq, item, delay: float):
+        await asyncio.sleep(delay)
+        self._queue.put_nowait((priority, seq, item))
+
+    def _finish(self, item, ok: bool, error=None):
+        wait = time.monotonic() - item.enqueued_at
+        self._waits.append(wait)
+        metrics.observe('dispatch_queue', wait)
+        metrics.inc('dms', status='sent' if ok else 'failed')
+        if ok:
+            self.sent += 1
+        else:
+            self.failed += 1
+            logger.error(f"Failed to DM notification for {item.message_id}: {error}")
+        if item.on_done:
+            try:
+                item.on_done(item.message_id, ok)
+            except Exception as e:
+                logger.error(f"Dispatch callback failed for {item.message_id}: {e}")
+
+    def stats(self) -> dict:
+        waits = sorted(self._waits)
+        return {
+            'queue_depth': self._queue.qsize(),
+            'retrying': len(self._retries),
+            'sent': self.sent,
+            'failed': self.failed,
+            'rate_limited': self.rate_limited,
+            'wait_p50': waits[len(waits) // 2] if waits else 0.0,
+            'wait_max': waits[-1] if waits else 0.0,
+        }
+
+    async def close(self, timeout: float = 10.0):
+        """Give queued DMs a moment to drain, then stop the sender and give up on the rest."""
+        deadline = time.monotonic() + timeout
+        while not self._queue.empty() or self._retries:
+            if time.monotonic() >= deadline or not self._task or self._task.done():
+                break
+            await asyncio.sleep(0.1)
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Whoever waits on these DMs hears they were not sent
+        undelivered = list(self._retries.values())
+        for task in list(self._retries):
+            task.cancel()
+        while not self._queue.empty():
+            undelivered.append(self._queue.get_nowait()[2])
+        for item in undelivered:
+            self._finish(item, False, 'shutting down')
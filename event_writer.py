@@ -0,0 +1,104 @@
+import asyncio
+import logging
+from datetime import datetime
+
+from config import EVENT_FLUSH_BATCH_SIZE, EVENT_FLUSH_INTERVAL
+import database as db
+import metrics
+
+logger = logging.getLogger(__name__)
+
+class EventWriteBuffer:
+    """Write-behind buffer for gmail_events.
+
+    Inserts and status updates are collected in memory and written in one
+    transaction per flush, triggered by batch size or by a timer.
+    """
+
+    def __init__(self, batch_size: int = EVENT_FLUSH_BATCH_SIZE, flush_interval: float = EVENT_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._inserts = {}   # message_id -> insert row (list, so notified can be folded in)
+        self._notified = {}  # message_id -> notified_at
+        self._deleted = set()
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+    @property
+    def pending(self) -> int:
+        return len(self._inserts) + len(self._notified) + len(self._deleted)
+
+    def log_gmail_event(self, message_id: str, thread_id: str, from_email: str, subject: str, snippet: str, body_preview: str, has_code: bool, code: str = None, email_address: str = None):
+        self._inserts[message_id] = [message_id, thread_id, from_email, subject, snippet, body_preview, has_code, code, False, None, email_address]
+        self._written()
+
+    def mark_notified(self, message_id: str):
+        now = datetime.now()
+        row = self._inserts.get(message_id)
+        if row is not None:
+            # Insert not flushed yet – write it as already notified.
+            row[8], row[9] = True, now
+        else:
+            self._notified[message_id] = now
+        self._written()
+
+    def mark_deleted(self, message_id: str):
+        self._deleted.add(message_id)
+        self._written()
+
+    def _written(self):
+        if self.pending >= self.batch_size:
+            self._wakeup.set()
+
+    def start(self):
+        """Start the background flush task."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing gmail events: {e}")
+
+    async def flush(self):
+        """Write everything buffered so far."""
+        async with self._flush_lock:
+            if not self.pending:
+                return
+            inserts, notified, deleted = self._inserts, self._notified, self._deleted
+            self._inserts, self._notified, self._deleted = {}, {}, set()
+
+            with metrics.timed('db_flush'):
+                ok = await db.write_gmail_events_async(
+                    [tuple(row) for row in inserts.values()],
+                    [(ts, message_id) for message_id, ts in notified.items()],
+                    list(deleted)
+                )
+            if ok:
+                logger.debug(f"Flushed {len(inserts)} inserts, {len(notified)} notified, {len(deleted)} deleted")
+                return
+
+            # Put the batch back (newer writes win) so the next flush retries it.
+            inserts.update(self._inserts)
+            notified.update(self._notified)
+            deleted.update(self._deleted)
+            self._inserts, self._notified, self._deleted = inserts, notified, deleted
+
+    async def close(self):
+        """Stop the flush task and write out anything still buffered."""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
@@ -0,0 +1,54 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+class MonitoredExecutor(ThreadPoolExecutor):
+    """ThreadPoolExecutor that keeps queue-depth and saturation counters."""
+
+    def __init__(self, max_workers: int, thread_name_prefix: str):
+        super().__init__(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self.name = thread_name_prefix
+        self.max_workers = max_workers
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.peak_queued = 0
+        self._lock = threading.Lock()
+
+    def submit(self, fn, /, *args, **kwargs):
+        with self._lock:
+            self.queued += 1
+            self.peak_queued = max(self.peak_queued, self.queued)
+        started = threading.Event()
+
+        def run():
+            with self._lock:
+                self.queued -= 1
+                self.active += 1
+            started.set()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.active -= 1
+                    self.completed += 1
+
+        def on_done(future):
+            # Cancelled before a worker picked it up: it never left the queue.
+            if not started.is_set():
+                with self._lock:
+                    self.queued -= 1
+
+        future = super().submit(run)
+        future.add_done_callback(on_done)
+        return future
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'workers': self.max_workers,
+                'active': self.active,
+                'queued': self.queued,
+                'peak_queued': self.peak_queued,
+                'completed': self.completed,
+                'saturation': self.active / self.max_workers,
+            }
@@ -97,7 +97,7 @@ class FetchPatch(commands.Cog):
 
         if patches_found > 0:
             # Log to database
-            db.log_event("patch_download", LICENSE_CODE, f"Downloaded {patches_found} patches: {', '.join(downloaded_files)}")
+            await db.log_event_async("patch_download", LICENSE_CODE, f"Downloaded {patches_found} patches: {', '.join(downloaded_files)}")
 
             embed = discord.Embed(
                 title=f"{EMOJIS['success']} Patches Downloaded",
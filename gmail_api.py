@@ -1,24 +1,221 @@
 import base64
 import re
 from email.utils import parsedate_to_datetime
+from email.message import EmailMessage
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from googleapiclient.http import BatchHttpRequest
 import logging
 import asyncio
+import threading
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
+
+from config import (
+    GMAIL_HISTORY_PAGE_SIZE, GMAIL_BATCH_SIZE,
+    GMAIL_EXECUTOR_WORKERS, GMAIL_HTTP_TIMEOUT, GMAIL_CLIENT,
+    BODY_TEXT_MAX_CHARS
+)
+from executors import MonitoredExecutor
+from gmail_quota import QuotaScheduler, GmailUnavailableError, QUOTA_COSTS, INTERACTIVE, error_status
+from mime_text import extract_text
+import metrics
 
 logger = logging.getLogger(__name__)
 
-class GmailAPI:
-    def __init__(self, credentials):
-        self.service = build('gmail', 'v1', credentials=credentials, cache_discovery=False)
+# Partial response for the notification pipeline: IDs, snippet, top-level headers
+# and the text part bodies. Attachment data is never inlined by messages.get.
+NOTIFICATION_FIELDS = (
+    'id,threadId,labelIds,snippet,internalDate,'
+    'payload(mimeType,headers,body/data,'
+    'parts(mimeType,body/data,parts(mimeType,body/data,parts(mimeType,body/data))))'
+)
+NOTIFICATION_HEADERS = ('From', 'Subject', 'Message-ID')
+REPLY_HEADERS = ('From', 'Subject', 'Message-ID', 'References')
+
+class HistoryExpiredError(Exception):
+    """startHistoryId is older than Gmail keeps history for (HTTP 404)."""
+
+class HistoryStream:
+    """Async iterator over message IDs added since a history ID.
+
+    Follows nextPageToken, fetching the next page while the current one is
+    being consumed, and yields every message ID only once. Once exhausted,
+    history_id is the mailbox history ID reported by the last page.
+    """
+
+    def __init__(self, fetch_page, start_history_id: int):
+        self._fetch_page = fetch_page  # async (start_history_id, page_token) -> response
+        self.start_history_id = start_history_id
+        self.history_id = None
+        self.page_count = 0
+        self.complete = False
+        self._seen = set()
+
+    async def pages(self):
+        """Yield the new message IDs of each page as it arrives."""
+        next_page = asyncio.ensure_future(self._fetch_page(self.start_history_id, None))
+        try:
+            while next_page is not None:
+                response = await next_page
+                token = response.get('nextPageToken')
+                next_page = asyncio.ensure_future(self._fetch_page(self.start_history_id, token)) if token else None
+
+                self.page_count += 1
+                if 'historyId' in response:
+                    self.history_id = int(response['historyId'])
+                ids = []
+                for hist in response.get('history', []):
+                    for msg_added in hist.get('messagesAdded', []):
+                        msg = msg_added.get('message')
+                        if msg and msg['id'] not in self._seen:
+                            self._seen.add(msg['id'])
+                            ids.append(msg['id'])
+                if ids:
+                    yield ids
+            self.complete = True
+        finally:
+            if next_page is not None and not next_page.done():
+                next_page.cancel()
+
+    async def __aiter__(self):
+        async for ids in self.pages():
+            for message_id in ids:
+                yield message_id
+
+class GmailAPIBase:
+    """Transport-independent parts shared by the Gmail clients."""
+
+    def stream_history(self, start_history_id: int) -> HistoryStream:
+        """Stream added message IDs since start_history_id across all pages."""
+        async def fetch_page(*args, **kwargs):
+            with metrics.timed('history_list'):
+                return await self.list_history_page(*args, **kwargs)
+        return HistoryStream(fetch_page, start_history_id)
+
+    async def search_message_ids(self, query: str, limit: int):
+        """Yield pages of message IDs matching a Gmail search (newest first), at most limit in all."""
+        token = None
+        remaining = limit
+        while remaining > 0:
+            with metrics.timed('messages_list'):
+                response = await self.list_messages_page(query, token, min(remaining, GMAIL_HISTORY_PAGE_SIZE))
+            ids = [m['id'] for m in response.get('messages', [])][:remaining]
+            if ids:
+                yield ids
+            remaining -= len(ids)
+            token = response.get('nextPageToken')
+            if not token or not ids:
+                return
+
+    @staticmethod
+    def trim_headers(msg, names=NOTIFICATION_HEADERS):
+        """Drop every top-level header the pipeline does not use."""
+        payload = msg.get('payload', {})
+        if 'headers' in payload:
+            wanted = {n.lower() for n in names}
+            payload['headers'] = [h for h in payload['headers'] if h['name'].lower() in wanted]
+        return msg
+
+    @staticmethod
+    def build_reply(thread_id: str, message_id: str, headers, reply_text: str) -> dict:
+        """Build the messages.send body for a threaded reply to the given headers."""
+        headers = {h['name'].lower(): h['value'] for h in headers}
+        to = headers.get('from')
+        subject = headers.get('subject', '')
+        if not subject.startswith('Re:'):
+            subject = f"Re: {subject}"
+        # Thread on the RFC 822 Message-ID; fall back to the Gmail ID as before
+        rfc_message_id = headers.get('message-id', message_id)
+        references = f"{headers['references']} {rfc_message_id}" if headers.get('references') else rfc_message_id
+
+        # Create reply message
+        mime_message = EmailMessage()
+        mime_message.set_content(reply_text)
+        mime_message['To'] = to
+        mime_message['Subject'] = subject
+        mime_message['In-Reply-To'] = rfc_message_id
+        mime_message['References'] = references
+
+        encoded_message = base64.urlsafe_b64encode(mime_message.as_bytes()).decode()
+
+        body = {
+            'raw': encoded_message,
+            'threadId': thread_id
+        }
+        return body
+
+    async def close(self):
+        """Release this mailbox's client resources (none; shared ones go in close_shared_clients)."""
+
+    def extract_body_text(self, msg, max_chars: int = BODY_TEXT_MAX_CHARS):
+        """Extract body text (plain, else stripped HTML), bounded to max_chars."""
+        if 'payload' not in msg:
+            return ''
+        return extract_text(msg['payload'], max_chars)
+
+# Shared by every GmailAPI instance (every mailbox); each worker thread owns one
+# keep-alive transport, which the mailboxes' AuthorizedHttp wrappers share.
+gmail_executor = MonitoredExecutor(GMAIL_EXECUTOR_WORKERS, 'gmail-http')
+_thread_transport = threading.local()
+_services = {}  # api_endpoint -> discovery-built service
+
+def _transport():
+    """The calling thread's raw keep-alive transport (httplib2 is not thread-safe)."""
+    http = getattr(_thread_transport, 'http', None)
+    if http is None:
+        http = _thread_transport.http = httplib2.Http(timeout=GMAIL_HTTP_TIMEOUT)
+    return http
+
+def _service(api_endpoint: str = None):
+    """Request builder shared by all mailboxes; requests always run with a mailbox's own http."""
+    service = _services.get(api_endpoint)
+    if service is None:
+        # api_endpoint overrides https://gmail.googleapis.com (e.g. a local fake for benchmarks)
+        client_options = {'api_endpoint': api_endpoint} if api_endpoint else None
+        service = _services[api_endpoint] = build(
+            'gmail', 'v1', http=httplib2.Http(), cache_discovery=False, client_options=client_options
+        )
+    return service
+
+class GmailAPI(GmailAPIBase):
+    def __init__(self, credentials, api_endpoint: str = None):
+        self.credentials = credentials
+        self.service = _service(api_endpoint)
+        # The batch URI comes from the discovery document, not client_options
+        self._batch_uri = f"{api_endpoint.rstrip('/')}/batch/gmail/v1" if api_endpoint else None
+        self.executor = gmail_executor
+        self._local = threading.local()
+        # Timeouts and connection resets (httplib2 raises OSError subclasses for both)
+        self.quota = QuotaScheduler(transient=(OSError, httplib2.HttpLib2Error))
+
+    def _http(self):
+        """This mailbox's credentials on the calling thread's shared transport."""
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = self._local.http = AuthorizedHttp(self.credentials, http=_transport())
+        return http
+
+    async def _execute(self, operation: str, request, level: int = None):
+        """Run a googleapiclient request on the Gmail executor with this thread's transport.
+
+        Goes through the mailbox's quota scheduler, which charges the
+        operation's quota units and retries transient errors.
+        """
+        loop = asyncio.get_running_loop()
+        return await self.quota.call(
+            operation, lambda: loop.run_in_executor(self.executor, lambda: request.execute(http=self._http())), level
+        )
+
+    def executor_stats(self) -> dict:
+        return self.executor.stats()
 
     async def get_user_profile(self):
         """Get user's email address."""
-        loop = asyncio.get_event_loop()
         try:
-            profile = await loop.run_in_executor(None, self.service.users().getProfile(userId='me').execute)
+            profile = await self._execute('getProfile', self.service.users().getProfile(userId='me'))
             return profile
-        except HttpError as e:
+        except (HttpError, GmailUnavailableError) as e:
             logger.error(f"Failed to get profile: {e}")
             return None
 
@@ -28,102 +225,191 @@ class GmailAPI:
             'labelIds': ['INBOX'],
             'topicName': topic_name
         }
-        loop = asyncio.get_event_loop()
         try:
-            response = await loop.run_in_executor(None, self.service.users().watch(userId='me', body=body).execute)
+            response = await self._execute('watch', self.service.users().watch(userId='me', body=body))
             return response
-        except HttpError as e:
+        except (HttpError, GmailUnavailableError) as e:
             logger.error(f"Failed to start watch: {e}")
             return None
 
     async def stop_watch(self):
         """Stop watching (cleanup)."""
-        loop = asyncio.get_event_loop()
         try:
-            await loop.run_in_executor(None, self.service.users().stop(userId='me').execute)
-        except HttpError as e:
+            await self._execute('stop', self.service.users().stop(userId='me'))
+        except (HttpError, GmailUnavailableError) as e:
             logger.error(f"Failed to stop watch: {e}")
 
+    async def list_history_page(self, start_history_id: int, page_token: str = None):
+        """Fetch one page of messageAdded history records."""
+        request = self.service.users().history().list(
+            userId='me',
+            startHistoryId=start_history_id,
+            historyTypes=['messageAdded'],
+            maxResults=GMAIL_HISTORY_PAGE_SIZE,
+            pageToken=page_token
+        )
+        try:
+            return await self._execute('history.list', request)
+        except HttpError as e:
+            if e.resp.status == 404:
+                raise HistoryExpiredError(f"History {start_history_id} is no longer available") from e
+            raise
+
+    async def list_messages_page(self, query: str, page_token: str = None, max_results: int = GMAIL_HISTORY_PAGE_SIZE):
+        """Fetch one page of message IDs matching a search query (raises HttpError)."""
+        request = self.service.users().messages().list(
+            userId='me',
+            q=query,
+            maxResults=max_results,
+            pageToken=page_token,
+            fields='messages/id,nextPageToken'
+        )
+        return await self._execute('messages.list', request)
+
     async def get_message(self, message_id: str):
         """Fetch full message by ID."""
-        loop = asyncio.get_event_loop()
         try:
-            msg = await loop.run_in_executor(None, self.service.users().messages().get(userId='me', id=message_id, format='full').execute)
+            msg = await self._execute('messages.get', self.service.users().messages().get(userId='me', id=message_id, format='full'))
             return msg
-        except HttpError as e:
+        except (HttpError, GmailUnavailableError) as e:
             logger.error(f"Failed to get message {message_id}: {e}")
             return None
 
+    async def fetch_message(self, message_id: str, raise_errors: bool = False):
+        """Fetch everything the notification pipeline needs in one trimmed request.
+
+        Returns None on error, or raises it with raise_errors.
+        """
+        request = self.service.users().messages().get(
+            userId='me', id=message_id, format='full', fields=NOTIFICATION_FIELDS
+        )
+        try:
+            msg = await self._execute('messages.get', request)
+            return self.trim_headers(msg)
+        except (HttpError, GmailUnavailableError) as e:
+            if raise_errors:
+                raise
+            logger.error(f"Failed to fetch message {message_id}: {e}")
+            return None
+
     async def get_message_metadata(self, message_id: str):
         """Fetch only metadata to extract from, subject, snippet."""
-        loop = asyncio.get_event_loop()
         try:
-            msg = await loop.run_in_executor(None, self.service.users().messages().get(userId='me', id=message_id, format='metadata').execute)
+            msg = await self._execute('messages.get', self.service.users().messages().get(userId='me', id=message_id, format='metadata'))
             return msg
-        except HttpError as e:
+        except (HttpError, GmailUnavailableError) as e:
             logger.error(f"Failed to get message metadata {message_id}: {e}")
             return None
 
+    async def get_messages_batch(self, message_ids, format: str = 'full', fields: str = None):
+        """Fetch many messages via the batch endpoint.
+
+        Yields (message_id, message, error) tuples as each batch request of up
+        to GMAIL_BATCH_SIZE calls completes; exactly one of message/error is set.
+        """
+        message_ids = list(message_ids)
+        chunks = [message_ids[i:i + GMAIL_BATCH_SIZE] for i in range(0, len(message_ids), GMAIL_BATCH_SIZE)]
+        futures = [asyncio.ensure_future(self._fetch_batch(chunk, format, fields)) for chunk in chunks]
+        try:
+            for future in asyncio.as_completed(futures):
+                for item in await future:
+                    yield item
+        finally:
+            for future in futures:
+                future.cancel()
+
+    async def _fetch_batch(self, message_ids, format, fields):
+        """One batch request under quota (every messages.get in it is charged).
+
+        The quota scheduler retries the batch as a whole; calls inside it
+        that fail transiently (typically 429) are retried in a smaller batch.
+        """
+        loop = asyncio.get_running_loop()
+        results = []
+        for attempt in range(self.quota.retry_attempts + 1):
+            ids = message_ids
+            try:
+                items = await self.quota.call(
+                    'messages.get',
+                    lambda: loop.run_in_executor(self.executor, self._execute_batch, ids, format, fields),
+                    units=QUOTA_COSTS['messages.get'] * len(ids)
+                )
+            except (HttpError, GmailUnavailableError, OSError, httplib2.HttpLib2Error) as e:
+                # OSError covers socket timeouts and resets; each message is retried on its own
+                logger.error(f"Batch request for {len(ids)} messages failed: {e}")
+                results.extend((message_id, None, e) for message_id in ids)
+                return results
+            message_ids = []
+            for message_id, msg, error in items:
+                if error is not None and attempt < self.quota.retry_attempts and self.quota.retryable(error):
+                    message_ids.append(message_id)
+                else:
+                    results.append((message_id, msg, error))
+            if not message_ids:
+                break
+            if any(error_status(error) == 429 for _, _, error in items):
+                self.quota.throttle()
+            await asyncio.sleep(self.quota.backoff(attempt + 1))
+        return results
+
+    def _execute_batch(self, message_ids, format, fields):
+        """Run one batch request (blocking) and collect per-message results (raises HttpError)."""
+        results = []
+
+        def on_response(request_id, response, exception):
+            results.append((request_id, response, exception))
+
+        if self._batch_uri:
+            batch = BatchHttpRequest(callback=on_response, batch_uri=self._batch_uri)
+        else:
+            batch = self.service.new_batch_http_request(callback=on_response)
+        messages = self.service.users().messages()
+        for message_id in message_ids:
+            kwargs = {'userId': 'me', 'id': message_id, 'format': format}
+            if fields:
+                kwargs['fields'] = fields
+            batch.add(messages.get(**kwargs), request_id=message_id)
+        batch.execute(http=self._http())
+        return results
+
     async def delete_message(self, message_id: str):
         """Delete a message permanently."""
-        loop = asyncio.get_event_loop()
         try:
-            await loop.run_in_executor(None, self.service.users().messages().delete(userId='me', id=message_id).execute)
+            await self._execute('messages.delete', self.service.users().messages().delete(userId='me', id=message_id), INTERACTIVE)
             return True
-        except HttpError as e:
+        except (HttpError, GmailUnavailableError) as e:
             logger.error(f"Failed to delete message {message_id}: {e}")
             return False
 
     async def send_reply(self, thread_id: str, message_id: str, reply_text: str):
         """Send a reply in the same thread."""
-        # First get the original message to extract headers
-        original = await self.get_message(message_id)
-        if not original:
+        # First get the original message's headers (metadata only, no body)
+        request = self.service.users().messages().get(
+            userId='me', id=message_id, format='metadata',
+            metadataHeaders=list(REPLY_HEADERS), fields='payload/headers'
+        )
+        try:
+            original = await self._execute('messages.get', request, INTERACTIVE)
+        except (HttpError, GmailUnavailableError) as e:
+            logger.error(f"Failed to get message headers {message_id}: {e}")
             return False
-        # Extract headers
-        headers = {h['name']: h['value'] for h in original['payload']['headers']}
-        to = headers.get('From')
-        subject = headers.get('Subject', '')
-        if not subject.startswith('Re:'):
-            subject = f"Re: {subject}"
-
-        # Create reply message
-        from email.message import EmailMessage
-        import base64
-
-        mime_message = EmailMessage()
-        mime_message.set_content(reply_text)
-        mime_message['To'] = to
-        mime_message['Subject'] = subject
-        mime_message['In-Reply-To'] = message_id
-        mime_message['References'] = message_id
-
-        encoded_message = base64.urlsafe_b64encode(mime_message.as_bytes()).decode()
-
-        body = {
-            'raw': encoded_message,
-            'threadId': thread_id
-        }
-        loop = asyncio.get_event_loop()
+        body = self.build_reply(thread_id, message_id, original['payload']['headers'], reply_text)
         try:
-            await loop.run_in_executor(None, self.service.users().messages().send(userId='me', body=body).execute)
+            await self._execute('messages.send', self.service.users().messages().send(userId='me', body=body), INTERACTIVE)
             return True
-        except HttpError as e:
+        except (HttpError, GmailUnavailableError) as e:
             logger.error(f"Failed to send reply: {e}")
             return False
 
-    def extract_body_text(self, msg):
-        """Extract plain text body from message payload."""
-        parts = []
-        if 'payload' in msg:
-            self._extract_parts(msg['payload'], parts)
-        return '\n'.join(parts)
-
-    def _extract_parts(self, payload, parts):
-        if payload.get('mimeType') == 'text/plain' and 'data' in payload.get('body', {}):
-            data = payload['body']['data']
-            text = base64.urlsafe_b64decode(data).decode('utf-8', errors='ignore')
-            parts.append(text)
-        elif 'parts' in payload:
-            for part in payload['parts']:
-                self._extract_parts(part, parts)
\ No newline at end of file
+def create_gmail_api(credentials):
+    """Build the Gmail client selected by GMAIL_CLIENT in config.py."""
+    if GMAIL_CLIENT == 'async':
+        from gmail_api_async import AsyncGmailAPI  # needs httpx
+        return AsyncGmailAPI(credentials)
+    return GmailAPI(credentials)
+
+async def close_shared_clients():
+    """Close the connection pool every mailbox's client shares (once, at shutdown)."""
+    if GMAIL_CLIENT == 'async':
+        from gmail_api_async import close_http_client
+        await close_http_client()
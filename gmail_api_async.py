@@ -0,0 +1,239 @@
+import asyncio
+import logging
+import httpx
+from google.auth.transport.requests import Request
+
+from config import (
+    GMAIL_HISTORY_PAGE_SIZE, GMAIL_HTTP_TIMEOUT,
+    GMAIL_ASYNC_MAX_CONNECTIONS, GMAIL_ASYNC_MAX_CONCURRENCY
+)
+from gmail_api import (
+    GmailAPIBase, HistoryExpiredError,
+    NOTIFICATION_FIELDS, REPLY_HEADERS
+)
+from gmail_quota import QuotaScheduler, GmailUnavailableError, INTERACTIVE
+
+logger = logging.getLogger(__name__)
+
+GMAIL_BASE_URL = 'https://gmail.googleapis.com/gmail/v1/users/me'
+
+try:
+    import h2  # noqa: F401  (optional, enables HTTP/2 multiplexing)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+_client = None
+
+def get_http_client() -> httpx.AsyncClient:
+    """Process-wide pooled HTTP client shared by every AsyncGmailAPI."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            timeout=GMAIL_HTTP_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=GMAIL_ASYNC_MAX_CONNECTIONS,
+                max_keepalive_connections=GMAIL_ASYNC_MAX_CONNECTIONS
+            )
+        )
+    return _client
+
+async def close_http_client():
+    """Close the shared HTTP client (at shutdown, once every mailbox is done with it)."""
+    global _client
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+    _client = None
+
+class GmailHTTPError(Exception):
+    """Non-2xx response from the Gmail REST API."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(f"HTTP {status}: {message}")
+        self.status = status
+
+class AsyncGmailAPI(GmailAPIBase):
+    """Gmail client on a native asyncio HTTP client (same interface as GmailAPI)."""
+
+    def __init__(self, credentials, base_url: str = GMAIL_BASE_URL, client: httpx.AsyncClient = None):
+        self.credentials = credentials
+        self.base_url = base_url.rstrip('/')
+        self.client = client or get_http_client()
+        self.in_flight = 0
+        self._limit = asyncio.Semaphore(GMAIL_ASYNC_MAX_CONCURRENCY)
+        self._refresh_lock = asyncio.Lock()
+        self.quota = QuotaScheduler(transient=(httpx.TransportError,))
+
+    async def _refresh(self, force: bool = False):
+        async with self._refresh_lock:
+            if force or not self.credentials.valid:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, self.credentials.refresh, Request())
+
+    async def _request(self, operation: str, method: str, path: str, params: dict = None, json: dict = None,
+                       level: int = None):
+        """Issue one authorized request through the quota scheduler and return the decoded JSON body."""
+        return await self.quota.call(operation, lambda: self._send(method, path, params, json), level)
+
+    async def _send(self, method: str, path: str, params: dict = None, json: dict = None):
+        if not self.credentials.valid:
+            await self._refresh()
+        params = {k: v for k, v in (params or {}).items() if v is not None}
+        async with self._limit:
+            self.in_flight += 1
+            try:
+                for attempt in range(2):
+                    response = await self.client.request(
+                        method, f"{self.base_url}{path}", params=params, json=json,
+                        headers={'Authorization': f"Bearer {self.credentials.token}"}
+                    )
+                    if response.status_code == 401 and attempt == 0:
+                        await self._refresh(force=True)
+                        continue
+                    break
+            finally:
+                self.in_flight -= 1
+        if response.status_code >= 400:
+            raise GmailHTTPError(response.status_code, response.text[:500])
+        if not response.content:
+            return {}
+        return response.json()
+
+    def executor_stats(self) -> dict:
+        return {
+            'workers': GMAIL_ASYNC_MAX_CONCURRENCY,
+            'active': self.in_flight,
+            'queued': 0,
+            'saturation': self.in_flight / GMAIL_ASYNC_MAX_CONCURRENCY,
+        }
+
+    async def get_user_profile(self):
+        """Get user's email address."""
+        try:
+            return await self._request('getProfile', 'GET', '/profile')
+        except (GmailHTTPError, httpx.HTTPError, GmailUnavailableError) as e:
+            logger.error(f"Failed to get profile: {e}")
+            return None
+
+    async def start_watch(self, topic_name: str):
+        """Start watching for changes."""
+        body = {
+            'labelIds': ['INBOX'],
+            'topicName': topic_name
+        }
+        try:
+            return await self._request('watch', 'POST', '/watch', json=body)
+        except (GmailHTTPError, httpx.HTTPError, GmailUnavailableError) as e:
+            logger.error(f"Failed to start watch: {e}")
+            return None
+
+    async def stop_watch(self):
+        """Stop watching (cleanup)."""
+        try:
+            await self._request('stop', 'POST', '/stop')
+        except (GmailHTTPError, httpx.HTTPError, GmailUnavailableError) as e:
+            logger.error(f"Failed to stop watch: {e}")
+
+    async def list_history_page(self, start_history_id: int, page_token: str = None):
+        """Fetch one page of messageAdded history records."""
+        try:
+            return await self._request('history.list', 'GET', '/history', params={
+                'startHistoryId': start_history_id,
+                'historyTypes': ['messageAdded'],
+                'maxResults': GMAIL_HISTORY_PAGE_SIZE,
+                'pageToken': page_token
+            })
+        except GmailHTTPError as e:
+            if e.status == 404:
+                raise HistoryExpiredError(f"History {start_history_id} is no longer available") from e
+            raise
+
+    async def list_messages_page(self, query: str, page_token: str = None, max_results: int = GMAIL_HISTORY_PAGE_SIZE):
+        """Fetch one page of message IDs matching a search query (raises GmailHTTPError)."""
+        return await self._request('messages.list', 'GET', '/messages', params={
+            'q': query,
+            'maxResults': max_results,
+            'pageToken': page_token,
+            'fields': 'messages/id,nextPageToken'
+        })
+
+    async def get_message(self, message_id: str):
+        """Fetch full message by ID."""
+        try:
+            return await self._request('messages.get', 'GET', f'/messages/{message_id}', params={'format': 'full'})
+        except (GmailHTTPError, httpx.HTTPError, GmailUnavailableError) as e:
+            logger.error(f"Failed to get message {message_id}: {e}")
+            return None
+
+    async def fetch_message(self, message_id: str, raise_errors: bool = False):
+        """Fetch everything the notification pipeline needs in one trimmed request.
+
+        Returns None on error, or raises it with raise_errors.
+        """
+        try:
+            msg = await self._request('messages.get', 'GET', f'/messages/{message_id}', params={
+                'format': 'full', 'fields': NOTIFICATION_FIELDS
+            })
+            return self.trim_headers(msg)
+        except (GmailHTTPError, httpx.HTTPError, GmailUnavailableError) as e:
+            if raise_errors:
+                raise
+            logger.error(f"Failed to fetch message {message_id}: {e}")
+            return None
+
+    async def get_message_metadata(self, message_id: str):
+        """Fetch only metadata to extract from, subject, snippet."""
+        try:
+            return await self._request('messages.get', 'GET', f'/messages/{message_id}', params={'format': 'metadata'})
+        except (GmailHTTPError, httpx.HTTPError, GmailUnavailableError) as e:
+            logger.error(f"Failed to get message metadata {message_id}: {e}")
+            return None
+
+    async def get_messages_batch(self, message_ids, format: str = 'full', fields: str = None):
+        """Fetch many messages concurrently over the shared connection pool.
+
+        Same contract as GmailAPI.get_messages_batch: yields (message_id,
+        message, error) as results arrive. With HTTP/2 the requests are
+        multiplexed, so no multipart batch envelope is needed.
+        """
+        async def fetch(message_id):
+            try:
+                msg = await self._request('messages.get', 'GET', f'/messages/{message_id}', params={'format': format, 'fields': fields})
+                return message_id, msg, None
+            except (GmailHTTPError, httpx.HTTPError, GmailUnavailableError) as e:
+                return message_id, None, e
+
+        tasks = [asyncio.ensure_future(fetch(message_id)) for message_id in message_ids]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def delete_message(self, message_id: str):
+        """Delete a message permanently."""
+        try:
+            await self._request('messages.delete', 'DELETE', f'/messages/{message_id}', level=INTERACTIVE)
+            return True
+        except (GmailHTTPError, httpx.HTTPError, GmailUnavailableError) as e:
+            logger.error(f"Failed to delete message {message_id}: {e}")
+            return False
+
+    async def send_reply(self, thread_id: str, message_id: str, reply_text: str):
+        """Send a reply in the same thread."""
+        try:
+            original = await self._request('messages.get', 'GET', f'/messages/{message_id}', params={
+                'format': 'metadata', 'metadataHeaders': list(REPLY_HEADERS), 'fields': 'payload/headers'
+            }, level=INTERACTIVE)
+        except (GmailHTTPError, httpx.HTTPError, GmailUnavailableError) as e:
+            logger.error(f"Failed to get message headers {message_id}: {e}")
+            return False
+        body = self.build_reply(thread_id, message_id, original['payload']['headers'], reply_text)
+        try:
+            await self._request('messages.send', 'POST', '/messages/send', json=body, level=INTERACTIVE)
+            return True
+        except (GmailHTTPError, httpx.HTTPError, GmailUnavailableError) as e:
+            logger.error(f"Failed to send reply: {e}")
+            return False
@@ -6,19 +6,47 @@ import asyncio
 
 from config import (
     EMOJIS, COLORS, FOOTER_TEXT,
-    ADMIN_USER_ID, GMAIL_CREDENTIALS_FILE
+    ADMIN_USER_ID, GMAIL_CREDENTIALS_FILE, METRICS_PORT, SHARDING_ENABLED, RESYNC_ON_STARTUP
 )
 import database as db
-from auth import GmailAuth
-from gmail_api import GmailAPI
-from watch_manager import WatchManager
+import metrics
+import gmail_quota
+from gmail_api import close_shared_clients
+from event_writer import EventWriteBuffer
+from dedup import SeenMessages
+from mailboxes import MailboxRegistry
+from leases import LeaseManager
 from pubsub_listener import PubSubListener
+from gmail_views import DYNAMIC_ITEMS
 
 logger = logging.getLogger(__name__)
 
+# Gauge fields worth a line in /stats (the rest are only on /metrics)
+STATS_GAUGE_KEYS = (
+    'queued', 'active', 'queue_depth', 'pending', 'wait_p50',
+    'owned', 'workers', 'next_renewal_in', 'failing',
+    'waiting', 'retries', 'open_circuits',
+)
+
+def answers_here(interaction: discord.Interaction) -> bool:
+    """Whether this worker replies to a slash command (always, unless sharded).
+
+    Every worker receives each command but only one may respond: the one
+    holding the lease on the command's mailbox option, or on the default
+    mailbox, as with button clicks.
+    """
+    mailboxes = getattr(interaction.client, 'mailboxes', None)
+    if not mailboxes or not mailboxes.leases:
+        return True
+    name = getattr(interaction.namespace, 'mailbox', None)
+    mailbox = mailboxes.get(name) if name else None
+    return mailboxes.owns(mailbox or mailboxes.default)
+
 def admin_only():
     async def predicate(interaction: discord.Interaction):
         if interaction.user.id != ADMIN_USER_ID:
+            if not answers_here(interaction):
+                return False
             embed = discord.Embed(
                 title=f"{EMOJIS['error']} Permission Denied",
                 description="This command is only for the bot owner.",
@@ -32,24 +60,45 @@ def admin_only():
 class GmailBotCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.auth = GmailAuth()
-        self.gmail_api = None
-        self.watch_manager = None
+        self.mailboxes = MailboxRegistry(bot)
         self.listener = None
-        self.bot.gmail_api = None  # placeholder for views to access
+        self.event_writer = EventWriteBuffer()
+        self.seen_messages = SeenMessages()
+        self.metrics_server = None
+        self.bot.mailboxes = self.mailboxes  # views find a message's mailbox here
+        self.bot.event_writer = self.event_writer
 
     async def cog_load(self):
         """Initialize Gmail connection and start services."""
         logger.info("Initializing Gmail bot...")
+        # Stateless email buttons work across restarts once registered
+        self.bot.add_dynamic_items(*DYNAMIC_ITEMS)
         try:
-            creds = await self.auth.get_credentials()
-            self.gmail_api = GmailAPI(creds)
-            self.bot.gmail_api = self.gmail_api  # make available to views
-            self.watch_manager = WatchManager(self.bot, self.gmail_api)
-            self.listener = PubSubListener(self.bot, self.gmail_api)
+            # Credentials, client and history cursor for every configured account
+            await self.mailboxes.load()
+            await self.seen_messages.warm()
+            self.listener = PubSubListener(self.bot, self.mailboxes, self.event_writer, self.seen_messages)
+            if SHARDING_ENABLED:
+                # Only the mailboxes this worker holds a lease on are served here
+                self.mailboxes.leases = LeaseManager(
+                    [mailbox.email_address for mailbox in self.mailboxes],
+                    self.listener.adopt_mailbox,
+                    self.listener.release_mailbox
+                )
 
-            # Start watch renewal background task
-            self.watch_manager.start_background_task()
+            # Start batched gmail_events writer, then each mailbox's
+            # history checkpointing and watch renewal (sharded: lease rebalancing)
+            self.event_writer.start()
+            await self.mailboxes.start()
+            if RESYNC_ON_STARTUP and not SHARDING_ENABLED:
+                # Catch up on mail that arrived while the bot was down
+                # (sharded workers resync each mailbox as they adopt it)
+                asyncio.create_task(self.listener.resync.resync_all(self.mailboxes.owned()))
+
+            self.register_gauges()
+            if METRICS_PORT:
+                self.metrics_server = metrics.MetricsServer()
+                await self.metrics_server.start()
 
             # Start Pub/Sub listener in background
             asyncio.create_task(self.listener.start())
@@ -60,28 +109,69 @@ class GmailBotCog(commands.Cog):
 
     async def cog_unload(self):
         """Cleanup on unload."""
+        self.bot.remove_dynamic_items(*DYNAMIC_ITEMS)
+        if self.mailboxes.leases:
+            # Hand every mailbox to the remaining workers; their watches stay up
+            await self.mailboxes.leases.close()
+        else:
+            await self.mailboxes.stop_watches()
         if self.listener:
             await self.listener.stop()
-        if self.watch_manager:
-            await self.watch_manager.stop_watch()
+        await self.mailboxes.close()
+        await close_shared_clients()
+        await self.event_writer.close()
+        if self.metrics_server:
+            await self.metrics_server.stop()
+        metrics.unregister_gauges()
+
+    def register_gauges(self):
+        """Queue depths and buffer sizes, read at scrape time."""
+        if self.mailboxes.default:
+            metrics.register_gauge('executor', self.mailboxes.default.gmail_api.executor_stats, pool='gmail')
+        metrics.register_gauge('mailboxes', lambda: len(self.mailboxes))
+        metrics.register_gauge('watch_renewal', self.mailboxes.watch_scheduler.stats)
+        metrics.register_gauge(
+            'gmail_quota', lambda: gmail_quota.combined_stats(m.gmail_api.quota for m in self.mailboxes)
+        )
+        if self.mailboxes.leases:
+            metrics.register_gauge('leases', self.mailboxes.leases.stats)
+        metrics.register_gauge('executor', db.executor_stats, pool='db')
+        metrics.register_gauge('dispatch', self.listener.dispatcher.stats)
+        metrics.register_gauge('digest', self.listener.digest.stats)
+        metrics.register_gauge('event_writer_pending', lambda: self.event_writer.pending)
+        metrics.register_gauge('dedup', lambda: {'hits': self.seen_messages.hits, 'db_hits': self.seen_messages.db_hits})
 
     @app_commands.command(name="setup", description="Start Gmail notifications (admin only)")
     @admin_only()
     async def setup(self, interaction: discord.Interaction):
-        """Start the watch and confirm."""
-        await interaction.response.defer(ephemeral=True)
-        if not self.watch_manager:
-            await interaction.followup.send("Gmail not initialized.", ephemeral=True)
+        """Start every mailbox's watch and confirm.
+
+        Sharded, each worker starts the watches of the mailboxes it holds and
+        only one of them replies.
+        """
+        answering = answers_here(interaction)
+        if answering:
+            await interaction.response.defer(ephemeral=True)
+        if not self.listener:
+            if answering:
+                await interaction.followup.send("Gmail not initialized.", ephemeral=True)
             return
 
-        success = await self.watch_manager.start_watch()
-        if success:
+        started = await self.mailboxes.start_watches()
+        if started:
             # Also ensure listener is running
             if not self.listener.running:
                 asyncio.create_task(self.listener.start())
+        if not answering:
+            return
+        if started:
+            description = (f"You will now receive notifications for new emails via DM "
+                           f"({started}/{len(self.mailboxes.owned())} mailboxes).")
+            if self.mailboxes.leases:
+                description += "\nOther workers start the mailboxes they hold."
             embed = discord.Embed(
                 title=f"{EMOJIS['success']} Gmail Notifications Started",
-                description="You will now receive notifications for new emails via DM.",
+                description=description,
                 color=COLORS['success']
             )
             await interaction.followup.send(embed=embed, ephemeral=True)
@@ -93,15 +183,118 @@ class GmailBotCog(commands.Cog):
             )
             await interaction.followup.send(embed=embed, ephemeral=True)
 
+    @app_commands.command(name="stats", description="Pipeline latency and queue stats (admin only)")
+    @admin_only()
+    async def stats(self, interaction: discord.Interaction):
+        if not answers_here(interaction):
+            return  # sharded: the default mailbox's worker reports its own pipeline
+        summary = metrics.summary()
+        embed = discord.Embed(
+            title=f"{EMOJIS['info']} Notification Pipeline",
+            color=COLORS['info']
+        )
+
+        e2e = summary['stages'].get('end_to_end')
+        if e2e:
+            embed.description = (
+                f"**Mail received → DM delivered:** p50 {e2e['p50']:.1f}s · "
+                f"p99 {e2e['p99']:.1f}s ({e2e['count']} emails)"
+            )
+        else:
+            embed.description = "No notifications delivered yet."
+
+        lines = [f"{'stage':<16}{'n':>7}{'p50 ms':>9}{'p99 ms':>9}"]
+        for stage, s in summary['stages'].items():
+            if stage != 'end_to_end':
+                lines.append(f"{stage:<16}{s['count']:>7}{s['p50'] * 1000:>9.0f}{s['p99'] * 1000:>9.0f}")
+        embed.add_field(name="Stages", value="```\n" + "\n".join(lines)[:1000] + "\n```", inline=False)
+
+        queues = []
+        for name, stats in summary['gauges'].items():
+            if isinstance(stats, dict):
+                shown = {k: v for k, v in stats.items() if k in STATS_GAUGE_KEYS}
+                if shown:
+                    queues.append(f"**{name}:** " + ", ".join(
+                        f"{k} {v:.2f}" if isinstance(v, float) else f"{k} {v}" for k, v in shown.items()
+                    ))
+            else:
+                queues.append(f"**{name}:** {stats}")
+        if queues:
+            embed.add_field(name="Queues", value="\n".join(queues)[:1024], inline=False)
+
+        if summary['counters']:
+            embed.add_field(
+                name="Counters",
+                value="\n".join(f"{k}: {v}" for k, v in summary['counters'].items())[:1024],
+                inline=False
+            )
+        embed.set_footer(text=FOOTER_TEXT)
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
+    @app_commands.command(name="resync", description="Catch up on mail missed while offline (admin only)")
+    @admin_only()
+    async def resync(self, interaction: discord.Interaction, mailbox: str = None):
+        """Resync one mailbox, or every mailbox, reporting progress as it goes.
+
+        Sharded, the mailbox's owner does a single-mailbox resync; for all of
+        them each worker resyncs its own and only one reports.
+        """
+        answering = answers_here(interaction)
+        if mailbox:
+            account = self.mailboxes.get(mailbox)
+            if account and not self.mailboxes.owns(account):
+                return  # its owner answers
+            accounts = [account] if account else []
+        else:
+            accounts = self.mailboxes.owned()
+        if not answering:
+            if self.listener and accounts:
+                await self.listener.resync.resync_all(accounts)
+            return
+
+        await interaction.response.defer(ephemeral=True)
+        if not self.listener:
+            await interaction.followup.send("Listener not ready.", ephemeral=True)
+            return
+        if mailbox and not accounts:
+            await interaction.followup.send(f"Mailbox {mailbox} is not configured.", ephemeral=True)
+            return
+
+        status = await interaction.followup.send(
+            f"{EMOJIS['info']} Resyncing {len(accounts)} mailboxes...", ephemeral=True, wait=True
+        )
+
+        async def on_progress(progress):
+            await status.edit(content="\n".join(str(p) for p in progress)[:2000])
+
+        results = await self.listener.resync.resync_all(accounts, on_progress)
+        ok = all(p.ok for p in results)
+        description = "\n".join(str(p) for p in results)[:4000] or "No mailboxes served here."
+        if self.mailboxes.leases and not mailbox:
+            description += "\nOther workers resync the mailboxes they hold."
+        embed = discord.Embed(
+            title=f"{EMOJIS['success' if ok else 'error']} Resync {'Finished' if ok else 'Incomplete'}",
+            description=description,
+            color=COLORS['success' if ok else 'error']
+        )
+        embed.set_footer(text=FOOTER_TEXT)
+        await status.edit(content=None, embed=embed)
+
     # Optional command to test sending a notification manually
     @app_commands.command(name="testmail", description="Test: process a specific message ID (admin only)")
     @admin_only()
-    async def testmail(self, interaction: discord.Interaction, message_id: str):
+    async def testmail(self, interaction: discord.Interaction, message_id: str, mailbox: str = None):
+        if not answers_here(interaction):
+            return  # the mailbox's owner processes it
         await interaction.response.defer(ephemeral=True)
         if not self.listener:
             await interaction.followup.send("Listener not ready.", ephemeral=True)
             return
-        await self.listener.process_message(message_id)
+        account = self.mailboxes.get(mailbox)
+        if not account:
+            await interaction.followup.send(f"Mailbox {mailbox} is not configured.", ephemeral=True)
+            return
+        await self.listener.process_message(account, message_id)
         await interaction.followup.send(f"Processed message {message_id}.", ephemeral=True)
 
 async def setup(bot):
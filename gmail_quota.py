@@ -0,0 +1,272 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import random
+import time
+from contextlib import contextmanager
+
+from config import (
+    GMAIL_QUOTA_UNITS_PER_SECOND, GMAIL_QUOTA_BURST,
+    GMAIL_RETRY_ATTEMPTS, GMAIL_RETRY_BASE, GMAIL_RETRY_MAX,
+    GMAIL_BREAKER_THRESHOLD, GMAIL_BREAKER_COOLDOWN
+)
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Quota units per call (https://developers.google.com/gmail/api/reference/quota)
+QUOTA_COSTS = {
+    'getProfile': 1,
+    'watch': 100,
+    'stop': 50,
+    'history.list': 2,
+    'messages.list': 5,
+    'messages.get': 5,
+    'messages.delete': 10,
+    'messages.send': 100,
+}
+
+# Priority classes, most urgent first
+INTERACTIVE = 0  # a user clicked a button: delete, reply, re-fetch for a view
+SYNC = 1         # notification syncs
+BULK = 2         # watch renewals
+PRIORITY_NAMES = ('interactive', 'sync', 'bulk')
+
+# Only retried when Gmail refused them outright (429 / rate-limit 403): after a
+# 5xx or a dropped connection the mail may already have gone out
+NOT_IDEMPOTENT = {'messages.send'}
+
+_priority = contextvars.ContextVar('gmail_priority', default=SYNC)
+
+@contextmanager
+def priority(level: int):
+    """Run the Gmail calls made in this block (and tasks it starts) at a priority class."""
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+class GmailUnavailableError(Exception):
+    """The mailbox's circuit breaker is open: Gmail kept failing, so calls fail fast."""
+
+def error_status(exc):
+    """HTTP status of a googleapiclient HttpError or GmailHTTPError (None for other errors)."""
+    status = getattr(exc, 'status', None)
+    if status is None and getattr(exc, 'resp', None) is not None:
+        status = getattr(exc.resp, 'status', None)
+    try:
+        return int(status) if status is not None else None
+    except (TypeError, ValueError):
+        return None
+
+class QuotaScheduler:
+    """Per-mailbox gate for Gmail calls: quota, priorities, retries and a circuit breaker.
+
+    Gmail allows GMAIL_QUOTA_UNITS_PER_SECOND quota units per user; every
+    call takes its QUOTA_COSTS units from a token bucket first. Callers that
+    have to wait queue by priority class (then arrival), so a burst of sync
+    fetches cannot delay a delete or reply behind it.
+
+    429, rate-limit 403, 5xx and transport errors are retried with jittered
+    exponential backoff; being rate limited also empties the bucket. After
+    GMAIL_BREAKER_THRESHOLD consecutive failed attempts (rate limits aside) the
+    breaker opens and calls raise GmailUnavailableError at once for
+    GMAIL_BREAKER_COOLDOWN seconds, after which one probe call decides
+    whether it closes again.
+    """
+
+    def __init__(self, transient=(), rate: float = GMAIL_QUOTA_UNITS_PER_SECOND, burst: float = GMAIL_QUOTA_BURST,
+                 retry_attempts: int = GMAIL_RETRY_ATTEMPTS, retry_base: float = GMAIL_RETRY_BASE,
+                 retry_max: float = GMAIL_RETRY_MAX, breaker_threshold: int = GMAIL_BREAKER_THRESHOLD,
+                 breaker_cooldown: float = GMAIL_BREAKER_COOLDOWN):
+        self.transient = tuple(transient)  # exception types worth retrying (timeouts, resets)
+        self.rate = rate
+        self.burst = burst
+        self.retry_attempts = retry_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.tokens = burst
+        self._updated = time.monotonic()
+        self._waiters = []  # (priority, seq, cost, future)
+        self._seq = itertools.count()
+        self._timer = None
+        self.failures = 0   # consecutive failed attempts
+        self._opened_at = None
+        self._probing = False
+        self.throttled = 0
+        self.retries = 0
+        self.trips = 0
+
+    # ---------- Token bucket ----------
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, cost: float, level: int = None):
+        """Wait until cost quota units are available, behind any more urgent waiter."""
+        cost = min(cost, self.burst)
+        level = _priority.get() if level is None else level
+        self._refill()
+        if not self._waiters and self.tokens >= cost:
+            self.tokens -= cost
+            return
+        self.throttled += 1
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (level, next(self._seq), cost, future))
+        self._wake()
+        await future
+
+    def _wake(self):
+        """Hand out tokens to waiters in priority order; re-arm the timer for the next one."""
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        self._refill()
+        while self._waiters:
+            _, _, cost, future = self._waiters[0]
+            if future.done():  # cancelled while waiting
+                heapq.heappop(self._waiters)
+                continue
+            if self.tokens < cost:
+                delay = (cost - self.tokens) / self.rate
+                self._timer = asyncio.get_running_loop().call_later(delay, self._wake)
+                return
+            heapq.heappop(self._waiters)
+            self.tokens -= cost
+            future.set_result(None)
+
+    # ---------- Circuit breaker ----------
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return 'closed'
+        if time.monotonic() - self._opened_at < self.breaker_cooldown:
+            return 'open'
+        return 'half_open'
+
+    def _allow(self) -> bool:
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'half_open' and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def _succeeded(self):
+        if self._opened_at is not None:
+            logger.info("Gmail reachable again, closing circuit")
+            metrics.inc('gmail_circuit', state='closed')
+        self.failures = 0
+        self._opened_at = None
+
+    def _failed(self, reason):
+        self.failures += 1
+        if self._opened_at is not None or self.failures >= self.breaker_threshold:
+            if self._opened_at is None:
+                self.trips += 1
+            self._opened_at = time.monotonic()
+            logger.warning(f"Gmail failing ({self.failures} attempts in a row, last: {reason}); "
+                           f"failing fast for {self.breaker_cooldown:.0f}s")
+            metrics.inc('gmail_circuit', state='open')
+
+    # ---------- Calls ----------
+
+    def retryable(self, exc) -> bool:
+        if isinstance(exc, self.transient):
+            return True
+        status = error_status(exc)
+        if status == 429 or (status is not None and status >= 500):
+            return True
+        # Gmail reports per-user rate limits as 403 rateLimitExceeded / userRateLimitExceeded
+        return status == 403 and 'ratelimitexceeded' in str(exc).lower().replace(' ', '').replace('-', '')
+
+    def backoff(self, attempt: int) -> float:
+        """Delay before retry number attempt (1-based): exponential, jittered."""
+        return min(self.retry_max, self.retry_base * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+
+    def throttle(self):
+        """Gmail says we are over quota: empty the bucket so every caller pauses."""
+        self._refill()
+        self.tokens = min(self.tokens, 0.0)
+
+    def _settle(self, exc=None):
+        if exc is None or not self.retryable(exc):
+            self._succeeded()  # Gmail answered, even if with an error of ours
+        elif error_status(exc) in (403, 429):  # rate limited: not an outage
+            self.throttle()
+        else:
+            self._failed(exc)
+
+    async def call(self, operation: str, fn, level: int = None, units: float = None):
+        """Run await fn() under quota, retrying transient errors; raises the last error.
+
+        units defaults to the operation's QUOTA_COSTS; level to the priority
+        class set by priority() (SYNC if none).
+        """
+        cost = QUOTA_COSTS[operation] if units is None else units
+        level = _priority.get() if level is None else level
+        attempt = 0
+        while True:
+            if not self._allow():
+                metrics.inc('gmail_calls', operation=operation, status='rejected')
+                raise GmailUnavailableError(f"Gmail circuit open, not calling {operation}")
+            probe = self._probing
+            try:
+                await self.acquire(cost, level)
+                result = await fn()
+            except Exception as e:
+                self._settle(e)
+                if not self.retryable(e) or attempt >= self.retry_attempts:
+                    raise
+                if operation in NOT_IDEMPOTENT and error_status(e) not in (403, 429):
+                    raise
+                attempt += 1
+                self.retries += 1
+                metrics.inc('gmail_calls', operation=operation, status='retried')
+                delay = self.backoff(attempt)
+                logger.warning(f"Gmail {operation} failed ({e}); retry {attempt}/{self.retry_attempts} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+            finally:
+                if probe:
+                    self._probing = False
+            self._settle()
+            return result
+
+    def stats(self) -> dict:
+        self._refill()
+        waiting = [0] * len(PRIORITY_NAMES)
+        for level, _, _, future in self._waiters:
+            if not future.done():
+                waiting[level] += 1
+        return {
+            'tokens': self.tokens,
+            **{f'waiting_{name}': n for name, n in zip(PRIORITY_NAMES, waiting)},
+            'throttled': self.throttled,
+            'retries': self.retries,
+            'circuit_open': int(self.state != 'closed'),
+            'trips': self.trips,
+        }
+
+def combined_stats(schedulers) -> dict:
+    """Totals over many mailboxes' schedulers, for one gauge."""
+    totals = {}
+    count = 0
+    for scheduler in schedulers:
+        count += 1
+        for key, value in scheduler.stats().items():
+            totals[key] = totals.get(key, 0) + value
+    totals.pop('tokens', None)
+    totals['waiting'] = sum(totals.get(f'waiting_{name}', 0) for name in PRIORITY_NAMES)
+    totals['open_circuits'] = totals.pop('circuit_open', 0)
+    totals['mailboxes'] = count
+    return totals
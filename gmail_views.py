@@ -1,48 +1,80 @@
 import discord
 import asyncio
-import re
-from config import EMOJIS, COLORS, FOOTER_TEXT
+import logging
+from collections import OrderedDict
+from typing import NamedTuple
+from config import EMOJIS, COLORS, FOOTER_TEXT, VIEW_STATE_CACHE_SIZE
 import database as db
+from code_extractor import best_code
+import gmail_quota
 
-class GmailMessageView(discord.ui.View):
-    def __init__(self, message_id, thread_id, full_body):
-        super().__init__(timeout=None)
-        self.message_id = message_id
-        self.thread_id = thread_id
-        self.full_body = full_body
+logger = logging.getLogger(__name__)
 
-        # Reply button
-        reply_btn = discord.ui.Button(
-            label="Reply",
-            style=discord.ButtonStyle.primary,
-            emoji=EMOJIS['reply'],
-            custom_id="gmail_reply"
-        )
-        reply_btn.callback = self.reply_callback
-        self.add_item(reply_btn)
+# Buttons carry the Gmail message ID in their custom_id and hold no other state,
+# so any bot process can serve clicks on any DM, including ones sent before a restart.
+# With sharded workers every process sees the click; only the mailbox's owner answers.
+MESSAGE_ID_PATTERN = r'(?P<message_id>[0-9a-zA-Z]+)'
 
-        # Delete button
-        delete_btn = discord.ui.Button(
-            label="Delete",
-            style=discord.ButtonStyle.danger,
-            emoji=EMOJIS['delete'],
-            custom_id="gmail_delete"
-        )
-        delete_btn.callback = self.delete_callback
-        self.add_item(delete_btn)
+class MessageState(NamedTuple):
+    thread_id: str
+    code: str
+    email_address: str  # mailbox the message is in (None = default mailbox)
+
+_state_cache = OrderedDict()  # message_id -> MessageState, most recent last
+
+def remember_message(message_id, thread_id, code=None, email_address=None):
+    """Cache what the buttons need for a freshly notified message."""
+    _state_cache[message_id] = MessageState(thread_id, code, email_address)
+    _state_cache.move_to_end(message_id)
+    while len(_state_cache) > VIEW_STATE_CACHE_SIZE:
+        _state_cache.popitem(last=False)
+
+def get_mailbox(client, email_address=None):
+    """The bot's mailbox for an address (None = default), or None if not served."""
+    mailboxes = getattr(client, 'mailboxes', None)
+    return mailboxes.get(email_address) if mailboxes else None
+
+async def load_message_state(client, message_id):
+    """Thread ID, detected code and mailbox for a message: cache, then ledger, then Gmail."""
+    state = _state_cache.get(message_id)
+    if state:
+        return state
+
+    row = await db.get_gmail_event_async(message_id)
+    if row:
+        state = MessageState(row[0], row[1], row[3])
+    else:
+        # Not in the ledger: only the default mailbox is worth asking
+        mailbox = get_mailbox(client)
+        with gmail_quota.priority(gmail_quota.INTERACTIVE):
+            msg = await mailbox.gmail_api.fetch_message(message_id) if mailbox else None
+        if not msg:
+            return None
+        state = MessageState(msg['threadId'], best_code(mailbox.gmail_api.extract_body_text(msg)), mailbox.email_address)
+    remember_message(message_id, *state)
+    return state
+
+async def handled_here(interaction, message_id) -> bool:
+    """Whether this worker answers a click (always, unless sharded)."""
+    mailboxes = getattr(interaction.client, 'mailboxes', None)
+    if not mailboxes or not mailboxes.leases:
+        return True
+    state = await load_message_state(interaction.client, message_id)
+    mailbox = mailboxes.get(state.email_address) if state else None
+    return mailboxes.owns(mailbox or mailboxes.default)
+
+class GmailMessageView(discord.ui.View):
+    """Buttons for one email. Built per DM, but every interactive item is dynamic,
+    so nothing is kept in the view store after sending."""
+
+    def __init__(self, message_id, thread_id, code=None):
+        super().__init__(timeout=None)
+        self.add_item(ReplyButton(message_id))
+        self.add_item(DeleteButton(message_id))
 
         # Copy button (only if code detected)
-        code_match = re.search(r'\b\d{6,8}\b', full_body) or re.search(r'\b[A-Z0-9]{8,}\b', full_body)
-        if code_match:
-            self.code = code_match.group()
-            copy_btn = discord.ui.Button(
-                label="Copy Code",
-                style=discord.ButtonStyle.secondary,
-                emoji=EMOJIS['copy'],
-                custom_id="gmail_copy"
-            )
-            copy_btn.callback = self.copy_callback
-            self.add_item(copy_btn)
+        if code:
+            self.add_item(CopyCodeButton(message_id))
 
         # Read All link button
         gmail_url = f"https://mail.google.com/mail/u/0/#inbox/{thread_id}"
@@ -53,31 +85,147 @@ class GmailMessageView(discord.ui.View):
             emoji="🔗"
         ))
 
-    async def reply_callback(self, interaction: discord.Interaction):
-        modal = ReplyModal(self.message_id, self.thread_id)
+class ReplyButton(discord.ui.DynamicItem[discord.ui.Button], template=rf'gmail:reply:{MESSAGE_ID_PATTERN}'):
+    def __init__(self, message_id):
+        super().__init__(discord.ui.Button(
+            label="Reply",
+            style=discord.ButtonStyle.primary,
+            emoji=EMOJIS['reply'],
+            custom_id=f"gmail:reply:{message_id}"
+        ))
+        self.message_id = message_id
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(match['message_id'])
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        return await handled_here(interaction, self.message_id)
+
+    async def callback(self, interaction: discord.Interaction):
+        modal = ReplyModal(self.message_id)
         await interaction.response.send_modal(modal)
 
-    async def delete_callback(self, interaction: discord.Interaction):
+class DeleteButton(discord.ui.DynamicItem[discord.ui.Button], template=rf'gmail:delete:{MESSAGE_ID_PATTERN}'):
+    def __init__(self, message_id):
+        super().__init__(discord.ui.Button(
+            label="Delete",
+            style=discord.ButtonStyle.danger,
+            emoji=EMOJIS['delete'],
+            custom_id=f"gmail:delete:{message_id}"
+        ))
+        self.message_id = message_id
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(match['message_id'])
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        return await handled_here(interaction, self.message_id)
+
+    async def callback(self, interaction: discord.Interaction):
         await interaction.response.defer(ephemeral=True)
         bot = interaction.client
-        gmail_api = getattr(bot, 'gmail_api', None)
-        if not gmail_api:
+        state = await load_message_state(bot, self.message_id)
+        if not state:
+            await interaction.followup.send("❌ Original email not found.", ephemeral=True)
+            return
+        mailbox = get_mailbox(bot, state.email_address)
+        if not mailbox:
             await interaction.followup.send("Gmail API not available.", ephemeral=True)
             return
 
-        success = await gmail_api.delete_message(self.message_id)
+        success = await mailbox.gmail_api.delete_message(self.message_id)
         if success:
-            db.mark_deleted(self.message_id)
+            event_writer = getattr(bot, 'event_writer', None)
+            if event_writer:
+                event_writer.mark_deleted(self.message_id)
+            else:
+                await db.mark_deleted_async(self.message_id)
             await interaction.followup.send("✅ Email deleted.", ephemeral=True)
             embed = interaction.message.embeds[0]
             embed.title = f"[DELETED] {embed.title}"
             embed.color = COLORS['error']
-            await interaction.message.edit(embed=embed, view=None)
+            # Through the interaction: the button may sit on an ephemeral message
+            # (opened from a digest), which a plain message edit cannot reach
+            try:
+                await interaction.edit_original_response(embed=embed, view=None)
+            except discord.HTTPException as e:
+                logger.warning(f"Could not mark email {self.message_id} deleted in Discord: {e}")
         else:
             await interaction.followup.send("❌ Failed to delete email.", ephemeral=True)
 
-    async def copy_callback(self, interaction: discord.Interaction):
-        await interaction.response.send_message(f"📋 Code: `{self.code}`", ephemeral=True)
+class CopyCodeButton(discord.ui.DynamicItem[discord.ui.Button], template=rf'gmail:copy:{MESSAGE_ID_PATTERN}'):
+    def __init__(self, message_id):
+        super().__init__(discord.ui.Button(
+            label="Copy Code",
+            style=discord.ButtonStyle.secondary,
+            emoji=EMOJIS['copy'],
+            custom_id=f"gmail:copy:{message_id}"
+        ))
+        self.message_id = message_id
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(match['message_id'])
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        return await handled_here(interaction, self.message_id)
+
+    async def callback(self, interaction: discord.Interaction):
+        state = await load_message_state(interaction.client, self.message_id)
+        if not state or not state.code:
+            await interaction.response.send_message("❌ Code no longer available.", ephemeral=True)
+            return
+        await interaction.response.send_message(f"📋 Code: `{state.code}`", ephemeral=True)
+
+class DigestView(discord.ui.View):
+    """Select menu for a digest DM; picking an email opens its buttons ephemerally."""
+
+    def __init__(self, entries):
+        super().__init__(timeout=None)
+        # entries: (message_id, from_email, subject), at most 25
+        options = [
+            discord.SelectOption(label=(subject or '(no subject)')[:100], description=from_email[:100], value=message_id)
+            for message_id, from_email, subject in entries
+        ]
+        self.add_item(DigestSelect(entries[0][0], options))
+
+class DigestSelect(discord.ui.DynamicItem[discord.ui.Select], template=rf'gmail:digest:{MESSAGE_ID_PATTERN}'):
+    def __init__(self, message_id, options):
+        # Options carry the message IDs, so the digest's first ID is enough to key it
+        super().__init__(discord.ui.Select(
+            placeholder="Choose an email...",
+            options=options,
+            custom_id=f"gmail:digest:{message_id}"
+        ))
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(match['message_id'], item.options)
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        return await handled_here(interaction, self.item.values[0])
+
+    async def callback(self, interaction: discord.Interaction):
+        message_id = self.item.values[0]
+        option = next(o for o in self.item.options if o.value == message_id)
+        state = await load_message_state(interaction.client, message_id)
+        if not state:
+            await interaction.response.send_message("❌ Original email not found.", ephemeral=True)
+            return
+        embed = discord.Embed(
+            title=f"{EMOJIS['mail']} {option.label}",
+            description=f"**From:** {option.description}",
+            color=COLORS['gmail']
+        )
+        if state.code:
+            embed.add_field(name="Code Detected", value="This message may contain a verification code.", inline=False)
+        view = GmailMessageView(message_id, state.thread_id, state.code)
+        await interaction.response.send_message(embed=embed, view=view, ephemeral=True)
+
+# Registered once at startup with bot.add_dynamic_items(*DYNAMIC_ITEMS)
+DYNAMIC_ITEMS = (ReplyButton, DeleteButton, CopyCodeButton, DigestSelect)
 
 class ReplyModal(discord.ui.Modal, title="Reply to Email"):
     reply_text = discord.ui.TextInput(
@@ -88,21 +236,24 @@ class ReplyModal(discord.ui.Modal, title="Reply to Email"):
         required=True
     )
 
-    def __init__(self, message_id, thread_id):
+    def __init__(self, message_id):
         super().__init__()
         self.message_id = message_id
-        self.thread_id = thread_id
 
     async def on_submit(self, interaction: discord.Interaction):
         await interaction.response.defer(ephemeral=True)
         bot = interaction.client
-        gmail_api = getattr(bot, 'gmail_api', None)
-        if not gmail_api:
+        state = await load_message_state(bot, self.message_id)
+        if not state:
+            await interaction.followup.send("❌ Original email not found.", ephemeral=True)
+            return
+        mailbox = get_mailbox(bot, state.email_address)
+        if not mailbox:
             await interaction.followup.send("Gmail API not available.", ephemeral=True)
             return
 
-        success = await gmail_api.send_reply(self.thread_id, self.message_id, self.reply_text.value)
+        success = await mailbox.gmail_api.send_reply(state.thread_id, self.message_id, self.reply_text.value)
         if success:
             await interaction.followup.send("✅ Reply sent.", ephemeral=True)
         else:
-            await interaction.followup.send("❌ Failed to send reply.", ephemeral=True)
\ No newline at end of file
+            await interaction.followup.send("❌ Failed to send reply.", ephemeral=True)
@@ -0,0 +1,73 @@
+import asyncio
+import logging
+
+from config import HISTORY_CHECKPOINT_INTERVAL
+import database as db
+
+logger = logging.getLogger(__name__)
+
+class HistoryCursor:
+    """In-memory, monotonic Gmail history cursor for one mailbox.
+
+    Loaded once from gmail_watch at startup; afterwards only this object moves
+    it, and it is checkpointed back with a compare-and-set so the stored value
+    never goes backwards.
+    """
+
+    def __init__(self, email_address: str, checkpoint_interval: float = HISTORY_CHECKPOINT_INTERVAL):
+        self.email_address = email_address
+        self.checkpoint_interval = checkpoint_interval
+        self.value = None
+        self._persisted = None
+        self._task = None
+
+    async def load(self):
+        """Read the stored cursor (once, at startup)."""
+        record = await db.get_watch_record_async(self.email_address)
+        self.value = self._persisted = record[1] if record else None
+        logger.info(f"History cursor for {self.email_address} loaded at {self.value}")
+        return self.value
+
+    def advance(self, history_id: int) -> bool:
+        """Move the cursor forward; older values are ignored."""
+        history_id = int(history_id)
+        if self.value is None or history_id > self.value:
+            self.value = history_id
+            return True
+        return False
+
+    async def checkpoint(self):
+        """Persist the cursor if it moved since the last checkpoint."""
+        value = self.value
+        if value is None or value == self._persisted:
+            return
+        if await db.update_history_id_async(self.email_address, value):
+            self._persisted = value
+            logger.debug(f"History cursor for {self.email_address} checkpointed at {value}")
+        else:
+            # No watch record yet (or the write failed); try again next interval
+            logger.debug(f"History cursor for {self.email_address} not checkpointed at {value}")
+
+    def start(self):
+        """Start the periodic checkpoint task."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.checkpoint_interval)
+            try:
+                await self.checkpoint()
+            except Exception as e:
+                logger.error(f"Error checkpointing history cursor: {e}")
+
+    async def close(self):
+        """Stop the checkpoint task and write the final position."""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.checkpoint()
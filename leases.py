@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import time
+
+from config import WORKER_ID, LEASE_TTL, LEASE_RENEW_INTERVAL, WORKER_TIMEOUT
+import database as db
+
+logger = logging.getLogger(__name__)
+
+class LeaseManager:
+    """Splits mailboxes between worker processes with leases in the ledger DB.
+
+    Every LEASE_RENEW_INTERVAL the worker heartbeats, renews its leases and
+    moves towards its share: live workers sorted by ID each get
+    len(mailboxes) // workers, the first len(mailboxes) % workers one more.
+    A worker over its share releases mailboxes; one under it takes free or
+    expired leases. A dead worker's leases expire after LEASE_TTL and are
+    picked up by the survivors.
+
+    on_acquire / on_release are coroutines taking the email address. A
+    hand-off (on_release) runs in the background while the lease keeps being
+    renewed, and the lease is only deleted once it has returned.
+    """
+
+    def __init__(self, emails, on_acquire, on_release, worker_id: str = WORKER_ID,
+                 ttl: float = LEASE_TTL, renew_interval: float = LEASE_RENEW_INTERVAL,
+                 worker_timeout: float = WORKER_TIMEOUT):
+        self.emails = sorted(emails)
+        self.on_acquire = on_acquire
+        self.on_release = on_release
+        self.worker_id = worker_id
+        self.ttl = ttl
+        self.renew_interval = renew_interval
+        self.worker_timeout = worker_timeout
+        self.owned = set()
+        self._handoffs = {}  # email -> task handing the mailbox off
+        self.workers = 1
+        self._valid_until = 0.0  # local deadline: stop acting on leases we could not renew
+        self._task = None
+        self.acquired = 0
+        self.released = 0
+
+    def owns(self, email_address: str) -> bool:
+        return email_address in self.owned and time.time() < self._valid_until
+
+    def target(self, workers) -> int:
+        """This worker's share of the mailboxes, given the live worker IDs."""
+        workers = sorted(set(workers) | {self.worker_id})
+        share, extra = divmod(len(self.emails), len(workers))
+        return share + (1 if workers.index(self.worker_id) < extra else 0)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await self.rebalance()
+            except Exception as e:
+                logger.error(f"Error rebalancing mailbox leases: {e}", exc_info=True)
+            await asyncio.sleep(self.renew_interval)
+
+    async def rebalance(self):
+        """Heartbeat, renew, then release or acquire leases towards this worker's share."""
+        now = time.time()
+        await db.heartbeat_worker_async(self.worker_id, now)
+        renewed = await db.renew_leases_async(self.worker_id, now, now + self.ttl)
+        if renewed is None:
+            # Ledger unreachable: keep serving until the leases would have expired
+            if now >= self._valid_until:
+                for email in list(self.owned):
+                    self._hand_off(email, "lease could not be renewed", release=False)
+            return
+        self._valid_until = now + self.ttl
+        for email in self.owned - renewed:
+            self._hand_off(email, "lease lost", release=False)
+
+        workers = await db.get_live_workers_async(now - self.worker_timeout)
+        if workers is None:
+            return
+        self.workers = len(set(workers) | {self.worker_id})
+        target = self.target(workers)
+
+        # Over our share: hand off the surplus (highest addresses first)
+        for email in sorted(self.owned)[target:]:
+            self._hand_off(email, "rebalancing")
+        if len(self.owned) >= target:
+            return
+
+        leases = await db.get_mailbox_leases_async()
+        if leases is None:
+            return
+        free = [
+            email for email in self.emails
+            if email not in self._handoffs and (email not in leases or leases[email][1] < now)
+        ]
+        for email in free[:target - len(self.owned)]:
+            if await db.acquire_lease_async(email, self.worker_id, now, now + self.ttl):
+                await self._adopt(email)
+
+    async def _adopt(self, email: str):
+        try:
+            await self.on_acquire(email)
+        except Exception as e:
+            logger.error(f"Could not take over {email}, releasing its lease: {e}", exc_info=True)
+            await db.release_lease_async(email, self.worker_id)
+            return
+        self.owned.add(email)
+        self.acquired += 1
+        logger.info(f"Worker {self.worker_id} now owns {email} ({len(self.owned)} mailboxes)")
+
+    def _hand_off(self, email: str, reason: str, release: bool = True):
+        """Stop owning a mailbox now; hand it off (and free the lease) in the background."""
+        self.owned.discard(email)
+        self.released += 1
+        logger.info(f"Worker {self.worker_id} gives up {email} ({reason})")
+        self._handoffs[email] = asyncio.create_task(self._release(email, release))
+
+    async def _release(self, email: str, release: bool):
+        try:
+            await self.on_release(email)
+        except Exception as e:
+            logger.error(f"Error handing off {email}: {e}", exc_info=True)
+        finally:
+            if release:
+                await db.release_lease_async(email, self.worker_id)
+            self._handoffs.pop(email, None)
+
+    def stats(self) -> dict:
+        return {
+            'owned': len(self.owned),
+            'mailboxes': len(self.emails),
+            'workers': self.workers,
+            'acquired': self.acquired,
+            'released': self.released,
+            'handing_off': len(self._handoffs),
+        }
+
+    async def close(self):
+        """Stop rebalancing, hand off every owned mailbox and leave the worker pool."""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for email in sorted(self.owned):
+            self._hand_off(email, "shutting down")
+        await asyncio.gather(*self._handoffs.values())
+        await db.remove_worker_async(self.worker_id)
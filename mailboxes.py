@@ -0,0 +1,144 @@
+import asyncio
+import logging
+
+from config import GMAIL_ACCOUNTS, GMAIL_TOKEN_FILE
+import database as db
+from auth import GmailAuth
+from gmail_api import create_gmail_api
+from history_cursor import HistoryCursor
+from watch_manager import WatchManager
+from watch_scheduler import WatchScheduler
+
+logger = logging.getLogger(__name__)
+
+class Mailbox:
+    """One Gmail account: its credentials, client, history cursor and watch."""
+
+    def __init__(self, bot, email_address: str, auth: GmailAuth, gmail_api, watch_scheduler: WatchScheduler = None):
+        # Lower-cased once: every table and the renewal heap are keyed by this
+        self.email_address = email_address = email_address.lower()
+        self.auth = auth
+        self.gmail_api = gmail_api
+        self.history_cursor = HistoryCursor(email_address)
+        self.watch_manager = WatchManager(bot, gmail_api, self.history_cursor, email_address)
+        self.watch_scheduler = watch_scheduler
+
+    async def start(self):
+        """Start checkpointing the cursor and schedule the watch's renewal."""
+        self.history_cursor.start()
+        if self.watch_scheduler:
+            await self.watch_scheduler.add(self.watch_manager)
+
+    async def stop(self):
+        """Stop watch renewal and write the cursor's final position (the client stays open)."""
+        if self.watch_scheduler:
+            self.watch_scheduler.remove(self.email_address)
+        await self.history_cursor.close()
+
+class MailboxRegistry:
+    """Every mailbox this process serves, keyed by (lower-cased) email address.
+
+    Clients, DB pool, Discord dispatcher and watch renewal scheduler are
+    shared; only credentials, cursor and watch are per mailbox. The first configured account is the
+    default, which also owns rows written before multi-mailbox support.
+
+    With sharding, leases (a LeaseManager) decide which of them this worker
+    syncs, notifies and renews watches for; the rest are only kept open.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._mailboxes = {}
+        self.default = None
+        self.leases = None
+        self.watch_scheduler = WatchScheduler()
+
+    def __iter__(self):
+        return iter(list(self._mailboxes.values()))
+
+    def __len__(self) -> int:
+        return len(self._mailboxes)
+
+    def add(self, mailbox: Mailbox):
+        self._mailboxes[mailbox.email_address] = mailbox
+        if self.default is None:
+            self.default = mailbox
+
+    def get(self, email_address: str = None):
+        """Mailbox for an address; None means the default mailbox."""
+        if email_address is None:
+            return self.default
+        return self._mailboxes.get(email_address.lower())
+
+    def owns(self, mailbox: Mailbox) -> bool:
+        """Whether this worker serves the mailbox (always, unless sharded)."""
+        return self.leases is None or self.leases.owns(mailbox.email_address)
+
+    def owned(self):
+        return [mailbox for mailbox in self if self.owns(mailbox)]
+
+    async def load(self, accounts: dict = None):
+        """Authorize every account and load its cursor.
+
+        accounts maps email address -> token file; empty means the single
+        GMAIL_TOKEN_FILE account, whose address is read from its profile.
+        """
+        accounts = accounts or GMAIL_ACCOUNTS or {None: GMAIL_TOKEN_FILE}
+        results = await asyncio.gather(
+            *(self._open(email, token_file) for email, token_file in accounts.items()),
+            return_exceptions=True
+        )
+        for (email, token_file), result in zip(accounts.items(), results):
+            if isinstance(result, Exception) or result is None:
+                logger.error(f"Could not open mailbox {email or token_file}: {result}")
+                continue
+            self.add(result)
+        if self.default is None:
+            raise RuntimeError("No Gmail mailbox could be opened")
+
+        await db.claim_legacy_watch_async(self.default.email_address)
+        await asyncio.gather(*(mailbox.history_cursor.load() for mailbox in self))
+        logger.info(f"Serving {len(self)} mailbox(es)")
+
+    async def _open(self, email_address, token_file):
+        auth = GmailAuth(token_file)
+        credentials = await auth.get_credentials()
+        gmail_api = create_gmail_api(credentials)
+        if email_address is None:
+            profile = await gmail_api.get_user_profile()
+            if not profile:
+                await gmail_api.close()
+                return None
+            email_address = profile['emailAddress']
+        return Mailbox(self.bot, email_address, auth, gmail_api, self.watch_scheduler)
+
+    async def start(self):
+        """Start the renewal scheduler and every mailbox's checkpointing and renewal.
+
+        Sharded, the lease manager starts instead and each mailbox is
+        started when this worker acquires it.
+        """
+        self.watch_scheduler.start()
+        if self.leases:
+            self.leases.start()
+            return
+        await asyncio.gather(*(mailbox.start() for mailbox in self))
+
+    async def start_watches(self) -> int:
+        """(Re)start the watch of every mailbox served here; returns how many succeeded."""
+        mailboxes = self.owned()
+        results = await asyncio.gather(*(mailbox.watch_manager.start_watch() for mailbox in mailboxes))
+        for mailbox, ok in zip(mailboxes, results):
+            if ok:
+                self.watch_scheduler.renewed(mailbox.watch_manager)
+        return sum(1 for ok in results if ok)
+
+    async def stop_watches(self):
+        await asyncio.gather(*(mailbox.watch_manager.stop_watch() for mailbox in self.owned()), return_exceptions=True)
+
+    async def close(self):
+        """Stop every mailbox (checkpointing its cursor) and release the clients."""
+        await self.watch_scheduler.close()
+        for mailbox in self:
+            await mailbox.stop()
+            await mailbox.gmail_api.close()
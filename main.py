@@ -30,7 +30,7 @@ class HandshakeBot(commands.Bot):
     async def setup_hook(self):
         # Initialize database
         try:
-            db.init_db()
+            await db.init_db_async()
             logger.info("✅ Database ready.")
         except Exception as e:
             logger.error(f"❌ Database init failed: {e}")
@@ -166,6 +166,10 @@ class HandshakeBot(commands.Bot):
         await self.verify_channel.send(embed=embed)
         logger.info("Posted verification success embed.")
 
+    async def close(self):
+        await super().close()
+        db.close()
+
 bot = HandshakeBot()
 
 if __name__ == "__main__":
@@ -0,0 +1,145 @@
+import logging
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from aiohttp import web
+
+from config import METRICS_HOST, METRICS_PORT
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'gmail_bot'
+# Upper bounds in seconds; wide enough for end-to-end mail latency
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+class Histogram:
+    """Fixed-bucket latency histogram (cumulative on export, like Prometheus)."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Estimate a quantile by interpolating inside its bucket."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+_histograms = {}  # stage -> Histogram
+_counters = {}    # (name, labels) -> value
+_gauges = []      # (name, labels, fn) evaluated at scrape time
+
+def observe(stage: str, seconds: float):
+    histogram = _histograms.get(stage)
+    if histogram is None:
+        histogram = _histograms[stage] = Histogram()
+    histogram.observe(seconds)
+
+@contextmanager
+def timed(stage: str):
+    """Record the duration of the block under stage (usable in async code too)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+def inc(name: str, amount: int = 1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    _counters[key] = _counters.get(key, 0) + amount
+
+def register_gauge(name: str, fn, **labels):
+    """fn() returns a number or a dict of numbers (exported with a stat label)."""
+    _gauges.append((name, labels, fn))
+
+def unregister_gauges():
+    _gauges.clear()
+
+def _labels(labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    lines = [f'# TYPE {PREFIX}_stage_seconds histogram']
+    for stage, h in sorted(_histograms.items()):
+        cumulative = 0
+        for bound, n in zip(list(h.buckets) + ['+Inf'], h.counts):
+            cumulative += n
+            lines.append(f'{PREFIX}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+        lines.append(f'{PREFIX}_stage_seconds_sum{{stage="{stage}"}} {h.sum}')
+        lines.append(f'{PREFIX}_stage_seconds_count{{stage="{stage}"}} {h.count}')
+
+    for name in sorted({name for name, _ in _counters}):
+        lines.append(f'# TYPE {PREFIX}_{name}_total counter')
+        for (n, labels), value in sorted(_counters.items()):
+            if n == name:
+                lines.append(f'{PREFIX}_{name}_total{_labels(labels)} {value}')
+
+    for name, labels, fn in _gauges:
+        try:
+            value = fn()
+        except Exception as e:
+            logger.debug(f"Gauge {name} failed: {e}")
+            continue
+        items = value.items() if isinstance(value, dict) else [(None, value)]
+        for stat, v in items:
+            if isinstance(v, (int, float)):
+                all_labels = sorted(labels.items()) + ([('stat', stat)] if stat else [])
+                lines.append(f'{PREFIX}_{name}{_labels(all_labels)} {float(v)}')
+    return '\n'.join(lines) + '\n'
+
+def summary() -> dict:
+    """Per-stage count / p50 / p99 / mean, counters and gauges, for /stats."""
+    stages = {
+        stage: {'count': h.count, 'p50': h.quantile(0.5), 'p99': h.quantile(0.99), 'mean': h.sum / h.count}
+        for stage, h in sorted(_histograms.items()) if h.count
+    }
+    counters = {name + _labels(labels): value for (name, labels), value in sorted(_counters.items())}
+    gauges = {}
+    for name, labels, fn in _gauges:
+        try:
+            gauges[name + _labels(sorted(labels.items()))] = fn()
+        except Exception:
+            pass
+    return {'stages': stages, 'counters': counters, 'gauges': gauges}
+
+class MetricsServer:
+    """Serves render() on /metrics for Prometheus to scrape."""
+
+    def __init__(self, host: str = METRICS_HOST, port: int = METRICS_PORT):
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle_metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=render(), content_type='text/plain', charset='utf-8')
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
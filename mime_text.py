@@ -0,0 +1,109 @@
+import base64
+import codecs
+import re
+from html.parser import HTMLParser
+
+from config import BODY_TEXT_MAX_CHARS
+
+DECODE_CHUNK = 8192  # base64 characters decoded per step (multiple of 4)
+
+_SKIP_TAGS = {'script', 'style', 'head', 'title', 'noscript', 'template'}
+_BLOCK_TAGS = {'br', 'p', 'div', 'tr', 'li', 'ul', 'ol', 'table', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'blockquote'}
+_SPACES = re.compile(r'[ \t\r\f\v\xa0]+')
+_BLANK_LINES = re.compile(r'\n\s*\n+')
+
+def iter_parts(payload, mime_type: str):
+    """Yield body-carrying parts of mime_type, depth-first, without building a list."""
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        if part.get('mimeType') == mime_type and part.get('body', {}).get('data'):
+            yield part
+        elif 'parts' in part:
+            stack.extend(reversed(part['parts']))
+
+def iter_decoded(data: str):
+    """Decode base64url body data incrementally, yielding text chunks."""
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+    for i in range(0, len(data), DECODE_CHUNK):
+        chunk = data[i:i + DECODE_CHUNK]
+        chunk += '=' * (-len(chunk) % 4)
+        yield decoder.decode(base64.urlsafe_b64decode(chunk))
+    yield decoder.decode(b'', final=True)
+
+class _HTMLText(HTMLParser):
+    """Collects visible text from HTML until a character budget is reached."""
+
+    def __init__(self, budget: int):
+        super().__init__(convert_charrefs=True)
+        self.budget = budget
+        self.size = 0
+        self.chunks = []
+        self._skip_depth = 0
+
+    @property
+    def full(self) -> bool:
+        return self.size >= self.budget
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _SKIP_TAGS:
+            self._skip_depth += 1
+        elif tag in _BLOCK_TAGS:
+            self._append('\n')
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in _BLOCK_TAGS:
+            self._append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in _SKIP_TAGS:
+            self._skip_depth = max(0, self._skip_depth - 1)
+        elif tag in _BLOCK_TAGS:
+            self._append('\n')
+
+    def handle_data(self, data):
+        if not self._skip_depth:
+            text = _SPACES.sub(' ', data.replace('\n', ' '))
+            if text.strip():
+                self._append(text)
+
+    def _append(self, text):
+        if not self.full:
+            self.chunks.append(text)
+            self.size += len(text)
+
+    def text(self) -> str:
+        text = _BLANK_LINES.sub('\n\n', ''.join(self.chunks))
+        return '\n'.join(line.strip() for line in text.split('\n')).strip()
+
+def _plain_text(payload, budget: int) -> str:
+    pieces = []
+    size = 0
+    for part in iter_parts(payload, 'text/plain'):
+        if pieces:
+            pieces.append('\n')
+        for text in iter_decoded(part['body']['data']):
+            pieces.append(text)
+            size += len(text)
+            if size >= budget:
+                return ''.join(pieces)[:budget]
+    return ''.join(pieces)
+
+def _html_text(payload, budget: int) -> str:
+    parser = _HTMLText(budget)
+    for part in iter_parts(payload, 'text/html'):
+        for html in iter_decoded(part['body']['data']):
+            parser.feed(html)
+            if parser.full:
+                return parser.text()[:budget]
+    parser.close()
+    return parser.text()[:budget]
+
+def extract_text(payload, budget: int = BODY_TEXT_MAX_CHARS) -> str:
+    """Readable text of a Gmail payload, at most budget characters.
+
+    text/plain parts win; HTML is stripped to text only when there are none.
+    Decoding stops as soon as the budget is filled, so the cost follows the
+    preview size rather than the message size.
+    """
+    return _plain_text(payload, budget) or _html_text(payload, budget)
@@ -1,19 +1,29 @@
 import asyncio
+import functools
 import json
 import logging
-import re
+import time
 from datetime import datetime, timezone
 from google.cloud import pubsub_v1
-from google.api_core.exceptions import NotFound
+from google.api_core.exceptions import NotFound, AlreadyExists
 import discord
 
 from config import (
-    GCP_PROJECT_ID, GCP_SUBSCRIPTION_NAME,
+    GCP_PROJECT_ID, GCP_TOPIC_NAME, GCP_SUBSCRIPTION_NAME, GMAIL_BATCH_THRESHOLD, GMAIL_FETCH_MAX_PASSES,
+    PUBSUB_MAX_MESSAGES, PUBSUB_MAX_BYTES, PUBSUB_MAX_LEASE_DURATION, PUBSUB_MAX_IN_FLIGHT,
+    PUBSUB_RETRY_MIN_BACKOFF, PUBSUB_RETRY_MAX_BACKOFF,
+    PUBSUB_MODE, SYNC_PARALLEL_PAGES, SHARDING_ENABLED, WORKER_ID, WORKER_SUBSCRIPTION_TTL, LEASE_TTL,
     ADMIN_USER_ID, EMOJIS, COLORS, FOOTER_TEXT
 )
-import database as db
-from gmail_api import GmailAPI
-from gmail_views import GmailMessageView
+from gmail_api import NOTIFICATION_FIELDS, HistoryExpiredError
+from gmail_quota import GmailUnavailableError
+from gmail_views import GmailMessageView, remember_message
+from code_extractor import best_code
+from sync_worker import MailboxSyncWorker
+from dispatch_queue import DiscordDispatcher
+from digest import NotificationDigest, DigestEntry
+from resync import ResyncEngine
+import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -22,14 +32,38 @@ DESCRIPTION_MAX = 4000
 FIELD_VALUE_MAX = 1024
 
 class PubSubListener:
-    def __init__(self, bot, gmail_api):
+    """Consumes Gmail notifications for every mailbox in the registry.
+
+    One subscription, dedup cache, event writer and DM dispatcher serve all
+    mailboxes; notifications are routed to a per-mailbox sync worker by
+    their emailAddress. Sharded, every worker has its own subscription to the
+    topic and acks (without syncing) notifications for mailboxes it does not
+    own.
+    """
+
+    def __init__(self, bot, mailboxes, event_writer, seen_messages):
         self.bot = bot
-        self.gmail_api = gmail_api
-        self.subscriber = pubsub_v1.SubscriberClient()
-        self.subscription_path = self.subscriber.subscription_path(GCP_PROJECT_ID, GCP_SUBSCRIPTION_NAME)
+        self.mailboxes = mailboxes
+        self.event_writer = event_writer
+        self.seen_messages = seen_messages
+        self.sync_workers = {}
+        self.subscriber = None  # streaming pull only; created on start()
+        # Sharded workers each see every notification (fan-out), not a share of them
+        subscription = f"{GCP_SUBSCRIPTION_NAME}-{WORKER_ID}" if SHARDING_ENABLED else GCP_SUBSCRIPTION_NAME
+        self.subscription_path = pubsub_v1.SubscriberClient.subscription_path(GCP_PROJECT_ID, subscription)
         self.streaming_pull_future = None
+        self.push_endpoint = None
         self.running = False
         self.admin_user = None
+        self.in_flight = asyncio.Semaphore(PUBSUB_MAX_IN_FLIGHT)
+        # DMs go out through a priority queue so codes overtake bulk mail
+        self.dispatcher = DiscordDispatcher(self.get_admin_user)
+        # ...and are grouped into digests while mail arrives in bursts
+        self.digest = NotificationDigest(self.dispatcher, self._delivered)
+        self._received_at = {}  # message_id -> Gmail internalDate (epoch seconds) until delivered
+        self._pending = {}      # message_id -> (mailbox address, future of the DM outcome) until delivered
+        self._fetch_failures = {}  # message_id -> sync passes its fetch failed in (transient errors)
+        self.resync = ResyncEngine(self)
 
     async def get_admin_user(self):
         """Fetch the admin user (cached)."""
@@ -38,77 +72,222 @@ class PubSubListener:
         return self.admin_user
 
     def callback(self, message):
-        """Synchronous callback from Pub/Sub – schedules async processing on bot's loop."""
-        asyncio.run_coroutine_threadsafe(
-            self.process_notification(message),
+        """Synchronous callback from Pub/Sub – schedules async processing on bot's loop.
+
+        The message is acked only once processing succeeds and nacked (for
+        redelivery) otherwise; the client extends its lease meanwhile. The
+        subscription's retry policy spaces redeliveries out, so a failure that
+        persists (an open circuit, a mailbox mid hand-off) does not spin.
+        """
+        metrics.observe('pubsub_delivery', max(0.0, (datetime.now(timezone.utc) - message.publish_time).total_seconds()))
+        future = asyncio.run_coroutine_threadsafe(
+            self.handle_notification(message.data),
             self.bot.loop
         )
-        message.ack()
+        future.add_done_callback(lambda f: self._settle(message, f))
 
-    async def process_notification(self, pubsub_message):
-        """Process a single notification from Gmail using history."""
+    @staticmethod
+    def _settle(message, future):
         try:
-            data = json.loads(pubsub_message.data.decode('utf-8'))
-            history_id = data.get('historyId')
+            ok = not future.cancelled() and future.result()
+        except Exception as e:
+            logger.error(f"Notification handling raised: {e}")
+            ok = False
+        if ok:
+            message.ack()
+        else:
+            message.nack()
+
+    async def handle_notification(self, data: bytes) -> bool:
+        """Process one notification, bounded by the in-flight limit."""
+        metrics.inc('notifications')
+        async with self.in_flight:
+            with metrics.timed('notification'):
+                return await self.process_notification(data)
+
+    async def process_notification(self, raw_data: bytes) -> bool:
+        """Process a single notification from Gmail using history.
+
+        Returns True when the notification is handled (or can never be) and
+        False when it should be redelivered.
+        """
+        try:
+            data = json.loads(raw_data.decode('utf-8'))
+            history_id = int(data['historyId'])
             email = data.get('emailAddress')
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error(f"Dropping malformed notification: {e}")
+            return True
+
+        mailbox = self.mailboxes.get(email)
+        if mailbox is None:
+            logger.warning(f"Dropping notification for unknown mailbox {email}")
+            return True
+        if not self.mailboxes.owns(mailbox):
+            logger.debug(f"Ignoring notification for {email}, owned by another worker")
+            return True
+
+        try:
             logger.info(f"Received notification for {email}, historyId: {history_id}")
 
-            # Get the last stored history ID
-            record = db.get_watch_record()
-            if not record:
-                logger.warning("No watch record found, skipping history fetch.")
-                return
-            last_history_id = record[1]
+            # Only raise the mailbox's watermark; its worker does the actual sync
+            return await self.get_sync_worker(mailbox).notify(history_id)
 
-            # Ignore notifications that are older than our last processed history ID
-            if history_id <= last_history_id:
-                logger.debug(f"Ignoring old notification: history_id {history_id} <= {last_history_id}")
-                return
+        except Exception as e:
+            logger.error(f"Error processing notification: {e}", exc_info=True)
+            return False
 
-            # Fetch history since last_history_id + 1
-            loop = asyncio.get_event_loop()
-            service = self.gmail_api.service
+    def get_sync_worker(self, mailbox):
+        """Return the single-flight sync worker for a mailbox."""
+        email = mailbox.email_address
+        worker = self.sync_workers.get(email)
+        if worker is None:
+            worker = MailboxSyncWorker(email, functools.partial(self.sync_history, mailbox), mailbox.history_cursor)
+            self.sync_workers[email] = worker
+        return worker
+
+    async def sync_history(self, mailbox, target_history_id):
+        """Process all of a mailbox's history after its cursor (one pass, run by its sync worker)."""
+        # Last processed history ID (kept in memory, checkpointed separately)
+        history_cursor = mailbox.history_cursor
+        last_history_id = history_cursor.value
+        if last_history_id is None:
+            logger.warning(f"No watch record found for {mailbox.email_address}, skipping history fetch.")
+            return False
+        if target_history_id <= last_history_id:
+            return True
+
+        # Stream every history page after last_history_id, handling
+        # messages while later pages are still being fetched
+        stream = mailbox.gmail_api.stream_history(last_history_id)
+        try:
+            with metrics.timed('history_sync'):
+                ok = await self.process_pages(mailbox, stream.pages(), self.resync.active(mailbox))
+        except HistoryExpiredError:
+            # Too old for history.list (long downtime): fall back to a search by date
+            return await self.resync.recover_expired(mailbox)
+        except Exception as e:
+            logger.error(f"Failed to fetch history: {e}")
+            return False
+        if not ok:
+            # Keep the cursor so a redelivery retries; handled messages are deduped
+            return False
+
+        # Move the cursor to where Gmail says the history ends (the notification's
+        # historyId only decides whether to sync); the checkpoint task persists it
+        if stream.history_id is not None:
+            history_cursor.advance(stream.history_id)
+        return True
+
+    async def process_pages(self, mailbox, pages, progress=None):
+        """Process pages of message IDs, up to SYNC_PARALLEL_PAGES of them at once.
+
+        Returns False if any page failed or the mailbox stopped being owned
+        by this worker mid-way.
+        """
+        slots = asyncio.Semaphore(SYNC_PARALLEL_PAGES)
+        tasks = []
+
+        async def run(message_ids):
             try:
-                history_response = await loop.run_in_executor(
-                    None,
-                    lambda: service.users().history().list(
-                        userId='me',
-                        startHistoryId=last_history_id + 1,
-                        historyTypes=['messageAdded']
-                    ).execute()
-                )
-            except Exception as e:
-                logger.error(f"Failed to fetch history: {e}")
-                return
+                return await self.process_messages(mailbox, message_ids, progress)
+            finally:
+                slots.release()
 
-            histories = history_response.get('history', [])
-            for hist in histories:
-                messages_added = hist.get('messagesAdded', [])
-                for msg_added in messages_added:
-                    msg = msg_added.get('message')
-                    if msg:
-                        msg_id = msg['id']
-                        await self.process_message(msg_id)
+        try:
+            async for message_ids in pages:
+                if not self.mailboxes.owns(mailbox):
+                    # Lease lost mid-pass; the new owner resumes from the stored cursor
+                    logger.info(f"Stopping sync of {mailbox.email_address}: no longer owned")
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                    return False
+                await slots.acquire()
+                tasks.append(asyncio.create_task(run(message_ids)))
+        except asyncio.CancelledError:
+            for task in tasks:
+                task.cancel()
+            raise
+        except Exception:
+            # Let the pages already started finish before reporting the error
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        return all(await asyncio.gather(*tasks))
 
-            # Update stored history ID to the latest one
-            db.update_history_id(history_id)
+    async def process_messages(self, mailbox, message_ids, progress=None):
+        """Process a page of messages, skipping ones already notified.
 
-        except Exception as e:
-            logger.error(f"Error processing notification: {e}", exc_info=True)
+        Fetches are batched when there are many. Returns once every DM of the
+        page has been sent or given up, False if any message failed or its DM
+        could not be sent; those (and, if the page is cut short by an error,
+        every message not yet handed on) are forgotten by the dedup cache so
+        the retried pass picks them up.
+        """
+        listed = len(message_ids)
+        message_ids = await self.seen_messages.claim(message_ids)
+        handled = set()  # queued for a DM, or skipped for good
+        try:
+            if len(message_ids) < GMAIL_BATCH_THRESHOLD:
+                for message_id in message_ids:
+                    if await self.process_message(mailbox, message_id):
+                        handled.add(message_id)
+            else:
+                batch = mailbox.gmail_api.get_messages_batch(message_ids, fields=NOTIFICATION_FIELDS)
+                async for message_id, msg, error in batch:
+                    if error is not None and not self._transient(mailbox, error):
+                        self._fetch_failed(mailbox, message_id, error)  # skipped for good
+                        handled.add(message_id)
+                        continue
+                    if error is not None:
+                        logger.warning(f"Batch fetch failed for {message_id} ({error}), retrying individually")
+                        msg = None
+                    else:
+                        msg = mailbox.gmail_api.trim_headers(msg)
+                    if await self.process_message(mailbox, message_id, msg):
+                        handled.add(message_id)
 
-    async def process_message(self, message_id):
-        """Fetch full message and send to admin."""
-        msg = await self.gmail_api.get_message_metadata(message_id)
-        if not msg:
-            return
+            # Hold the pass until Discord has the DMs: only then may the cursor move
+            # past these messages and the notification be acked. Mail held for a
+            # digest is left to its timer, so bursts still group into one DM.
+            deliveries = [
+                (m, self._pending[m][1]) for m in handled if m in self._pending and not self.digest.holds(m)
+            ]
+            if deliveries:
+                await asyncio.wait([future for _, future in deliveries])
+                handled.difference_update(message_id for message_id, future in deliveries if not future.result())
+        finally:
+            for message_id in message_ids:
+                if message_id not in handled:
+                    self.seen_messages.discard(message_id)
+
+        failed = len(message_ids) - len(handled)
+        metrics.inc('messages', len(handled), status='processed')
+        metrics.inc('messages', failed, status='failed')
+        if progress:
+            progress.add(listed, len(handled), failed)
+        return not failed
+
+    async def process_message(self, mailbox, message_id, msg=None):
+        """Fetch the message (unless already fetched) and queue its DM to admin.
+
+        The DM's outcome resolves the message's future in _pending.
+        """
+        if msg is None:
+            try:
+                with metrics.timed('message_get'):
+                    msg = await mailbox.gmail_api.fetch_message(message_id, raise_errors=True)
+            except Exception as e:
+                return self._fetch_failed(mailbox, message_id, e)
+        self._fetch_failures.pop(message_id, None)
+        if 'internalDate' in msg:
+            self._received_at[message_id] = int(msg['internalDate']) / 1000
 
         headers = {h['name']: h['value'] for h in msg['payload']['headers']}
         from_email = headers.get('From', 'Unknown')
         subject = headers.get('Subject', '(no subject)')
         snippet = msg.get('snippet', '')
 
-        full_msg = await self.gmail_api.get_message(message_id)
-        body_text = self.gmail_api.extract_body_text(full_msg) if full_msg else ''
+        with metrics.timed('body_extract'):
+            body_text = mailbox.gmail_api.extract_body_text(msg)
 
         # Truncate for display
         if len(snippet) > 500:
@@ -118,28 +297,35 @@ class PubSubListener:
         else:
             body_preview = body_text
 
-        # Detect codes
-        code_match = re.search(r'\b\d{6,8}\b', body_text) or re.search(r'\b[A-Z0-9]{8,}\b', body_text)
-        has_code = bool(code_match)
+        # Detect codes (once; the view reuses the result)
+        with metrics.timed('code_detect'):
+            code = best_code(body_text)
+        has_code = code is not None
 
-        db.log_gmail_event(
+        self.event_writer.log_gmail_event(
             message_id=message_id,
             thread_id=msg['threadId'],
             from_email=from_email,
             subject=subject,
             snippet=snippet,
             body_preview=body_preview,
-            has_code=has_code
+            has_code=has_code,
+            code=code,
+            email_address=mailbox.email_address
         )
 
-        admin = await self.get_admin_user()
-        if not admin:
-            logger.error("Admin user not found")
-            return
+        remember_message(message_id, msg['threadId'], code, mailbox.email_address)
+        priority = self.dispatcher.priority_for(from_email, msg.get('labelIds'), has_code)
+        if message_id not in self._pending:
+            self._pending[message_id] = (mailbox.email_address, asyncio.get_running_loop().create_future())
+        if self.digest.offer(DigestEntry(message_id, from_email, subject, priority)):
+            return True
 
+        # Say which account it arrived in once there is more than one
+        to_line = f"**To:** {mailbox.email_address}\n" if len(self.mailboxes) > 1 else ''
         embed = discord.Embed(
             title=f"{EMOJIS['mail']} New Email",
-            description=f"**From:** {from_email}\n**Subject:** {subject}\n\n{snippet}",
+            description=f"**From:** {from_email}\n{to_line}**Subject:** {subject}\n\n{snippet}",
             color=COLORS['gmail'],
             timestamp=datetime.now(timezone.utc)
         )
@@ -152,24 +338,98 @@ class PubSubListener:
         if has_code:
             embed.add_field(name="Code Detected", value="This message may contain a verification code.", inline=False)
 
-        view = GmailMessageView(message_id, msg['threadId'], body_text)
-        await admin.send(embed=embed, view=view)
+        view = GmailMessageView(message_id, msg['threadId'], code)
+        self.dispatcher.submit(priority, message_id, on_done=self._delivered, embed=embed, view=view)
+        return True
+
+    @staticmethod
+    def _transient(mailbox, error) -> bool:
+        return isinstance(error, GmailUnavailableError) or mailbox.gmail_api.quota.retryable(error)
 
-        db.mark_notified(message_id)
+    def _fetch_failed(self, mailbox, message_id, error) -> bool:
+        """A message could not be fetched: True to skip it for good, False to retry it next pass.
+
+        Permanent errors (e.g. 404 for mail deleted before the fetch) are
+        skipped at once, transient ones after GMAIL_FETCH_MAX_PASSES passes,
+        so one message can never hold the cursor back forever.
+        """
+        passes = self._fetch_failures.pop(message_id, 0) + 1
+        if self._transient(mailbox, error) and passes < GMAIL_FETCH_MAX_PASSES:
+            self._fetch_failures[message_id] = passes
+            logger.warning(f"Could not fetch {message_id} ({error}), retrying on the next pass")
+            return False
+        logger.warning(f"Skipping message {message_id} in {mailbox.email_address}: {error}")
+        metrics.inc('messages', status='skipped')
+        return True
+
+    def _delivered(self, message_id, ok):
+        """Dispatcher callback: record the DM, or let a later sync retry it."""
+        received_at = self._received_at.pop(message_id, None)
+        pending = self._pending.pop(message_id, None)
+        if pending and not pending[1].done():
+            pending[1].set_result(ok)
+        if ok:
+            self.event_writer.mark_notified(message_id)
+            if received_at is not None:
+                # Mail received by Gmail -> DM delivered
+                metrics.observe('end_to_end', max(0.0, time.time() - received_at))
+        else:
+            self.seen_messages.discard(message_id)
+
+    async def adopt_mailbox(self, email_address: str):
+        """Lease acquired: reload the cursor the previous owner left and catch up from it."""
+        mailbox = self.mailboxes.get(email_address)
+        await mailbox.history_cursor.load()
+        await mailbox.start()
+        # Notifications that arrived while nobody owned the mailbox were acked
+        # and dropped; a resync up to its current historyId picks their mail up.
+        asyncio.create_task(self.resync.resync(mailbox))
+
+    async def release_mailbox(self, email_address: str, timeout: float = LEASE_TTL):
+        """Lease given up: stop syncing, deliver what is queued, persist ledger and cursor.
+
+        The next owner resumes from the checkpointed cursor and skips every
+        message marked notified here, so nothing is delivered twice.
+        """
+        mailbox = self.mailboxes.get(email_address)
+        worker = self.sync_workers.pop(email_address, None)
+        if worker:
+            await worker.stop()
+        pending = [(m, future) for m, (email, future) in self._pending.items() if email == email_address]
+        if pending:
+            # Handing off is rare: send held mail now rather than after the lease is gone
+            if any(self.digest.holds(m) for m, _ in pending):
+                self.digest.flush()
+            await asyncio.wait([future for _, future in pending], timeout=timeout)
+        await self.event_writer.flush()
+        await mailbox.stop()
 
     async def start(self):
         """Start the Pub/Sub listener."""
         if self.running:
             return
         self.running = True
+        if PUBSUB_MODE == 'push':
+            await self._start_push()
+            return
         try:
+            self.subscriber = pubsub_v1.SubscriberClient()
+            loop = asyncio.get_event_loop()
+            if SHARDING_ENABLED:
+                await loop.run_in_executor(None, self._ensure_subscription)
+            await loop.run_in_executor(None, self._ensure_retry_policy)
+            flow_control = pubsub_v1.types.FlowControl(
+                max_messages=PUBSUB_MAX_MESSAGES,
+                max_bytes=PUBSUB_MAX_BYTES,
+                max_lease_duration=PUBSUB_MAX_LEASE_DURATION
+            )
             self.streaming_pull_future = self.subscriber.subscribe(
                 self.subscription_path,
-                callback=self.callback
+                callback=self.callback,
+                flow_control=flow_control
             )
             logger.info(f"Listening for messages on {self.subscription_path}")
             # Blocking call – run in a separate thread
-            loop = asyncio.get_event_loop()
             await loop.run_in_executor(None, self._run_streaming_pull)
         except NotFound:
             logger.error(f"Subscription {self.subscription_path} not found")
@@ -178,6 +438,60 @@ class PubSubListener:
         finally:
             self.running = False
 
+    def _ensure_subscription(self):
+        """Create this worker's subscription to the topic if it does not exist yet."""
+        topic = pubsub_v1.PublisherClient.topic_path(GCP_PROJECT_ID, GCP_TOPIC_NAME)
+        try:
+            self.subscriber.create_subscription(request={
+                'name': self.subscription_path,
+                'topic': topic,
+                'ack_deadline_seconds': 60,
+                # Deleted by Pub/Sub once the worker is gone for good
+                'expiration_policy': {'ttl': {'seconds': WORKER_SUBSCRIPTION_TTL}},
+                'retry_policy': self._retry_policy(),
+            })
+            logger.info(f"Created worker subscription {self.subscription_path}")
+        except AlreadyExists:
+            pass
+
+    @staticmethod
+    def _retry_policy():
+        return {
+            'minimum_backoff': {'seconds': PUBSUB_RETRY_MIN_BACKOFF},
+            'maximum_backoff': {'seconds': PUBSUB_RETRY_MAX_BACKOFF},
+        }
+
+    def _ensure_retry_policy(self):
+        """Give the subscription a redelivery backoff if it has none (Pub/Sub would redeliver nacks at once)."""
+        try:
+            subscription = self.subscriber.get_subscription(request={'subscription': self.subscription_path})
+            if 'retry_policy' in subscription:
+                return  # keep whatever the operator configured
+            self.subscriber.update_subscription(request={
+                'subscription': {'name': self.subscription_path, 'retry_policy': self._retry_policy()},
+                'update_mask': {'paths': ['retry_policy']},
+            })
+            logger.info(f"Set redelivery backoff on {self.subscription_path}")
+        except NotFound:
+            raise
+        except Exception as e:
+            logger.warning(f"Could not set a retry policy on {self.subscription_path} ({e}); "
+                           f"failed notifications will be redelivered immediately")
+
+    async def _start_push(self):
+        """Serve Pub/Sub push deliveries instead of streaming pull (no gRPC threads)."""
+        from pubsub_push import PushEndpoint
+        try:
+            if SHARDING_ENABLED:
+                # A push reaches one worker only; one that does not own the mailbox
+                # would ack it and the notification would be lost
+                raise ValueError("push mode cannot be used with SHARDING_ENABLED; use PUBSUB_MODE = 'pull'")
+            self.push_endpoint = PushEndpoint(self.handle_notification)
+            await self.push_endpoint.start()
+        except Exception as e:
+            logger.error(f"Pub/Sub push endpoint error: {e}")
+            self.running = False
+
     def _run_streaming_pull(self):
         """Run the streaming pull future (blocks). This runs in a thread."""
         try:
@@ -189,4 +503,11 @@ class PubSubListener:
         """Stop the listener."""
         if self.streaming_pull_future:
             self.streaming_pull_future.cancel()
+        if self.push_endpoint:
+            await self.push_endpoint.stop()
+            self.push_endpoint = None
+        for worker in self.sync_workers.values():
+            await worker.stop()
+        await self.digest.close()
+        await self.dispatcher.close()
         self.running = False
\ No newline at end of file
@@ -0,0 +1,96 @@
+import asyncio
+import base64
+import logging
+import time
+from aiohttp import web
+from google.auth.transport.requests import Request
+from google.oauth2 import id_token
+
+from config import (
+    PUBSUB_PUSH_HOST, PUBSUB_PUSH_PORT, PUBSUB_PUSH_PATH,
+    PUBSUB_PUSH_AUDIENCE, PUBSUB_PUSH_SERVICE_ACCOUNT, PUBSUB_PUSH_VERIFY_TOKEN
+)
+
+logger = logging.getLogger(__name__)
+
+class PushEndpoint:
+    """Embedded HTTP endpoint receiving Pub/Sub push deliveries.
+
+    Each POST carries one message; a 204 acks it, any error status makes
+    Pub/Sub redeliver it with backoff.
+    """
+
+    def __init__(self, handler, host: str = PUBSUB_PUSH_HOST, port: int = PUBSUB_PUSH_PORT,
+                 path: str = PUBSUB_PUSH_PATH, verify_token: bool = PUBSUB_PUSH_VERIFY_TOKEN,
+                 audience: str = PUBSUB_PUSH_AUDIENCE, service_account: str = PUBSUB_PUSH_SERVICE_ACCOUNT):
+        self.handler = handler  # async (data: bytes) -> bool
+        self.host = host
+        self.port = port
+        self.path = path
+        self.verify_token = verify_token
+        self.audience = audience
+        self.service_account = service_account
+        self._runner = None
+        self._verified = {}  # token -> expiry; Pub/Sub reuses a token for about an hour
+
+    async def start(self):
+        # Any Google-signed token passes the signature check; only the audience and
+        # signer tie it to our subscription, so never serve without both.
+        if self.verify_token and not (self.audience and self.service_account):
+            raise ValueError("PUBSUB_PUSH_AUDIENCE and PUBSUB_PUSH_SERVICE_ACCOUNT must both be set "
+                             "to serve Pub/Sub push")
+        if not self.verify_token:
+            logger.warning("Pub/Sub push token verification is disabled; anyone reaching the endpoint can post")
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_push)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"Listening for Pub/Sub push on http://{self.host}:{self.port}{self.path}")
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def handle_push(self, request: web.Request) -> web.Response:
+        if self.verify_token and not await self._authorized(request):
+            return web.Response(status=403)
+        try:
+            envelope = await request.json()
+            data = base64.b64decode(envelope['message']['data'])
+        except (ValueError, KeyError, TypeError) as e:
+            # Malformed deliveries can never succeed – ack them.
+            logger.error(f"Dropping malformed push delivery: {e}")
+            return web.Response(status=204)
+
+        ok = await self.handler(data)
+        return web.Response(status=204 if ok else 503)
+
+    async def _authorized(self, request: web.Request) -> bool:
+        """Verify the OIDC bearer token Pub/Sub attaches to push requests."""
+        auth = request.headers.get('Authorization', '')
+        if not auth.startswith('Bearer '):
+            logger.warning("Push request without bearer token")
+            return False
+        token = auth[len('Bearer '):]
+
+        now = time.time()
+        if self._verified.get(token, 0) > now:
+            return True
+
+        loop = asyncio.get_running_loop()
+        try:
+            claims = await loop.run_in_executor(
+                None, lambda: id_token.verify_oauth2_token(token, Request(), audience=self.audience)
+            )
+        except ValueError as e:
+            logger.warning(f"Rejected push token: {e}")
+            return False
+        if claims.get('email') != self.service_account or not claims.get('email_verified'):
+            logger.warning(f"Rejected push token for {claims.get('email')}")
+            return False
+
+        self._verified = {t: exp for t, exp in self._verified.items() if exp > now}
+        self._verified[token] = claims.get('exp', now)
+        return True
@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import time
+
+from config import (
+    GMAIL_HISTORY_PAGE_SIZE,
+    RESYNC_WINDOW, RESYNC_WINDOW_MARGIN, RESYNC_MAX_MESSAGES, RESYNC_PROGRESS_INTERVAL
+)
+import database as db
+import metrics
+
+logger = logging.getLogger(__name__)
+
+class ResyncProgress:
+    """Counters for one mailbox's catch-up."""
+
+    def __init__(self, email_address: str):
+        self.email_address = email_address
+        self.mode = 'history'  # 'window' once the stored history ID turned out to be expired
+        self.target = None     # historyId being caught up to
+        self.pages = 0
+        self.listed = 0        # message IDs seen in history / the search
+        self.processed = 0     # ...that were new and got notified
+        self.failed = 0
+        self.started = time.monotonic()
+        self.finished = None
+        self.ok = None
+
+    def add(self, listed: int, processed: int, failed: int):
+        self.pages += 1
+        self.listed += listed
+        self.processed += processed
+        self.failed += failed
+
+    def finish(self, ok: bool):
+        self.finished = time.monotonic()
+        self.ok = bool(ok)
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def rate(self) -> float:
+        """Messages scanned per second."""
+        return self.listed / self.elapsed if self.elapsed > 0 else 0.0
+
+    def __str__(self):
+        state = 'running' if self.finished is None else ('done' if self.ok else 'failed')
+        return (f"{self.email_address}: {state} ({self.mode}), {self.pages} pages, "
+                f"{self.listed} scanned, {self.processed} new, {self.failed} failed, "
+                f"{self.rate:.0f} msg/s in {self.elapsed:.1f}s")
+
+class ResyncEngine:
+    """Catches mailboxes up after downtime: at startup, on /resync and on expired history.
+
+    A resync is an ordinary sync pass up to the mailbox's current historyId,
+    run by its single-flight sync worker so it never races notification
+    syncs; while it runs, the listener reports its pages here. When the
+    stored history ID has expired, recover_expired() lists recent mail by
+    date instead and lets the ledger drop what was already notified.
+    """
+
+    def __init__(self, listener, window: float = RESYNC_WINDOW, window_margin: float = RESYNC_WINDOW_MARGIN,
+                 max_messages: int = RESYNC_MAX_MESSAGES, progress_interval: float = RESYNC_PROGRESS_INTERVAL):
+        self.listener = listener
+        self.window = window
+        self.window_margin = window_margin
+        self.max_messages = max_messages
+        self.progress_interval = progress_interval
+        self.progress = {}  # email -> ResyncProgress of the current or last resync
+
+    def active(self, mailbox):
+        """The running resync's progress for a mailbox, if any."""
+        progress = self.progress.get(mailbox.email_address)
+        return progress if progress and progress.finished is None else None
+
+    async def resync(self, mailbox) -> ResyncProgress:
+        """Sync a mailbox up to its current historyId."""
+        progress = ResyncProgress(mailbox.email_address)
+        self.progress[mailbox.email_address] = progress
+        ok = False
+        try:
+            profile = await mailbox.gmail_api.get_user_profile()
+            if not profile:
+                logger.error(f"Resync of {mailbox.email_address}: could not read its profile")
+            elif mailbox.history_cursor.value is None:
+                logger.warning(f"Resync of {mailbox.email_address}: no history cursor yet, start its watch first")
+            else:
+                progress.target = int(profile['historyId'])
+                ok = await self.listener.get_sync_worker(mailbox).notify(progress.target)
+        finally:
+            progress.finish(ok)
+        metrics.inc('resyncs', mode=progress.mode, status='ok' if ok else 'failed')
+        logger.info(f"Resync {progress}")
+        return progress
+
+    async def resync_all(self, mailboxes, on_progress=None):
+        """Resync mailboxes concurrently, reporting progress every progress_interval.
+
+        on_progress is an optional coroutine called with the list of
+        ResyncProgress while the resync runs.
+        """
+        mailboxes = list(mailboxes)
+        task = asyncio.ensure_future(asyncio.gather(*(self.resync(mailbox) for mailbox in mailboxes)))
+        while not task.done():
+            await asyncio.wait({task}, timeout=self.progress_interval)
+            if task.done():
+                break
+            running = [self.progress[m.email_address] for m in mailboxes if m.email_address in self.progress]
+            for progress in running:
+                if progress.finished is None:
+                    logger.info(f"Resync {progress}")
+            if on_progress:
+                try:
+                    await on_progress(running)
+                except Exception as e:
+                    logger.warning(f"Resync progress callback failed: {e}")
+        return task.result()
+
+    async def recover_expired(self, mailbox) -> bool:
+        """The stored history ID is gone: notify recent mail found by date, then restart history from now.
+
+        Lists at most max_messages IDs received since the mailbox's newest
+        ledger row (less a margin, and no more than window ago); the dedup
+        cache and gmail_events drop the ones already notified.
+        """
+        email = mailbox.email_address
+        progress = self.active(mailbox)
+        if progress:
+            progress.mode = 'window'
+        # Read first: anything newer arrives through history.list from here on
+        profile = await mailbox.gmail_api.get_user_profile()
+        if not profile:
+            return False
+
+        since = time.time() - self.window
+        last_event = await db.get_last_event_time_async(email)
+        if last_event:
+            since = max(since, last_event - self.window_margin)
+        query = f"after:{int(since)}"
+        logger.warning(f"History for {email} expired; resyncing mail matching '{query}' (at most {self.max_messages})")
+
+        message_ids = []
+        try:
+            async for ids in mailbox.gmail_api.search_message_ids(query, self.max_messages):
+                message_ids.extend(ids)
+        except Exception as e:
+            logger.error(f"Failed to list messages for {email}: {e}")
+            return False
+        message_ids.reverse()  # oldest first
+
+        async def pages():
+            for i in range(0, len(message_ids), GMAIL_HISTORY_PAGE_SIZE):
+                yield message_ids[i:i + GMAIL_HISTORY_PAGE_SIZE]
+
+        if not await self.listener.process_pages(mailbox, pages(), progress):
+            return False
+        mailbox.history_cursor.advance(int(profile['historyId']))
+        logger.info(f"History for {email} restarted at {mailbox.history_cursor.value}")
+        return True
@@ -0,0 +1,78 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+class MailboxSyncWorker:
+    """Runs history syncs for one mailbox, strictly one at a time.
+
+    Notifications only raise a target historyId watermark. Every notification
+    that arrives while a pass is running is folded into the next pass, so a
+    burst of N notifications costs at most two history syncs.
+    """
+
+    def __init__(self, email: str, sync_pass, history_cursor):
+        self.email = email
+        self._sync_pass = sync_pass  # async (target_history_id) -> bool
+        self.history_cursor = history_cursor
+        self.target = 0
+        self.passes = 0
+        self.notifications = 0
+        self._waiters = []  # futures resolved when the pass covering them ends
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def notify(self, history_id: int) -> asyncio.Future:
+        """Raise the watermark; the returned future resolves to True once synced."""
+        self.notifications += 1
+        future = asyncio.get_running_loop().create_future()
+        cursor = self.history_cursor.value
+        if cursor is not None and history_id <= cursor:
+            logger.debug(f"Ignoring old notification: history_id {history_id} <= {cursor}")
+            future.set_result(True)
+            return future
+
+        self.target = max(self.target, history_id)
+        self._waiters.append(future)
+        self._wakeup.set()
+        self.start()
+        return future
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            waiters, self._waiters = self._waiters, []
+            target = self.target
+            self.passes += 1
+            try:
+                ok = await self._sync_pass(target)
+            except asyncio.CancelledError:
+                # stop() mid-pass: the pass's notifications were not handled
+                self._waiters = waiters + self._waiters
+                raise
+            except Exception as e:
+                logger.error(f"History sync for {self.email} failed: {e}", exc_info=True)
+                ok = False
+            if len(waiters) > 1:
+                logger.debug(f"Coalesced {len(waiters)} notifications for {self.email} into one sync")
+            for future in waiters:
+                if not future.done():
+                    future.set_result(bool(ok))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for future in self._waiters:
+            if not future.done():
+                future.set_result(False)
+        self._waiters = []
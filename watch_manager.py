@@ -1,30 +1,32 @@
-import asyncio
 import logging
-from datetime import datetime, timezone, timedelta
 from googleapiclient.errors import HttpError
 
-from config import GCP_TOPIC_NAME
+from config import GCP_PROJECT_ID, GCP_TOPIC_NAME
 import database as db
-from gmail_api import GmailAPI
 
 logger = logging.getLogger(__name__)
 
 class WatchManager:
-    def __init__(self, bot, gmail_api):
+    def __init__(self, bot, gmail_api, history_cursor, email_address):
         self.bot = bot
         self.gmail_api = gmail_api
-        self._task = None
-        self.topic_name = f"projects/exemplary-torch-470317-i1/topics/{GCP_TOPIC_NAME}"
+        self.history_cursor = history_cursor
+        self.email_address = email_address
+        self.expiration = None  # epoch ms of the current watch, once known
+        # Every mailbox publishes to the same topic; notifications carry emailAddress
+        self.topic_name = f"projects/{GCP_PROJECT_ID}/topics/{GCP_TOPIC_NAME}"
 
     async def start_watch(self):
         """Start or renew the Gmail watch."""
         try:
             response = await self.gmail_api.start_watch(self.topic_name)
             if response:
-                expiration = int(response['expiration'])
-                history_id = int(response['historyId'])
-                db.set_watch_record(expiration, history_id)
-                logger.info(f"Watch started, expires at {expiration} (timestamp)")
+                expiration = self.expiration = int(response['expiration'])
+                # Keep an existing cursor so a renewal never skips unprocessed history
+                if self.history_cursor.value is None:
+                    self.history_cursor.advance(int(response['historyId']))
+                await db.set_watch_record_async(self.email_address, expiration, self.history_cursor.value)
+                logger.info(f"Watch for {self.email_address} started, expires at {expiration} (timestamp)")
                 return True
         except HttpError as e:
             logger.error(f"Failed to start watch: {e}")
@@ -33,39 +35,10 @@ class WatchManager:
     async def stop_watch(self):
         """Stop the watch (cleanup)."""
         await self.gmail_api.stop_watch()
-        logger.info("Watch stopped")
+        logger.info(f"Watch for {self.email_address} stopped")
 
-    async def check_and_renew(self):
-        """Check if watch is expiring soon and renew."""
-        record = db.get_watch_record()
-        if not record:
-            # No watch, start one
-            logger.info("No watch record found, starting...")
-            await self.start_watch()
-            return
-
-        expiration, history_id, created_at = record
-        # expiration is a Unix timestamp in milliseconds
-        now = datetime.now(timezone.utc)
-        exp_time = datetime.fromtimestamp(expiration / 1000, tz=timezone.utc)
-        # Renew if within 1 day of expiry
-        if exp_time - now < timedelta(days=1):
-            logger.info(f"Watch expiring soon at {exp_time}, renewing...")
-            await self.start_watch()
-        else:
-            logger.debug(f"Watch valid until {exp_time}")
-
-    async def run_periodic_check(self):
-        """Background task that checks every 6 hours."""
-        await self.bot.wait_until_ready()
-        while not self.bot.is_closed():
-            try:
-                await self.check_and_renew()
-            except Exception as e:
-                logger.error(f"Error in watch renewal: {e}")
-            await asyncio.sleep(6 * 3600)  # 6 hours
-
-    def start_background_task(self):
-        """Start the periodic check task."""
-        if self._task is None or self._task.done():
-            self._task = asyncio.create_task(self.run_periodic_check())
\ No newline at end of file
+    async def load_expiration(self):
+        """Read the stored watch expiration (epoch ms), or None if there is no watch."""
+        record = await db.get_watch_record_async(self.email_address)
+        self.expiration = record[0] if record else None
+        return self.expiration
@@ -0,0 +1,164 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import time
+
+from config import (
+    WATCH_RENEW_BEFORE, WATCH_RENEW_JITTER, WATCH_RENEW_CONCURRENCY,
+    WATCH_RETRY_BASE, WATCH_RETRY_MAX
+)
+import gmail_quota
+
+logger = logging.getLogger(__name__)
+
+class _Watch:
+    __slots__ = ('manager', 'seq', 'due', 'failures')
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.seq = None   # heap entry that is current; None while renewing
+        self.due = None
+        self.failures = 0  # consecutive
+
+class WatchScheduler:
+    """Renews every mailbox's Gmail watch shortly before it expires.
+
+    One heap of (due time, mailbox) for all watches: each is due
+    WATCH_RENEW_BEFORE ahead of its expiration, less up to WATCH_RENEW_JITTER
+    so watches created together do not renew together. A single task sleeps
+    until the earliest due time (or until an earlier one is added), so
+    nothing is polled. Renewals run up to WATCH_RENEW_CONCURRENCY at a time;
+    a failed one is retried with jittered exponential backoff.
+    """
+
+    def __init__(self, renew_before: float = WATCH_RENEW_BEFORE, jitter: float = WATCH_RENEW_JITTER,
+                 concurrency: int = WATCH_RENEW_CONCURRENCY, retry_base: float = WATCH_RETRY_BASE,
+                 retry_max: float = WATCH_RETRY_MAX):
+        self.renew_before = renew_before
+        self.jitter = jitter
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self._heap = []     # (due, seq, email); entries not matching _watches are stale
+        self._watches = {}  # email -> _Watch
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._renewing = set()
+        self._task = None
+        self.renewals = 0
+        self.failures = 0
+
+    def __len__(self) -> int:
+        return len(self._watches)
+
+    async def add(self, watch_manager):
+        """Schedule a mailbox's watch from its stored expiration (renewed at once if there is none)."""
+        watch = _Watch(watch_manager)
+        self._watches[watch_manager.email_address] = watch
+        expiration = await watch_manager.load_expiration()
+        if self._watches.get(watch_manager.email_address) is watch and watch.seq is None:
+            self._schedule_expiration(watch, expiration)
+
+    def remove(self, email_address: str):
+        """Stop renewing a mailbox's watch (its heap entry is skipped when it comes up)."""
+        self._watches.pop(email_address, None)
+
+    def renewed(self, watch_manager):
+        """A watch was (re)started outside the scheduler: move it to its new expiration."""
+        watch = self._watches.get(watch_manager.email_address)
+        if watch and watch.seq is not None:
+            self._schedule_expiration(watch, watch_manager.expiration)
+
+    def _schedule_expiration(self, watch, expiration):
+        if expiration is None:
+            due = time.time()
+        else:
+            due = expiration / 1000 - self.renew_before - random.uniform(0, self.jitter)
+        self._push(watch, due)
+
+    def _push(self, watch, due: float):
+        watch.seq = next(self._seq)
+        watch.due = due
+        heapq.heappush(self._heap, (due, watch.seq, watch.manager.email_address))
+        self._wakeup.set()
+
+    def _peek(self):
+        """Earliest current entry, dropping stale ones."""
+        while self._heap:
+            due, seq, email = self._heap[0]
+            watch = self._watches.get(email)
+            if watch is not None and watch.seq == seq:
+                return watch
+            heapq.heappop(self._heap)
+        return None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            watch = self._peek()
+            if watch is None:
+                await self._wakeup.wait()
+                continue
+            delay = watch.due - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self._heap)
+            watch.seq = None
+            task = asyncio.create_task(self._renew(watch))
+            self._renewing.add(task)
+            task.add_done_callback(self._renewing.discard)
+
+    async def _renew(self, watch):
+        email = watch.manager.email_address
+        async with self._semaphore:
+            if self._watches.get(email) is not watch:
+                return
+            try:
+                # Renewals run a day early and can wait behind notification traffic
+                with gmail_quota.priority(gmail_quota.BULK):
+                    ok = await watch.manager.start_watch()
+            except Exception as e:
+                logger.error(f"Error renewing watch for {email}: {e}")
+                ok = False
+        if self._watches.get(email) is not watch:
+            return
+        if ok:
+            self.renewals += 1
+            watch.failures = 0
+            self._schedule_expiration(watch, watch.manager.expiration)
+            return
+
+        self.failures += 1
+        watch.failures += 1
+        delay = min(self.retry_max, self.retry_base * 2 ** (watch.failures - 1)) * random.uniform(0.5, 1.0)
+        logger.warning(f"Watch renewal for {email} failed ({watch.failures}x), retrying in {delay:.0f}s")
+        self._push(watch, time.time() + delay)
+
+    def stats(self) -> dict:
+        watch = self._peek()
+        return {
+            'scheduled': len(self._watches),
+            'renewing': len(self._renewing),
+            'next_renewal_in': max(0.0, watch.due - time.time()) if watch else None,
+            'next_renewal': watch.manager.email_address if watch else None,
+            'renewals': self.renewals,
+            'failures': self.failures,
+            'failing': sum(1 for w in self._watches.values() if w.failures),
+        }
+
+    async def close(self):
+        tasks = [t for t in (self._task, *self._renewing) if t]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None